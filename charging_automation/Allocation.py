@@ -0,0 +1,95 @@
+# Splitting the solar surplus between the plugged-in vehicles
+
+import math
+
+
+def clamp_amp(amp, amps_min, amps_max):
+    # Chargers don't go below the minimum amps: a vehicle that would get less gets nothing
+    if amp > amps_max:
+        return amps_max
+    if amp < amps_min:
+        return 0
+    return amp
+
+
+class PriorityAllocator:
+    """
+    Fills the vehicles one after the other in priority order (the `vehicle-priority` IDs first, then the account's
+    order): a vehicle only gets the amps the ones before it can't take.
+
+    Allocators take the total amps for the vehicles sharing the surplus and return the amps of each vehicle,
+    in the order they were given. With a single vehicle they all give it the total (within the charger limits).
+    """
+
+    def __init__(self, priority=(), amps_min=8, amps_max=48):
+        self.priority = list(priority)
+        self.amps_min = amps_min
+        self.amps_max = amps_max
+
+    def order(self, vehicles):
+        ranks = {vehicle_id: i for i, vehicle_id in enumerate(self.priority)}
+        return sorted(vehicles, key=lambda vehicle: ranks.get(vehicle.vehicle_id, len(ranks)))
+
+    def allocate(self, total_amp, vehicles):
+        amps = {}
+        remaining = total_amp
+        for vehicle in self.order(vehicles):
+            amps[vehicle.vehicle_id] = clamp_amp(remaining, self.amps_min, self.amps_max)
+            remaining -= amps[vehicle.vehicle_id]
+        return [amps[vehicle.vehicle_id] for vehicle in vehicles]
+
+
+class SocDeficitAllocator(PriorityAllocator):
+    """
+    Splits the amps in proportion to how far each vehicle is from its charge limit. When the surplus is too small
+    for every vehicle to get the minimum amps, the vehicles closest to their limit drop out, so the surplus isn't
+    spread too thin to be used. Ties go by priority.
+    """
+
+    @staticmethod
+    def deficit(vehicle):
+        limit = vehicle.battery_limit or 100
+        return max(0, limit - (vehicle.battery_level or 0))
+
+    def split(self, total_amp, vehicles):
+        # Proportional shares, capped at the charger maximum with the rest shared by the others
+        shares = {}
+        remaining = list(vehicles)
+        while remaining:
+            weights = {vehicle.vehicle_id: self.deficit(vehicle) for vehicle in remaining}
+            if not sum(weights.values()):
+                weights = dict.fromkeys(weights, 1)
+            total_weight = sum(weights.values())
+            capped = [vehicle for vehicle in remaining
+                      if total_amp * weights[vehicle.vehicle_id] / total_weight > self.amps_max]
+            if not capped:
+                for vehicle in remaining:
+                    shares[vehicle.vehicle_id] = total_amp * weights[vehicle.vehicle_id] / total_weight
+                break
+            for vehicle in capped:
+                shares[vehicle.vehicle_id] = self.amps_max
+                total_amp -= self.amps_max
+                remaining.remove(vehicle)
+        return shares
+
+    def allocate(self, total_amp, vehicles):
+        ordered = self.order(vehicles)
+        # Vehicles at their charge limit can't take anything (unless they all are)
+        candidates = [vehicle for vehicle in ordered if self.deficit(vehicle)] or ordered
+        while True:
+            shares = self.split(total_amp, candidates)
+            if len(candidates) == 1 or min(shares.values()) >= self.amps_min:
+                break
+            # min() keeps the first of equal deficits: look from the lowest priority up
+            candidates.remove(min(reversed(candidates), key=self.deficit))
+        # Chargers step by 2A
+        return [clamp_amp(math.floor(shares.get(vehicle.vehicle_id, 0) / 2) * 2, self.amps_min, self.amps_max)
+                for vehicle in vehicles]
+
+
+def create_allocator(config):
+    if config.vehicle_allocation == 'priority':
+        return PriorityAllocator(config.vehicle_priority, config.amps_min, config.amps_max)
+    if config.vehicle_allocation == 'soc-deficit':
+        return SocDeficitAllocator(config.vehicle_priority, config.amps_min, config.amps_max)
+    raise ValueError('Unknown vehicle allocation: {}'.format(config.vehicle_allocation))
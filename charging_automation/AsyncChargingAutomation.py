@@ -0,0 +1,162 @@
+# Async automation cycle: independent service calls run concurrently
+
+import asyncio
+import logging
+from ChargingAutomation import (AutomationMode, CycleBranch, CycleInputs, CycleResult, ServiceClients, VehicleInputs,
+                                apply_schedule, decide_charging, get_grid_consumption, get_grid_spread,
+                                get_measured_amp, get_night_charging_limit, is_night_time, record_schedule_changes)
+from HubitatAPI import AsyncHubitatAPI
+from RivianAPI import AsyncRivianAPI
+
+logger = logging.getLogger(__name__)
+
+
+async def get_automation_mode_async(hubitat):
+    # If not using Hubitat, hardcode the automation mode
+    if not hubitat:
+        return AutomationMode.SOLAR_ONLY
+
+    automation_on, night_charging = await asyncio.gather(hubitat.is_automation_on(), hubitat.is_night_charging_on())
+    if not automation_on:
+        return AutomationMode.OFF
+    return AutomationMode.DEFAULT if night_charging else AutomationMode.SOLAR_ONLY
+
+
+async def get_night_charging_limit_async(hubitat, default_limit):
+    if not hubitat:
+        return get_night_charging_limit(None, default_limit)
+    return await hubitat.get_night_charging_limit()
+
+
+async def get_rivian(clients):
+    # Creating the client logs in, which must happen once before any vehicle request
+    return AsyncRivianAPI(await asyncio.to_thread(lambda: clients.rivian))
+
+
+async def get_grid_readings(clients):
+    return await asyncio.to_thread(lambda: (get_grid_consumption(clients), get_grid_spread(clients)))
+
+
+def cancel(*tasks):
+    # Drop speculative requests whose results are not needed
+    for task in tasks:
+        if task is None:
+            continue
+        if task.done():
+            # Retrieve the result, so an unused failure is not reported as unhandled
+            if not task.cancelled():
+                task.exception()
+        else:
+            task.cancel()
+
+
+async def run_charging_automation_async(clients=None):
+    """
+    Async version of run_charging_automation().
+
+    Data dependencies of a cycle:
+    - Hubitat automation mode, night charging limit, and each vehicle's state and schedule are independent reads
+    - Rivian vehicle states and schedules need the Rivian login (and the list of vehicles)
+    - A vehicle's current schedule and EV draw are only used when it is charging, the grid reading only when a vehicle
+      is plugged in
+    - The schedule updates of the vehicles and the Hubitat info message are independent writes
+
+    All reads start at once (the schedules speculatively), so a cycle takes roughly as long as its slowest dependency,
+    however many vehicles there are. The grid reading (which starts the sampler, or takes ~50 seconds without it) only
+    starts once a vehicle is known to be plugged in during the day. At night it's only read if a vehicle's decision
+    needs it, like in the sequential cycle.
+    """
+    logger.info('Running charging automation cycle (async)...')
+
+    # Without long-lived clients (one-off run) create a fresh set for this cycle
+    if clients is None:
+        clients = ServiceClients()
+
+    hubitat = AsyncHubitatAPI(clients.hubitat) if clients.hubitat else None
+    night = is_night_time(clients.config)
+
+    mode_task = asyncio.create_task(get_automation_mode_async(hubitat))
+    # The night charging limit is only used at night
+    limit_task = asyncio.create_task(get_night_charging_limit_async(
+        hubitat, clients.config.night_charging_limit_default)) if night else None
+    rivian_task = asyncio.create_task(get_rivian(clients))
+
+    schedule_tasks = []
+
+    async def read_vehicle(vehicle):
+        # Vehicle state, with the current schedule read speculatively at the same time
+        schedule_task = asyncio.create_task(vehicle.get_current_schedule_amp())
+        schedule_tasks.append(schedule_task)
+        await vehicle.init_vehicle_info()
+        return vehicle, schedule_task
+
+    async def read_vehicles():
+        rivian = await rivian_task
+        return await asyncio.gather(*(read_vehicle(vehicle) for vehicle in await rivian.get_vehicles()))
+
+    async def read_charging(vehicle, schedule_task, vehicle_inputs):
+        if vehicle.is_charging():
+            # At night the draw isn't used: the vehicle charges at full speed, or is turned off
+            vehicle_inputs.current_amp, vehicle_inputs.measured_amp = await asyncio.gather(
+                schedule_task,
+                asyncio.to_thread(get_measured_amp, clients, vehicle.vehicle) if not night else asyncio.sleep(0, None))
+        else:
+            vehicle_inputs.current_amp, vehicle_inputs.measured_amp = 0, None
+        vehicle_inputs.charger_derated = vehicle.is_charger_derated()
+
+    vehicles_task = asyncio.create_task(read_vehicles())
+    grid_task = None
+
+    try:
+        logger.info('Reading config from Hubitat...')
+        mode = await mode_task
+        logger.info('Automation mode: {}'.format(mode))
+
+        # Check automation is ON
+        if mode == AutomationMode.OFF:
+            logger.info('Automation is OFF')
+            cancel(limit_task, vehicles_task, grid_task, *schedule_tasks)
+            return CycleResult(mode, CycleBranch.OFF)
+
+        vehicles = await vehicles_task
+        inputs = CycleInputs(clients, mode)
+        inputs.night = night
+        for vehicle, _ in vehicles:
+            vehicle_inputs = VehicleInputs(clients, vehicle.vehicle)
+            vehicle_inputs.charger_connected = vehicle.is_charger_connected()
+            vehicle_inputs.battery_level = vehicle.get_battery_level()
+            vehicle_inputs.battery_limit = vehicle.get_battery_limit()
+            inputs.vehicles.append(vehicle_inputs)
+
+        connected = [(vehicle, schedule_task, vehicle_inputs)
+                     for (vehicle, schedule_task), vehicle_inputs in zip(vehicles, inputs.vehicles)
+                     if vehicle_inputs.charger_connected]
+        if connected:
+            # At night the vehicles usually charge at full speed, without a grid reading
+            grid_task = asyncio.create_task(get_grid_readings(clients)) if not night else None
+            charging_limit, grid_readings, *_ = await asyncio.gather(
+                limit_task if limit_task else asyncio.sleep(0, None),
+                grid_task if grid_task else asyncio.sleep(0, None),
+                *(read_charging(*reads) for reads in connected))
+            inputs.night_charging_limit = charging_limit
+            if grid_readings is not None:
+                inputs.grid_consumption, inputs.grid_spread = grid_readings
+        cancel(limit_task, grid_task, *schedule_tasks)
+
+        result = decide_charging(inputs)
+    except BaseException:
+        cancel(mode_task, limit_task, rivian_task, vehicles_task, grid_task, *schedule_tasks)
+        raise
+
+    # Schedule updates and info message are independent writes
+    info_task = hubitat.set_info_message(*result.info) if hubitat else asyncio.sleep(0)
+    _, *updated = await asyncio.gather(info_task, *(
+        asyncio.to_thread(apply_schedule, vehicle.vehicle, vehicle_result)
+        for (vehicle, _), vehicle_result in zip(vehicles, result.vehicles)))
+    for vehicle_result, schedule_updated in zip(result.vehicles, updated):
+        vehicle_result.schedule_updated = schedule_updated
+    result.schedule_updated = any(updated)
+    record_schedule_changes(clients, result)
+
+    logger.info('Automation cycle complete')
+    return result
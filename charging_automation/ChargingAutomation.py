@@ -1,9 +1,19 @@
+import contextvars
 import logging
 import math
-from datetime import datetime
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from enum import Enum
-from Config import Config
-from EnphaseAPI import EnphaseAPI
+from functools import cached_property
+import Clock
+import Metrics
+import Resilience
+import Tracing
+from Allocation import create_allocator
+from Config import ConfigFiles
+from EvDraw import EvDrawEstimator
 from HubitatAPI import HubitatAPI
 from RivianAPI import RivianAPI
 
@@ -16,18 +26,73 @@ class AutomationMode(Enum):
     SOLAR_ONLY = 2  # only using excess solar, not charging at night
 
 
+class CycleBranch(Enum):
+    OFF = 'off'  # automation off
+    UNPLUGGED = 'unplugged'  # charger not plugged in
+    NIGHT_CHARGING = 'night-charging'  # charging at full speed at night (default mode)
+    SMALL_CHANGE = 'small-change'  # change too small, keeping the current amps
+    AMP_CHANGE = 'amp-change'  # amps adjusted to the solar surplus
+
+
+class CycleResult:
+    # Summary of an automation cycle (or of one vehicle's part of it), used to decide when to run the next one
+    def __init__(self, mode, branch):
+        self.mode = mode
+        self.branch = branch
+        self.vehicle_id = None
+        # Results of each vehicle (a single vehicle's result is the cycle's result)
+        self.vehicles = []
+        self.night = False
+        self.current_amp = 0
+        self.new_amp = 0
+        self.delta_amp = 0
+        self.grid_consumption = None
+        self.grid_spread = None
+        # Amps the EV actually draws (None if not measured), and whether the charger reports a derate
+        self.measured_amp = None
+        self.charger_derated = False
+        self.schedule_updated = False
+        # Night charging: seconds until the night charging limit is projected to be reached (None if not charging)
+        self.night_charging_time = None
+        # Info message to publish to Hubitat: (message, amps, grid watts)
+        self.info = None
+
+    def complete(self, branch, new_amp, info):
+        self.branch = branch
+        self.new_amp = new_amp
+        self.info = info
+        return self
+
+
 def is_night_time(config):
-    current_hour = datetime.now().hour
+    current_hour = Clock.now().hour
     return current_hour < config.night_time_end or current_hour >= config.night_time_start
 
 
-def calculate_delta_amp(grid_consumption):
-    # Amp = Watt / 240
+def get_seconds_until_night_end(config):
+    now = Clock.now()
+    # Whole hours, like is_night_time()
+    night_end = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(
+        hours=math.ceil(config.night_time_end))
+    if night_end <= now:
+        night_end += timedelta(days=1)
+    return (night_end - now).total_seconds()
+
+
+def get_night_charging_time(battery_level, charging_limit, config):
+    # Seconds charging at amps-max takes to reach the limit. Without charging losses, derating or the charging
+    # slowing down near the limit, so the projection is never late
+    energy = (charging_limit - battery_level) / 100 * config.vehicle_battery_capacity * 1000
+    return energy / (config.amps_max * config.charger_voltage) * 3600
+
+
+def calculate_delta_amp(grid_consumption, volts=240):
+    # Amp = Watt / Volt
     # round up to 2Amp — charger minimal step
     # If grid consumption is positive we want to round up and decrease more to avoid consuming at all.
     # If consumption is negative we also round up a negative number to make a smaller absolute increase in Amps.
 
-    delta_amp = -math.ceil(grid_consumption / 240 / 2) * 2
+    delta_amp = -math.ceil(grid_consumption / volts / 2) * 2
     return delta_amp
 
 
@@ -35,6 +100,96 @@ def is_delta_amp_too_small(delta_amp):
     return -3 < delta_amp < 3
 
 
+def is_drawing_less(measured_amp, current_amp):
+    # The EV draws noticeably less than its schedule allows (the measured power also depends on the voltage)
+    return measured_amp is not None and measured_amp < current_amp - 3
+
+
+class ReactiveController:
+    """
+    Steps the amps to the current grid reading, ignoring changes under 3A.
+
+    Controllers turn the cycle inputs into an amp change: get_delta_amp() picks the change,
+    is_delta_amp_too_small() decides whether it's worth a schedule update.
+    """
+
+    def __init__(self, config):
+        self.volts = config.charger_voltage
+
+    def get_delta_amp(self, inputs):
+        return calculate_delta_amp(inputs.grid_consumption, self.volts)
+
+    def is_delta_amp_too_small(self, delta_amp, inputs):
+        return is_delta_amp_too_small(delta_amp)
+
+
+class PredictiveController(ReactiveController):
+    """
+    Steps the amps to the surplus expected by the next cycle.
+
+    The solar production trend of the recent readings is extrapolated over the horizon, but only when it looks like
+    the sun rising: a steady ramp (readings fit a straight line) before solar noon, and no faster than the production
+    doubling in an hour. A falling trend isn't extrapolated, decreasing ahead of it gives up solar that is still there.
+    Jumps from passing clouds are left to the reactive step. While the grid readings are spread out (clouds), changes
+    need a wider band, so the amps don't chase every gap in the clouds (fewer schedule writes). The band grows faster
+    for decreases: holding one back draws a little from the grid until the cloud passes, while holding back an
+    increase leaves solar unused.
+    Without a background sampler there is no history, and it works like the reactive controller.
+    """
+    # Amps of hysteresis per amp's worth of grid spread for increases and decreases, and the widest band
+    INCREASE_DEADBAND = 0.4
+    DECREASE_DEADBAND = 1.0
+    MAX_DEADBAND = 6
+    # How well the readings must fit a straight line (R squared) to extrapolate the trend
+    MIN_TREND_FIT = 0.8
+    # Grid spread window (seconds), longer than the scheduler's so a gap in the clouds doesn't reset it
+    SPREAD_WINDOW = 30 * 60
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.horizon = config.controller_horizon
+        self.trend_window = config.controller_trend_window
+        self.solar_noon = config.solar_noon
+
+    def get_production_change(self, inputs):
+        # Expected change of the solar production over the horizon (W)
+        sampler = inputs.clients.sampler
+        if not sampler:
+            return 0
+        trend, fit = sampler.get_production_trend(self.trend_window)
+        production = sampler.get_latest_production()
+        if trend is None or trend <= 0 or fit < self.MIN_TREND_FIT or not production:
+            return 0
+        if Clock.now().hour >= self.solar_noon:
+            return 0
+        return min(production * self.horizon / 3600, trend * self.horizon)
+
+    def get_spread(self, inputs):
+        sampler = inputs.clients.sampler
+        return sampler.get_grid_spread(self.SPREAD_WINDOW) if sampler else inputs.grid_spread
+
+    def get_delta_amp(self, inputs):
+        production_change = self.get_production_change(inputs)
+        if production_change:
+            logger.info('Expected solar production change in the next {} seconds: {}W'.format(
+                self.horizon, round(production_change)))
+        return calculate_delta_amp(inputs.grid_consumption - production_change, self.volts)
+
+    def is_delta_amp_too_small(self, delta_amp, inputs):
+        spread = self.get_spread(inputs) or 0
+        per_amp = self.INCREASE_DEADBAND if delta_amp > 0 else self.DECREASE_DEADBAND
+        deadband = min(self.MAX_DEADBAND, max(3, per_amp * spread / self.volts))
+        return abs(delta_amp) < deadband
+
+
+def create_controller(config):
+    if config.controller == 'predictive':
+        return PredictiveController(config)
+    if config.controller == 'reactive':
+        return ReactiveController(config)
+    raise ValueError('Unknown controller: {}'.format(config.controller))
+
+
 def get_automation_mode(hubitat):
     # If not using Hubitat, hardcode the automation mode
     if not hubitat:
@@ -47,106 +202,614 @@ def get_automation_mode(hubitat):
     return AutomationMode.DEFAULT if night_charging else AutomationMode.SOLAR_ONLY
 
 
-def get_night_charging_limit(hubitat):
-    # If not using Hubitat, hardcode 50%
+def get_night_charging_limit(hubitat, default_limit=50):
+    # If not using Hubitat, use the configured limit
     if not hubitat:
-        return 50
+        return default_limit
 
     limit = hubitat.get_night_charging_limit()
     return limit
 
 
-def run_charging_automation():
-    logger.info('Running charging automation cycle...')
+class ServiceClients:
+    """
+    Long-lived API clients shared by all automation cycles of a process.
 
-    hubitat = HubitatAPI('hubitat-config.json')
-    # If not using Hubitat replace with the line below
-    # hubitat = None
+    Each client keeps its own keep-alive session and only logs in again when a call fails,
+    so a cycle does not pay for re-reading config files, TLS handshakes and logins.
+    The Rivian and Enphase clients are created on first use, so a failed login is retried on the next cycle.
+    Their modules are only imported then too, so a cycle that doesn't need Enphase readings doesn't load them.
+    """
 
-    logger.info('Reading config from Hubitat...')
-    mode = get_automation_mode(hubitat)
+    def __init__(self, config_file='config.json', hubitat_config_file='hubitat-config.json',
+                 rivian_session_file='rivian-session.json', rivian_schedule_file='rivian-schedule.json',
+                 enphase_token_file='enphase-token.json', use_sampler=False, use_subscription=False):
+        # Config files, read again when they change (see reload_config)
+        self.config_files = ConfigFiles(config_file, hubitat_config_file)
+        self.config = self.config_files.config
+        self.hubitat_config = self.config_files.hubitat
+        # Timeouts, retries and circuit breakers of the API requests
+        self.policy = Resilience.Policy.from_config(self.config)
+        Tracing.configure(self.config)
+        self.rivian_session_file = rivian_session_file
+        self.rivian_schedule_file = rivian_schedule_file
+        self.enphase_token_file = enphase_token_file
+        # If not using Hubitat create the clients with hubitat_config_file=None
+        self.hubitat = HubitatAPI(self.hubitat_config, self.policy) if self.hubitat_config else None
+        self._rivian = None
+        self._enphase = None
+        self._sampler = None
+        self._store = None
+        # Guard the creation of the lazy clients, which the async cycle may first use from two worker threads at once
+        # (the Enphase client, its store and the sampler share one, so a Rivian login doesn't hold up the Enphase one)
+        self.rivian_lock = threading.Lock()
+        self.enphase_lock = threading.RLock()
+        self.use_sampler = use_sampler
+        # Whether the Rivian vehicle state subscription may be used (daemon mode only)
+        self.use_subscription = use_subscription
+        # Set by pushed events that should run a cycle right away (a Hubitat switch, a vehicle plugged in)
+        self.changes = threading.Event()
+        self.controller = create_controller(self.config)
+        self.allocator = create_allocator(self.config)
+        # Vehicle ID -> EV draw estimator
+        self.ev_draw = {}
+        # State of a previous run, applied to each client when it's created (see restore_state)
+        self.warm_state = {}
 
-    logger.info('Automation mode: {}'.format(mode))
+    @property
+    def rivian(self):
+        with self.rivian_lock:
+            if self._rivian is None:
+                self._rivian = RivianAPI(self.config, self.rivian_session_file, self.rivian_schedule_file, self.policy)
+                if self.use_subscription and self.config.rivian_vehicle_subscription:
+                    self.start_rivian_subscription()
+            return self._rivian
+
+    def start_rivian_subscription(self):
+        try:
+            from RivianSubscription import VehicleStateSubscription
+        except ImportError as e:
+            logger.warning('The Rivian vehicle subscription needs the websockets package, polling instead: {}'.format(
+                e))
+            return
+        self._rivian.subscription = VehicleStateSubscription(self._rivian, self.config.rivian_subscription_url,
+                                                             self.changes).start()
+
+    @property
+    def rivian_vehicles(self):
+        # Vehicles of the Rivian client, without logging in if it isn't created yet
+        return self._rivian.vehicles if self._rivian is not None else []
+
+    @property
+    def enphase(self):
+        with self.enphase_lock:
+            if self._enphase is None:
+                from EnphaseAPI import EnphaseAPI
+                config = self.config
+                self._enphase = EnphaseAPI(config.enphase_credentials(), self.store, config.enphase_sampling_profile,
+                                           config.enphase_production_interval, self.policy, self.enphase_token_file,
+                                           *get_reading_schedule(config))
+                if 'enphase' in self.warm_state:
+                    self._enphase.restore_state(self.warm_state['enphase'])
+            return self._enphase
+
+    @property
+    def store(self):
+        # Optional on-disk store of the Enphase readings
+        with self.enphase_lock:
+            if self.config.timeseries_dir and self._store is None:
+                from TimeSeriesStore import TimeSeriesStore
+                self._store = TimeSeriesStore(self.config.timeseries_dir, self.config.timeseries_raw_retention_days)
+            return self._store
+
+    @property
+    def sampler(self):
+        # Background Enphase sampler, started on first use and resumed after a pause (daemon mode only)
+        with self.enphase_lock:
+            if self.use_sampler and self._sampler is None:
+                from EnphaseSampler import EnphaseSampler
+                self._sampler = EnphaseSampler(self.enphase, self.config.enphase_sample_interval,
+                                               self.config.enphase_sample_buffer)
+            if self._sampler is not None:
+                self._sampler.resume()
+            return self._sampler
+
+    @property
+    def running_sampler(self):
+        # The background sampler if it's running, without starting or resuming it
+        sampler = self._sampler
+        return sampler if sampler is not None and sampler.running else None
+
+    def pause_sampler(self):
+        # Stops reading the gateway while no cycle needs the grid readings (idle or night intervals)
+        with self.enphase_lock:
+            if self._sampler is not None:
+                self._sampler.pause()
+
+    def get_ev_draw(self, vehicle_id):
+        # EV draw estimator of a vehicle, None when not measuring the draw
+        if not self.config.measure_ev_draw:
+            return None
+        return self.ev_draw.setdefault(vehicle_id, EvDrawEstimator(self.config.charger_voltage))
+
+    def reload_config(self):
+        """
+        Reads the config files again if they changed (a stat() per file otherwise), and passes the new settings on.
+
+        Clients whose credentials or connection settings changed are closed, and created again (logging in) when
+        they are next used. The others take the new settings as they are.
+        """
+        if not self.config_files.reload():
+            return
+        old, config = self.config, self.config_files.config
+        self.config = config
+        if self.config_files.hubitat is not self.hubitat_config:
+            self.hubitat_config = self.config_files.hubitat
+            if self.hubitat is not None:
+                self.hubitat.apply_config(self.hubitat_config)
+                self.hubitat.invalidate()
+        if config is old:
+            return
+
+        self.policy.apply_config(config)
+        Tracing.configure(config)
+        if self._rivian is not None:
+            if config.rivian_settings() != old.rivian_settings():
+                logger.info('Rivian settings changed, logging in again on next use')
+                self._rivian.close()
+                self._rivian = None
+            else:
+                self._rivian.config = config
+        if self._sampler is not None and (config.enphase_sample_interval, config.enphase_sample_buffer) != \
+                (old.enphase_sample_interval, old.enphase_sample_buffer):
+            self._sampler.stop()
+            self._sampler = None
+        if self._store is not None and (config.timeseries_dir, config.timeseries_raw_retention_days) != \
+                (old.timeseries_dir, old.timeseries_raw_retention_days):
+            self._store.close()
+            self._store = None
+        if self._enphase is not None:
+            if config.enphase_credentials() != old.enphase_credentials():
+                logger.info('Enphase credentials changed, logging in again on next use')
+                self.close_enphase()
+            else:
+                enphase = self._enphase
+                enphase.store = self.store
+                enphase.profile = config.enphase_sampling_profile
+                enphase.production_interval = config.enphase_production_interval
+                enphase.num_readings, enphase.reading_interval = get_reading_schedule(config)
+        self.controller = create_controller(config)
+        self.allocator = create_allocator(config)
+        for estimator in self.ev_draw.values():
+            estimator.volts = config.charger_voltage
+
+    def restore_state(self, state):
+        # Picks up where a previous run (main.py --once) left off, instead of starting cold
+        self.warm_state = state
+        if self.hubitat is not None and 'hubitat' in state:
+            self.hubitat.restore_state(state['hubitat'])
+
+    def get_state(self):
+        # The state to restore in the next run. Clients this run didn't use keep their previous state
+        state = dict(self.warm_state)
+        if self.hubitat is not None:
+            state['hubitat'] = self.hubitat.get_state()
+        if self._enphase is not None:
+            state['enphase'] = self._enphase.get_state()
+        return state
+
+    def close_enphase(self, keep_stream=False):
+        # The sampler reads through the Enphase client, both go
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        if self._enphase is not None:
+            self._enphase.close(keep_stream)
+            self._enphase = None
+
+    def wait_for_changes(self, timeout):
+        # Sleeps until the next cycle is due, returns True if woken up early by a pushed change
+        if not Clock.wait(self.changes, timeout):
+            return False
+        self.changes.clear()
+        return True
+
+    def close(self, keep_stream=False):
+        self.close_enphase(keep_stream)
+        if self._rivian is not None:
+            self._rivian.close()
+            self._rivian = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+        Tracing.stop()
+
+
+def get_reading_schedule(config):
+    # Readings taken for a decision without the background sampler, and the seconds between them
+    return max(1, config.enphase_sample_window // config.enphase_sample_interval), config.enphase_sample_interval
+
+
+def get_grid_consumption(clients):
+    sampler = clients.sampler
+    if not sampler:
+        return clients.enphase.get_median_grid_consumption()
+
+    config = clients.config
+    window = config.enphase_sample_window
+    # Right after start-up the buffer may not cover the window yet
+    min_samples = max(1, window // config.enphase_sample_interval)
+    sampler.wait_for_samples(min_samples, window, timeout=window + config.enphase_sample_interval)
+    grid_consumption = sampler.get_grid_consumption(window, config.grid_consumption_statistic)
+    if grid_consumption is None:
+        raise Resilience.ServiceUnavailable('No recent Enphase readings available')
+    return grid_consumption
+
+
+def get_grid_spread(clients):
+    # Standard deviation of the grid readings over a longer window — how much the solar surplus is moving
+    sampler = clients.sampler
+    if not sampler:
+        return None
+    return sampler.get_grid_spread(clients.config.grid_spread_window)
+
+
+def get_measured_amp(clients, vehicle):
+    # Amps the EV draws while charging, None when unknown (or not measured)
+    estimator = clients.get_ev_draw(vehicle.vehicle_id)
+    if not estimator or not vehicle.is_charging():
+        return None
+    # Without a running sampler there are no consumption readings to estimate the draw from (and none worth starting it)
+    return estimator.estimate(vehicle, clients.running_sampler)
 
-    # Check automation is ON
-    if mode == AutomationMode.OFF:
-        logger.info('Automation is OFF')
-        return
 
-    config = Config('config.json')
-    rivian = RivianAPI(config, 'rivian-session.json')
-    enphase = EnphaseAPI('config.json')
+def record_schedule_changes(clients, result):
+    # Lets the EV draw estimators measure how the chargers followed the schedule updates
+    updated = [vehicle_result for vehicle_result in result.vehicles if vehicle_result.schedule_updated]
+    for vehicle_result in updated:
+        # No draw to measure after an "off" write (unplugged, night charging stopped)
+        if vehicle_result.new_amp == 0 or vehicle_result.branch == CycleBranch.UNPLUGGED:
+            continue
+        estimator = clients.get_ev_draw(vehicle_result.vehicle_id)
+        if not estimator:
+            continue
+        draw_amp = vehicle_result.measured_amp if vehicle_result.measured_amp is not None \
+            else vehicle_result.current_amp
+        # The consumption step can't tell apart vehicles that changed at the same time. Only a running sampler is used,
+        # a schedule write isn't worth starting it
+        sampler = clients.running_sampler if len(updated) == 1 else None
+        estimator.record_change(sampler, draw_amp, vehicle_result.new_amp)
+
+
+class CycleInputs:
+    """
+    Everything a cycle decides on: the values shared by all vehicles here, each vehicle's own in a VehicleInputs.
+
+    Each value is read from the services the first time the decision needs it, so the sequential cycle only makes
+    the requests its branch requires. The async cycle fetches them concurrently up front and assigns them instead.
+    """
+
+    def __init__(self, clients, mode, vehicles=()):
+        self.clients = clients
+        self.mode = mode
+        self.vehicles = list(vehicles)
+
+    @cached_property
+    def night(self):
+        return is_night_time(self.clients.config)
+
+    @cached_property
+    def night_charging_limit(self):
+        return get_night_charging_limit(self.clients.hubitat, self.clients.config.night_charging_limit_default)
+
+    @cached_property
+    def grid_consumption(self):
+        return get_grid_consumption(self.clients)
+
+    @cached_property
+    def grid_spread(self):
+        return get_grid_spread(self.clients)
+
+
+class VehicleInputs:
+    # Values of one vehicle a cycle decides on, read on first use like CycleInputs
+    def __init__(self, clients, vehicle):
+        self.clients = clients
+        self.vehicle = vehicle
+        self.vehicle_id = vehicle.vehicle_id
+
+    @cached_property
+    def charger_connected(self):
+        return self.vehicle.is_charger_connected()
+
+    @cached_property
+    def current_amp(self):
+        vehicle = self.vehicle
+        return vehicle.get_current_schedule_amp() if vehicle.is_charging() else 0
+
+    @cached_property
+    def measured_amp(self):
+        return get_measured_amp(self.clients, self.vehicle)
+
+    @cached_property
+    def charger_derated(self):
+        return self.vehicle.is_charger_derated()
+
+    @cached_property
+    def battery_level(self):
+        return self.vehicle.get_battery_level()
+
+    @cached_property
+    def battery_limit(self):
+        return self.vehicle.get_battery_limit()
+
+
+def get_info(amp, grid_consumption):
+    return 'Charging: disabled' if amp == 0 else 'Charging: enabled', amp, grid_consumption
+
+
+def decide_vehicle(inputs, vehicle):
+    """
+    The part of a vehicle's decision that doesn't depend on the solar surplus.
+    Returns the vehicle's result, completed unless the vehicle shares the surplus, and the amps it starts from.
+    """
+    mode = inputs.mode
+    result = CycleResult(mode, None)
+    result.vehicle_id = vehicle.vehicle_id
+    result.night = inputs.night
+    if len(inputs.vehicles) > 1:
+        logger.info('Vehicle {}:'.format(vehicle.vehicle_id))
 
     # Check if charger is plugged in
-    if not rivian.is_charger_connected():
+    if not vehicle.charger_connected:
         logger.info('Charger not plugged in')
-        rivian.set_schedule_off()
-        if hubitat:
-            hubitat.set_info_message('Charging: not plugged in', 0, 0)
-        return
+        return result.complete(CycleBranch.UNPLUGGED, 0, ('Charging: not plugged in', 0, 0)), 0
 
     # Current charging speed
-    current_amp = rivian.get_current_schedule_amp() if rivian.is_charging() else 0
+    current_amp = result.current_amp = vehicle.current_amp
 
     # Check night time
-    if is_night_time(config):
+    if result.night:
         if mode == AutomationMode.SOLAR_ONLY:
             logger.info('Mode == Solar-only: Disabling charging at night')
-            rivian.set_schedule_off()
             current_amp = 0
-            if hubitat:
-                hubitat.set_info_message('Charging: disabled (night off)', 0, 0)
         if mode == AutomationMode.DEFAULT:
             # In default mode, charge to a certain % at night
-            charging_limit = get_night_charging_limit(hubitat)
-            ev_battery_level = rivian.get_battery_level()
+            charging_limit = inputs.night_charging_limit
+            ev_battery_level = vehicle.battery_level
             if ev_battery_level < charging_limit:
                 logger.info('Mode == Default: Charging to {}% at night (now at {}%)'.format(
                     charging_limit, round(ev_battery_level)))
-                rivian.set_schedule_default()
-                if hubitat:
-                    hubitat.set_info_message('Charging: enabled (night)', RivianAPI.AMPS_MAX, 0)
+                config = inputs.clients.config
+                result.night_charging_time = get_night_charging_time(ev_battery_level, charging_limit, config)
+                logger.info('Projected to reach {}% in {} minutes'.format(
+                    charging_limit, round(result.night_charging_time / 60)))
                 # Short-circuit if already charging
-                return
+                amps_max = config.amps_max
+                return result.complete(CycleBranch.NIGHT_CHARGING, amps_max,
+                                       ('Charging: enabled (night)', amps_max, 0)), current_amp
             else:
                 logger.info('Mode == Default: Charged to {}% at night (already at {}%)'.format(
                     charging_limit, round(ev_battery_level)))
-                rivian.set_schedule_off()
                 current_amp = 0
-                if hubitat:
-                    hubitat.set_info_message('Charging: disabled (night full)', 0, 0)
 
+    if current_amp:
+        result.measured_amp = vehicle.measured_amp
+        result.charger_derated = vehicle.charger_derated
+    return result, current_amp
+
+
+def share_surplus(inputs, sharing, controller):
+    # Adjusts the amps of the (vehicle, result, current amps) sharing the solar surplus
     # Read production data from Enphase
-    grid_consumption = enphase.get_median_grid_consumption()
-    delta_amp = calculate_delta_amp(grid_consumption)
-    logger.info('Grid consumption: {} ; Current Amp: {} ; Delta Amp: {}'.format(grid_consumption, current_amp, delta_amp))
+    grid_consumption = inputs.grid_consumption
+    delta_amp = controller.get_delta_amp(inputs)
+    total_current = total_base = 0
+    for vehicle, result, current_amp in sharing:
+        result.grid_consumption = grid_consumption
+        result.grid_spread = inputs.grid_spread
+        base_amp = current_amp
+        if is_drawing_less(result.measured_amp, current_amp):
+            # Derated, ramping or nearly full: the surplus comes on top of what the car actually draws, not of the
+            # amps set, so raising the amps further would leave it unused
+            logger.info('EV draws {}A of {}A{}'.format(round(result.measured_amp, 1), current_amp,
+                                                        ' (charger derated)' if result.charger_derated else ''))
+            base_amp = round(result.measured_amp / 2) * 2
+        total_current += current_amp
+        total_base += base_amp
+    delta_amp += total_base - total_current
+    logger.info('Grid consumption: {} ; Current Amp: {} ; Delta Amp: {}'.format(
+        grid_consumption, total_current, delta_amp))
+    for vehicle, result, current_amp in sharing:
+        result.delta_amp = delta_amp
 
-    if is_delta_amp_too_small(delta_amp):
+    if controller.is_delta_amp_too_small(delta_amp, inputs):
         # Ignore small changes to avoid flipping
         logger.info('Small or no change. Ignoring')
         # Always set the expected state
-        rivian.set_schedule_amps(current_amp)
-        if hubitat:
-            hubitat.set_info_message(
-                'Charging: disabled' if current_amp == 0 else 'Charging: enabled',
-                current_amp,
-                grid_consumption)
+        for vehicle, result, current_amp in sharing:
+            result.complete(CycleBranch.SMALL_CHANGE, current_amp, get_info(current_amp, grid_consumption))
         return
 
-    new_amp = current_amp + delta_amp
-    if new_amp > RivianAPI.AMPS_MAX:
-        new_amp = RivianAPI.AMPS_MAX
-    if new_amp < RivianAPI.AMPS_MIN:
-        new_amp = 0
-
-    logger.info('Current Amp: {} ; New Amp: {}'.format(current_amp, new_amp))
-    if new_amp == 0:
-        rivian.set_schedule_off()
-        if hubitat:
-            hubitat.set_info_message('Charging: disabled', new_amp, grid_consumption)
+    new_amps = inputs.clients.allocator.allocate(total_current + delta_amp, [vehicle for vehicle, _, _ in sharing])
+    for (vehicle, result, current_amp), new_amp in zip(sharing, new_amps):
+        if len(sharing) > 1 and 0 < new_amp < inputs.clients.config.amps_max and \
+                controller.is_delta_amp_too_small(new_amp - current_amp, inputs):
+            # Don't shift small amounts between vehicles
+            result.complete(CycleBranch.SMALL_CHANGE, current_amp, get_info(current_amp, grid_consumption))
+            continue
+        logger.info('{}Current Amp: {} ; New Amp: {}'.format(
+            'Vehicle {}: '.format(vehicle.vehicle_id) if len(sharing) > 1 else '', current_amp, new_amp))
+        result.complete(CycleBranch.AMP_CHANGE, new_amp, get_info(new_amp, grid_consumption))
+
+
+def combine_results(inputs, results):
+    # The cycle's result: a single vehicle's own, or a summary of all vehicles
+    if len(results) == 1:
+        result = results[0]
+        result.vehicles = [result]
+        return result
+
+    result = CycleResult(inputs.mode, CycleBranch.UNPLUGGED)
+    result.vehicles = results
+    result.night = inputs.night
+    if not results:
+        logger.info('No Rivian vehicles found')
+        return result.complete(CycleBranch.UNPLUGGED, 0, ('Charging: not plugged in', 0, 0))
+    for branch in (CycleBranch.AMP_CHANGE, CycleBranch.NIGHT_CHARGING, CycleBranch.SMALL_CHANGE):
+        if any(vehicle_result.branch == branch for vehicle_result in results):
+            result.branch = branch
+            break
+    result.current_amp = sum(vehicle_result.current_amp for vehicle_result in results)
+    result.delta_amp = max((vehicle_result.delta_amp for vehicle_result in results), key=abs)
+    for vehicle_result in results:
+        if vehicle_result.grid_consumption is not None:
+            result.grid_consumption = vehicle_result.grid_consumption
+            result.grid_spread = vehicle_result.grid_spread
+    measured = [vehicle_result.measured_amp for vehicle_result in results if vehicle_result.measured_amp is not None]
+    result.measured_amp = sum(measured) if measured else None
+    result.charger_derated = any(vehicle_result.charger_derated for vehicle_result in results)
+    # The next check is due when the first vehicle reaches its limit
+    charging_times = [vehicle_result.night_charging_time for vehicle_result in results
+                      if vehicle_result.night_charging_time is not None]
+    result.night_charging_time = min(charging_times) if charging_times else None
+    new_amp = sum(vehicle_result.new_amp for vehicle_result in results)
+    message, _, grid_consumption = get_info(new_amp, result.grid_consumption or 0)
+    if result.branch == CycleBranch.NIGHT_CHARGING:
+        message = 'Charging: enabled (night)'
+    # Hubitat takes the message in the URL path, so no slashes
+    amps = ', '.join(str(vehicle_result.new_amp) for vehicle_result in results)
+    return result.complete(result.branch, new_amp, (message, amps, grid_consumption))
+
+
+def decide_charging(inputs, controller=None):
+    controller = controller or inputs.clients.controller
+    results = []
+    sharing = []
+    for vehicle in inputs.vehicles:
+        with Tracing.span('decide_vehicle', vehicle=vehicle.vehicle_id) as span:
+            result, current_amp = decide_vehicle(inputs, vehicle)
+            span['branch'] = result.branch.value if result.branch else 'share-surplus'
+        results.append(result)
+        if result.branch is None:
+            sharing.append((vehicle, result, current_amp))
+    if sharing:
+        with Tracing.span('share_surplus', vehicles=len(sharing)) as span:
+            share_surplus(inputs, sharing, controller)
+            span['branches'] = [vehicle_result.branch.value for _, vehicle_result, _ in sharing]
+    return combine_results(inputs, results)
+
+
+def apply_schedule(vehicle, result):
+    # Returns True if the vehicle's charging schedule had to be updated
+    schedule_updates = vehicle.schedule_updates
+    if result.new_amp == 0:
+        vehicle.set_schedule_off()
+    elif result.branch == CycleBranch.NIGHT_CHARGING:
+        vehicle.set_schedule_default()
     else:
-        rivian.set_schedule_amps(new_amp)
-        if hubitat:
-            hubitat.set_info_message('Charging: enabled', new_amp, grid_consumption)
+        vehicle.set_schedule_amps(result.new_amp)
+    return vehicle.schedule_updates > schedule_updates
+
+
+def init_vehicles_info(vehicles):
+    # Reads the state of all vehicles at once (the worker threads keep the cycle's deadline and tracing context)
+    if len(vehicles) < 2:
+        for vehicle in vehicles:
+            vehicle.init_vehicle_info()
+        return
+    # As many at once as the Rivian session's connection pool holds
+    with ThreadPoolExecutor(max_workers=min(len(vehicles), 4)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, vehicle.init_vehicle_info) for vehicle in vehicles]
+        for future in futures:
+            future.result()
+
+
+def apply_schedules(vehicles, result):
+    # Each vehicle's schedule is written on its own (unchanged schedules are not written)
+    for vehicle, vehicle_result in zip(vehicles, result.vehicles):
+        vehicle_result.schedule_updated = apply_schedule(vehicle, vehicle_result)
+    return any(vehicle_result.schedule_updated for vehicle_result in result.vehicles)
+
+
+def publish_info(hubitat, result):
+    if hubitat:
+        hubitat.set_info_message(*result.info)
+
+
+def get_decision_label(result):
+    # Branch of the decision for the metrics, telling night charging apart from charging disabled at night
+    if result.night and result.branch in (CycleBranch.SMALL_CHANGE, CycleBranch.AMP_CHANGE):
+        return 'night-off'
+    if result.branch == CycleBranch.NIGHT_CHARGING:
+        return 'night-default'
+    return result.branch.value
+
+
+def record_cycle_metrics(result, duration):
+    Metrics.CYCLE_DURATION.observe(duration)
+    if result is None:
+        Metrics.CYCLE_FAILURES.inc()
+        return
+
+    Metrics.DECISIONS.inc(get_decision_label(result))
+    for mode in AutomationMode:
+        Metrics.AUTOMATION_MODE.set(1 if mode == result.mode else 0, mode.name.lower())
+    for vehicle_result in result.vehicles:
+        Metrics.CURRENT_AMPS.set(vehicle_result.new_amp, vehicle_result.vehicle_id)
+        Metrics.CHARGER_DERATED.set(1 if vehicle_result.charger_derated else 0, vehicle_result.vehicle_id)
+        if vehicle_result.measured_amp is not None:
+            Metrics.EV_DRAW_AMPS.set(vehicle_result.measured_amp, vehicle_result.vehicle_id)
+
+
+def apply_safe_state(clients):
+    """
+    Called after a cycle was aborted (deadline passed, a service is down): the solar surplus is unknown,
+    so during the day charging is turned off rather than left at amps that may now come from the grid.
+    At night the schedule is left as it is, night charging is meant to use the grid.
+    """
+    if is_night_time(clients.config):
+        return
+    with Resilience.deadline(clients.config.safe_state_timeout):
+        for vehicle in clients.rivian_vehicles:
+            logger.info('Turning charging off until the next cycle ({})'.format(vehicle.vehicle_id))
+            try:
+                vehicle.set_schedule_off()
+            except requests.RequestException as e:
+                logger.error('Failed to turn charging off: {}'.format(e))
+
+
+def run_charging_automation(clients=None):
+    logger.info('Running charging automation cycle...')
+
+    # Without long-lived clients (one-off run) create a fresh set for this cycle
+    if clients is None:
+        clients = ServiceClients()
+
+    hubitat = clients.hubitat
+
+    logger.info('Reading config from Hubitat...')
+    with Tracing.span('get_automation_mode') as span:
+        mode = get_automation_mode(hubitat)
+        span['mode'] = mode.name.lower()
+
+    logger.info('Automation mode: {}'.format(mode))
+
+    # Check automation is ON
+    if mode == AutomationMode.OFF:
+        logger.info('Automation is OFF')
+        return CycleResult(mode, CycleBranch.OFF)
+
+    vehicles = clients.rivian.get_vehicles()
+    init_vehicles_info(vehicles)
+
+    with Tracing.span('decide_charging') as span:
+        result = decide_charging(CycleInputs(clients, mode, [VehicleInputs(clients, vehicle) for vehicle in vehicles]))
+        span['branch'] = get_decision_label(result)
+    with Tracing.span('apply_schedules') as span:
+        result.schedule_updated = span['updated'] = apply_schedules(vehicles, result)
+    record_schedule_changes(clients, result)
+    publish_info(hubitat, result)
 
     logger.info('Automation cycle complete')
+    return result
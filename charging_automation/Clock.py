@@ -0,0 +1,88 @@
+# Injectable clock
+#
+# All time reads, sleeps and periodic background tasks go through the installed clock,
+# so the simulator can replace it and run a simulated day in seconds.
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask(threading.Thread):
+    # Calls `function` every `interval` seconds in a background thread, starting immediately
+    def __init__(self, name, interval, function):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.function = function
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.function()
+            except Exception as e:
+                logger.error('{} failed: {}'.format(self.name, e))
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        # Like event.wait(timeout): True if the event was set before the timeout
+        return event.wait(timeout)
+
+    def start_periodic(self, name, interval, function):
+        task = PeriodicTask(name, interval, function)
+        task.start()
+        return task
+
+
+clock = SystemClock()
+
+
+def install(new_clock):
+    global clock
+    clock = new_clock
+
+
+def time_now():
+    return clock.time()
+
+
+def monotonic():
+    return clock.monotonic()
+
+
+def now():
+    return clock.now()
+
+
+def sleep(seconds):
+    clock.sleep(seconds)
+
+
+def wait(event, timeout=None):
+    return clock.wait(event, timeout)
+
+
+def start_periodic(name, interval, function):
+    return clock.start_periodic(name, interval, function)
@@ -1,6 +1,30 @@
 # Charging Automation Config
+#
+# config.json and hubitat-config.json are read once at start-up into Config / HubitatConfig, and validated.
+# ConfigFiles reads a file again only when its modification time changes, so settings can be tuned without a restart.
 
 import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ENPHASE_SAMPLING_PROFILES = ['lean', 'full']
+GRID_CONSUMPTION_STATISTICS = ['median', 'mean', 'trimmed-mean']
+CONTROLLERS = ['reactive', 'predictive']
+VEHICLE_ALLOCATIONS = ['priority', 'soc-deficit']
+
+
+def check_choice(config_file, key, value, choices):
+    if value not in choices:
+        raise ValueError('{}: "{}" must be one of {}, not {!r}'.format(config_file, key, ', '.join(choices), value))
+
+
+def check_number(config_file, key, value, minimum=0, positive=True):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum or \
+            (positive and value == minimum):
+        raise ValueError('{}: "{}" must be a number {} {}, not {!r}'.format(
+            config_file, key, '>' if positive else '>=', minimum, value))
 
 
 class Config:
@@ -9,17 +33,266 @@ class Config:
         self.rivian_user = None
         self.rivian_pass = None
         self.enphase_token = None
+        self.enphase_user = None
+        self.enphase_pass = None
         self.enphase_gateway_sn = None
         self.enphase_gateway_host = None
         self.night_time_start = None
         self.night_time_end = None
+        self.enphase_sample_interval = None
+        self.enphase_sample_window = None
+        self.enphase_sample_buffer = None
+        self.enphase_sampling_profile = None
+        self.enphase_production_interval = None
+        self.grid_consumption_statistic = None
+        self.grid_spread_window = None
+        self.iteration_time = None
+        self.fast_iteration_time = None
+        self.stable_iteration_time = None
+        self.idle_iteration_time = None
+        self.min_schedule_write_gap = None
+        self.grid_spread_threshold = None
+        self.large_delta_amp = None
+        self.rivian_schedule_max_age = None
+        self.rivian_persisted_queries = None
+        self.rivian_host = None
+        self.rivian_vehicle_subscription = None
+        self.rivian_subscription_url = None
+        self.metrics_port = None
+        self.connect_timeout = None
+        self.read_timeout = None
+        self.request_retries = None
+        self.circuit_breaker_threshold = None
+        self.circuit_breaker_reset = None
+        self.cycle_deadline = None
+        self.safe_state_timeout = None
+        self.timeseries_dir = None
+        self.timeseries_raw_retention_days = None
+        self.trace_file = None
+        self.trace_max_bytes = None
+        self.trace_backup_count = None
+        self.controller = None
+        self.controller_horizon = None
+        self.controller_trend_window = None
+        self.solar_noon = None
+        self.measure_ev_draw = None
+        self.vehicle_allocation = None
+        self.vehicle_priority = None
+        self.amps_min = None
+        self.amps_max = None
+        self.charger_voltage = None
+        self.night_charging_limit_default = None
+        self.vehicle_battery_capacity = None
+        self.night_planner_margin = None
 
         with open(self.config_file) as f:
             data = json.load(f)
             self.rivian_user = data['rivian-user']
             self.rivian_pass = data['rivian-pass']
             self.enphase_token = data['enphase-token']
+            # Optional: Enphase account, to get a new token when it expires
+            self.enphase_user = data.get('enphase-user')
+            self.enphase_pass = data.get('enphase-pass')
             self.enphase_gateway_sn = data['enphase-gateway-sn']
             self.enphase_gateway_host = data['enphase-gateway-host']
             self.night_time_start = data['night-time-start']
             self.night_time_end = data['night-time-end']
+            # Optional: background Enphase sampling (seconds between readings, decision window, ring buffer size)
+            self.enphase_sample_interval = data.get('enphase-sample-interval', 10)
+            self.enphase_sample_window = data.get('enphase-sample-window', 50)
+            self.enphase_sample_buffer = data.get('enphase-sample-buffer', 360)
+            # Which gateway endpoints each reading uses, one of: lean (live data, production.json every
+            # enphase-production-interval seconds), full (both on every reading)
+            self.enphase_sampling_profile = data.get('enphase-sampling-profile', 'lean')
+            self.enphase_production_interval = data.get('enphase-production-interval', 15 * 60)
+            # One of: median, mean, trimmed-mean
+            self.grid_consumption_statistic = data.get('grid-consumption-statistic', 'median')
+            self.grid_spread_window = data.get('grid-spread-window', 300)
+            # Optional: adaptive scheduling of the automation cycles (seconds)
+            self.iteration_time = data.get('iteration-time', 5 * 60)
+            self.fast_iteration_time = data.get('fast-iteration-time', 90)
+            self.stable_iteration_time = data.get('stable-iteration-time', 15 * 60)
+            self.idle_iteration_time = data.get('idle-iteration-time', 30 * 60)
+            self.min_schedule_write_gap = data.get('min-schedule-write-gap', 3 * 60)
+            # Grid readings spread (W) and amp change that switch to fast iterations
+            self.grid_spread_threshold = data.get('grid-spread-threshold', 300)
+            self.large_delta_amp = data.get('large-delta-amp', 6)
+            # Optional: how long the local copy of the Rivian charging schedule is trusted (seconds)
+            self.rivian_schedule_max_age = data.get('rivian-schedule-max-age', 60 * 60)
+            # Optional: send Apollo persisted query hashes instead of the full query text to Rivian
+            self.rivian_persisted_queries = data.get('rivian-persisted-queries', False)
+            # Optional: Rivian API host (e.g. a local stand-in for the simulator)
+            self.rivian_host = data.get('rivian-host', 'https://rivian.com')
+            # Optional: keep the vehicle state current through Rivian's websocket subscription instead of polling it
+            # (needs the websockets package)
+            self.rivian_vehicle_subscription = data.get('rivian-vehicle-subscription', False)
+            self.rivian_subscription_url = data.get('rivian-subscription-url',
+                                                    'wss://api.rivian.com/gql-consumer-subscriptions/graphql')
+            # Optional: serve Prometheus metrics on this port (disabled by default)
+            self.metrics_port = data.get('metrics-port')
+            # Optional: request timeouts (seconds) and how many times failed reads are retried
+            self.connect_timeout = data.get('connect-timeout', 5)
+            self.read_timeout = data.get('read-timeout', 30)
+            self.request_retries = data.get('request-retries', 2)
+            # Consecutive failures that make the automation skip a service, and for how long (seconds)
+            self.circuit_breaker_threshold = data.get('circuit-breaker-threshold', 5)
+            self.circuit_breaker_reset = data.get('circuit-breaker-reset', 60)
+            # Longest an automation cycle may take, and the time allowed to then leave the schedule in a safe state
+            self.cycle_deadline = data.get('cycle-deadline', 2 * 60)
+            self.safe_state_timeout = data.get('safe-state-timeout', 20)
+            # Optional: keep every Enphase reading (and 1m / 15m / daily rollups) in this directory
+            self.timeseries_dir = data.get('timeseries-dir')
+            self.timeseries_raw_retention_days = data.get('timeseries-raw-retention-days', 31)
+            # Optional: write spans of each cycle's service calls and decisions to this file (Chrome trace format),
+            # rotated at trace-max-bytes, keeping trace-backup-count old files
+            self.trace_file = data.get('trace-file')
+            self.trace_max_bytes = data.get('trace-max-bytes', 5 * 1024 * 1024)
+            self.trace_backup_count = data.get('trace-backup-count', 3)
+            # Optional: amp controller, one of: reactive, predictive
+            self.controller = data.get('controller', 'reactive')
+            # Predictive controller: how far ahead to extrapolate and how much history to fit the trend on (seconds)
+            self.controller_horizon = data.get('controller-horizon', 5 * 60)
+            self.controller_trend_window = data.get('controller-trend-window', 10 * 60)
+            # Hour of the day solar production peaks
+            self.solar_noon = data.get('solar-noon', 13)
+            # Optional: adjust the amps to what the EV actually draws (Rivian live charging data, or the Enphase
+            # consumption step after a schedule change) instead of the amps set
+            self.measure_ev_draw = data.get('measure-ev-draw', True)
+            # Optional: how to split the solar surplus between vehicles, one of: priority, soc-deficit
+            self.vehicle_allocation = data.get('vehicle-allocation', 'priority')
+            # Vehicle IDs in priority order (vehicles not listed come after, in the account's order)
+            self.vehicle_priority = data.get('vehicle-priority', [])
+            # Optional: charging amps range of the charger, its voltage (to turn watts into amps), and the night
+            # charging limit (%) used without Hubitat
+            self.amps_min = data.get('amps-min', 8)
+            self.amps_max = data.get('amps-max', 48)
+            self.charger_voltage = data.get('charger-voltage', 240)
+            self.night_charging_limit_default = data.get('night-charging-limit-default', 50)
+            # Optional: usable battery capacity of the vehicles (kWh), to project when night charging reaches the
+            # limit, and how long before that projection the automation checks again (seconds)
+            self.vehicle_battery_capacity = data.get('vehicle-battery-capacity', 135)
+            self.night_planner_margin = data.get('night-planner-margin', 10 * 60)
+        self.validate()
+
+    def validate(self):
+        # Raises ValueError on a setting the automation can't run with
+        config_file = self.config_file
+        check_number(config_file, 'night-time-start', self.night_time_start, positive=False)
+        check_number(config_file, 'night-time-end', self.night_time_end, positive=False)
+        for key in ('enphase-sample-interval', 'enphase-sample-window', 'enphase-sample-buffer',
+                    'enphase-production-interval', 'grid-spread-window', 'iteration-time', 'fast-iteration-time',
+                    'stable-iteration-time', 'idle-iteration-time', 'connect-timeout', 'read-timeout',
+                    'circuit-breaker-threshold', 'circuit-breaker-reset', 'cycle-deadline', 'safe-state-timeout',
+                    'timeseries-raw-retention-days', 'controller-horizon', 'controller-trend-window', 'amps-min',
+                    'amps-max', 'charger-voltage', 'vehicle-battery-capacity', 'trace-max-bytes'):
+            check_number(config_file, key, getattr(self, key.replace('-', '_')))
+        for key in ('min-schedule-write-gap', 'grid-spread-threshold', 'large-delta-amp', 'rivian-schedule-max-age',
+                    'request-retries', 'solar-noon', 'night-charging-limit-default', 'night-planner-margin',
+                    'trace-backup-count'):
+            check_number(config_file, key, getattr(self, key.replace('-', '_')), positive=False)
+        check_choice(config_file, 'enphase-sampling-profile', self.enphase_sampling_profile, ENPHASE_SAMPLING_PROFILES)
+        check_choice(config_file, 'grid-consumption-statistic', self.grid_consumption_statistic,
+                     GRID_CONSUMPTION_STATISTICS)
+        check_choice(config_file, 'controller', self.controller, CONTROLLERS)
+        check_choice(config_file, 'vehicle-allocation', self.vehicle_allocation, VEHICLE_ALLOCATIONS)
+        check_number(config_file, 'amps-max', self.amps_max, self.amps_min, positive=False)
+
+    def enphase_credentials(self):
+        # What the Enphase client logs in with
+        return {
+            'enphase-token': self.enphase_token,
+            'enphase-user': self.enphase_user,
+            'enphase-pass': self.enphase_pass,
+            'enphase-gateway-sn': self.enphase_gateway_sn,
+            'enphase-gateway-host': self.enphase_gateway_host,
+        }
+
+    def rivian_settings(self):
+        # What the Rivian client is created with (changing any of them needs a new client)
+        return (self.rivian_user, self.rivian_pass, self.rivian_host, self.rivian_persisted_queries,
+                self.vehicle_allocation, self.rivian_vehicle_subscription, self.rivian_subscription_url)
+
+
+class HubitatConfig:
+    def __init__(self, config_file):
+        self.config_file = config_file
+        with open(config_file) as f:
+            data = json.load(f)
+            self.host = data['host']
+            self.api_id = data['api-id']
+            self.token = data['token']
+            self.on_switch_id = data['automation-on-switch-id']
+            self.night_charge_switch_id = data['night-charge-switch-id']
+            self.info_device_id = data['info-device-id']
+            # Optional: how long device attributes read from the hub are reused (seconds)
+            self.cache_ttl = data.get('cache-ttl', 60)
+            # Optional: how often an unchanged info message is re-sent just to refresh its "Last update" time
+            self.info_refresh_interval = data.get('info-refresh-interval', 30 * 60)
+            # Optional: port to receive the Maker API device events on (disabled by default), and how often the
+            # device attributes are still read from the hub while events arrive (in case one was missed)
+            self.event_port = data.get('event-port')
+            self.event_resync_interval = data.get('event-resync-interval', 60 * 60)
+        check_number(config_file, 'cache-ttl', self.cache_ttl, positive=False)
+        check_number(config_file, 'info-refresh-interval', self.info_refresh_interval, positive=False)
+        check_number(config_file, 'event-resync-interval', self.event_resync_interval)
+
+
+def get_mtime(path):
+    # Modification time of a file, None if it can't be read
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ConfigFiles:
+    """
+    The config files, loaded once and then only when their modification time changes.
+
+    A file that fails to load or validate on start-up raises; a bad edit later on is logged and the previous settings
+    are kept until the file is fixed.
+    """
+
+    def __init__(self, config_file='config.json', hubitat_config_file=None):
+        self.config_file = config_file
+        self.hubitat_config_file = hubitat_config_file
+        self.config_mtime = get_mtime(config_file)
+        self.config = Config(config_file)
+        self.hubitat_mtime = None
+        self.hubitat = None
+        if hubitat_config_file:
+            self.hubitat_mtime = get_mtime(hubitat_config_file)
+            self.hubitat = HubitatConfig(hubitat_config_file)
+
+    def load(self, loader, path, mtime):
+        # The file's settings, None if it didn't change or can't be used
+        if mtime is None:
+            logger.error('Cannot read {}, keeping the current settings'.format(path))
+            return None
+        try:
+            settings = loader(path)
+        except (OSError, KeyError, ValueError) as e:
+            logger.error('Invalid {}, keeping the current settings: {!r}'.format(path, e))
+            return None
+        logger.info('Reloaded {}'.format(path))
+        return settings
+
+    def reload(self):
+        # Reads the files that changed since they were loaded. Returns True if any settings changed
+        changed = False
+        mtime = get_mtime(self.config_file)
+        if mtime != self.config_mtime:
+            self.config_mtime = mtime
+            config = self.load(Config, self.config_file, mtime)
+            if config is not None:
+                self.config = config
+                changed = True
+        if self.hubitat_config_file:
+            mtime = get_mtime(self.hubitat_config_file)
+            if mtime != self.hubitat_mtime:
+                self.hubitat_mtime = mtime
+                hubitat = self.load(HubitatConfig, self.hubitat_config_file, mtime)
+                if hubitat is not None:
+                    self.hubitat = hubitat
+                    changed = True
+        return changed
@@ -1,17 +1,85 @@
 # Enphase utils
 
+import asyncio
 import logging
-import json
 import os.path
-import time
+import threading
 
-from enphase_api.cloud.authentication import Authentication
+import requests
 from enphase_api.local.gateway import Gateway
+import Clock
+import Metrics
+import Resilience
+import Tracing
+from TokenStore import TokenStore
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TOKEN_FILE = 'enphase-token.json'
+# The library's gateway host when enphase-gateway-host isn't set (mDNS)
+DEFAULT_GATEWAY_HOST = 'https://envoy.local'
+# Get a new token a day before the current one expires
+TOKEN_EXPIRY_MARGIN = 24 * 60 * 60
 
-def get_secure_gateway_session(credentials):
+
+def get_token_expiry(token, gateway_serial_number=None):
+    """
+    Decodes the expiry of a gateway token.
+
+    Returns:
+        int: Expiry time (epoch seconds), or None if the token is not valid for the gateway.
+    """
+    # Only needed when a token wasn't validated before (jwt and its crypto backends are slow to import)
+    import jwt
+    from enphase_api.cloud.authentication import Authentication
+
+    if not Authentication.check_token_valid(token=token, gateway_serial_number=gateway_serial_number):
+        return None
+    return jwt.decode(token, options={'verify_signature': False})['exp']
+
+
+def get_valid_token(credentials, token_store):
+    """
+    Picks a token that hasn't expired: the one in config.json, or else the one refreshed earlier.
+
+    The expiry of each token is only decoded once, it is kept in the token store with the token (the config.json
+    token's too, so a refreshed token doesn't make every client decode it again). The store's token and gateway
+    session are only replaced when the token picked is a different one.
+
+    Returns:
+        str: The token, or None if neither is valid.
+    """
+    gateway_serial_number = credentials.get('enphase-gateway-sn')
+    config_token = credentials.get('enphase-token')
+    stored_token = token_store.get('token')
+    for token in (config_token, stored_token):
+        if not token:
+            continue
+        if token == stored_token and token_store.get('expiresAt') is not None:
+            expires_at = token_store.get('expiresAt')
+        elif token == token_store.get('configToken'):
+            expires_at = token_store.get('configExpiresAt')
+        else:
+            # 0: not valid for the gateway, not decoded again
+            expires_at = get_token_expiry(token, gateway_serial_number) or 0
+            if token == stored_token:
+                token_store.update(expiresAt=expires_at)
+            else:
+                token_store.update(configToken=token, configExpiresAt=expires_at)
+        if Clock.time_now() < expires_at - TOKEN_EXPIRY_MARGIN:
+            if token != stored_token:
+                # A different token: the stored gateway session belongs to the previous one
+                token_store.update(token=token, expiresAt=expires_at, cookies={})
+            return token
+    return None
+
+
+def save_gateway_session(gateway, token_store):
+    # Keep the gateway's session cookie, so the next client can skip the login
+    token_store.update(cookies=requests.utils.dict_from_cookiejar(gateway.session.cookies))
+
+
+def get_secure_gateway_session(credentials, policy=None, token_store=None):
     """
     Establishes a secure session with the Enphase® IQ Gateway API.
 
@@ -23,8 +91,13 @@ def get_secure_gateway_session(credentials):
 
     It also downloads and stores the certificate from the gateway for secure communication.
 
+    Tokens are validated once: an acquired token and its expiry are saved to the token store (config.json is not
+    modified). The gateway session cookie is saved there too, and reused until the gateway rejects it.
+
     Args:
         credentials (dict): A dictionary containing the required credentials.
+        policy (Resilience.Policy): Timeouts, retries and circuit breaker of the gateway requests.
+        token_store (TokenStore): Where refreshed tokens and the gateway session are kept.
 
     Returns:
         Gateway: An initialised Gateway API wrapper object for interacting with the gateway.
@@ -32,20 +105,17 @@ def get_secure_gateway_session(credentials):
     Raises:
         ValueError: If authentication fails or if required credentials are missing.
     """
+    token_store = token_store or TokenStore(DEFAULT_TOKEN_FILE)
 
     # Do we have a valid JSON Web Token (JWT) to be able to use the service?
-    if not (credentials.get('enphase-token')
-                and Authentication.check_token_valid(
-                    token=credentials['enphase-token'],
-                    gateway_serial_number=credentials.get('enphase-gateway-sn'))):
-        # It is not valid so clear it.
-        credentials['enphase-token'] = None
+    token = get_valid_token(credentials, token_store)
 
     # Do we still not have a Token?
-    if not credentials.get('enphase-token'):
+    if not token:
         # Do we have a way to obtain a token?
         if credentials.get('enphase-user') and credentials.get('enphase-pass'):
             # Create a Authentication object.
+            from enphase_api.cloud.authentication import Authentication
             authentication = Authentication()
 
             # Authenticate with Entrez (French for "Access").
@@ -57,51 +127,176 @@ def get_secure_gateway_session(credentials):
             # Does the user want to target a specific gateway or all uncommissioned ones?
             if credentials.get('enphase-gateway-sn'):
                 # Get a new gateway specific token (installer = short-life, owner = long-life).
-                credentials['enphase-token'] = authentication.get_token_for_commissioned_gateway(
+                token = authentication.get_token_for_commissioned_gateway(
                     gateway_serial_number=credentials['enphase-gateway-sn']
                 )
             else:
                 # Get a new uncommissioned gateway specific token.
-                credentials['enphase-token'] = authentication.get_token_for_uncommissioned_gateway()
+                token = authentication.get_token_for_uncommissioned_gateway()
 
-            # Update the file to include the modified token.
-            with open('config.json', mode='w', encoding='utf-8') as json_file:
-                json.dump(credentials, json_file, indent=4)
+            # Store the new token (and its expiry) for the next sessions.
+            expires_at = get_token_expiry(token, credentials.get('enphase-gateway-sn'))
+            if expires_at is None:
+                raise ValueError('Enphase® Authentication server ("Entrez") returned an invalid token')
+            token_store.update(token=token, expiresAt=expires_at, cookies={})
         else:
             # Let the user know why the program is exiting.
             raise ValueError('Unable to login to the gateway (bad, expired or missing token in config.json).')
 
+    credentials['enphase-token'] = token
+
     # Did the user override the library default hostname to the Gateway?
-    host = credentials.get('enphase-gateway-host')
+    host = credentials.get('enphase-gateway-host') or DEFAULT_GATEWAY_HOST
 
-    # Download and store the certificate from the gateway so all future requests are secure.
-    if not os.path.exists('gateway.cer'):
+    # Download and store the certificate from the gateway so all future requests are secure (not over plain http,
+    # e.g. the simulator's stand-in gateway).
+    if host.startswith('https://') and not os.path.exists(Gateway.DEFAULT_CERT_FILE):
         Gateway.trust_gateway(host)
 
-    # Instantiate the Gateway API wrapper (with the default library hostname if None provided).
+    # Instantiate the Gateway API wrapper.
     gateway = Gateway(host)
+    Metrics.instrument_session(gateway.session, 'enphase')
+    # Replaces the library's 5 minute timeout, the login included
+    Resilience.protect_session(gateway.session, 'enphase', policy)
+
+    # Reuse the session of a previous login with this token (if the gateway rejects it, the caller logs in again).
+    if token_store.get('cookies'):
+        gateway.session.cookies.update(token_store.get('cookies'))
+        return gateway
 
     # Are we not able to login to the gateway?
-    if not gateway.login(credentials['enphase-token']):
+    if not gateway.login(token):
         # Let the user know why the program is exiting.
         raise ValueError('Unable to login to the gateway (bad, expired or missing token in config.json).')
+    save_gateway_session(gateway, token_store)
 
     # Return the initialised gateway object.
     return gateway
 
 
+class LiveStreamLease:
+    """
+    Keeps the gateway's live data streaming.
+
+    The gateway stops refreshing /ivp/livedata/status some time after the stream was enabled. Instead of enabling the
+    stream for every reading (and disabling it after), the lease only re-enables it shortly before it would stop, or
+    when the live data stopped updating anyway (e.g. the gateway restarted or the stream was disabled by someone else).
+    """
+    # The gateway stops streaming this long after the stream was enabled
+    DURATION = 10 * 60
+
+    def __init__(self, enphase, renew_margin=60):
+        self.enphase = enphase
+        self.renew_margin = renew_margin
+        self.enabled_at = None
+        self.last_update = None
+        self.lock = threading.Lock()
+
+    def is_active(self):
+        return self.enabled_at is not None and Clock.time_now() - self.enabled_at < self.DURATION - self.renew_margin
+
+    def renew(self):
+        with self.lock:
+            if not self.is_active():
+                logger.debug('Enabling the Enphase live data stream')
+                self.enphase.live_stats_enable()
+                self.enabled_at = Clock.time_now()
+                self.last_update = None
+
+    def check(self, stats):
+        # Live data that didn't change since the last reading means the gateway isn't streaming
+        with self.lock:
+            if self.last_update is not None and stats['reading_time'] == self.last_update:
+                logger.info('Enphase live data stopped updating, enabling the stream again on the next reading')
+                self.enabled_at = None
+            self.last_update = stats['reading_time']
+
+    def get_state(self):
+        # Survives a restart: the gateway keeps streaming for the rest of the lease
+        return {'enabledAt': self.enabled_at, 'lastUpdate': self.last_update}
+
+    def restore_state(self, state):
+        with self.lock:
+            self.enabled_at = state.get('enabledAt')
+            self.last_update = state.get('lastUpdate')
+
+    def release(self):
+        with self.lock:
+            if self.enabled_at is not None:
+                self.enphase.live_stats_disable()
+                self.enabled_at = None
+
+
 class EnphaseAPI:
-    def __init__(self, credentials_file):
-        self.credentials_file = credentials_file
+    # Sampling profiles: which endpoints each sample reads
+    # - lean: live data only, /production.json (much heavier for the gateway) every production_interval seconds
+    # - full: live data and /production.json on every sample
+    PROFILES = ['lean', 'full']
+
+    def __init__(self, credentials, store=None, profile='lean', production_interval=15 * 60, policy=None,
+                 token_file=DEFAULT_TOKEN_FILE, num_readings=5, reading_interval=10):
+        if profile not in self.PROFILES:
+            raise ValueError('Unknown Enphase sampling profile: {}'.format(profile))
+        # enphase-* settings of config.json (see Config.enphase_credentials)
+        self.config_credentials = credentials
+        self.credentials = None
+        # Optional TimeSeriesStore keeping every live data reading (production.json is a different meter reading)
+        self.store = store
+        self.profile = profile
+        self.production_interval = production_interval
+        self.production_read_at = None
+        # Readings and seconds between them of get_median_grid_consumption (without the background sampler)
+        self.num_readings = num_readings
+        self.reading_interval = reading_interval
+        self.policy = policy
+        # Refreshed token, its expiry and the gateway session cookie
+        self.token_store = TokenStore(token_file)
+        # Serializes re-login when the sampler and the cycle find the session expired at the same time
+        self.login_lock = threading.Lock()
+        self.logins = 0
+        self.stream = LiveStreamLease(self)
         self.gateway = self.enphase_gateway()
 
     def enphase_gateway(self):
-        with open(self.credentials_file, 'r') as f:
-            credentials = json.load(f)
-        return get_secure_gateway_session(credentials)
+        # The login picks the token to use, starting over from the configured one
+        self.credentials = dict(self.config_credentials)
+        return get_secure_gateway_session(self.credentials, self.policy, self.token_store)
+
+    def is_token_valid(self):
+        # Expiry decoded when the token was stored, no need to decode the token again
+        return Clock.time_now() < self.token_store.get('expiresAt', 0) - TOKEN_EXPIRY_MARGIN
+
+    @Tracing.traced('enphase')
+    def login(self):
+        logger.info('Enphase gateway session expired, logging in again')
+        self.logins += 1
+        # Forget the rejected session, the login sets a new cookie
+        self.gateway.session.cookies.clear()
+        self.token_store.update(cookies={})
+        if self.is_token_valid() and self.gateway.login(self.credentials['enphase-token']):
+            save_gateway_session(self.gateway, self.token_store)
+        else:
+            # Token expired or rejected: pick a valid token again, or get a new one
+            self.gateway = self.enphase_gateway()
 
+    def api_call(self, path, **kwargs):
+        # The gateway keeps the session cookie on its keep-alive connection, and the token store across restarts.
+        # Only login again when the gateway rejects it (session expires after 10 minutes of inactivity).
+        logins = self.logins
+        try:
+            return self.gateway.api_call(path, **kwargs)
+        except ValueError:
+            with self.login_lock:
+                # Another request may have logged in again already
+                if self.logins == logins:
+                    self.login()
+            return self.gateway.api_call(path, **kwargs)
+
+    @Tracing.traced('enphase')
     def read_stats(self):
-        production_statistics = self.gateway.api_call('/production.json')
+        production_statistics = self.api_call('/production.json')
+        if not production_statistics:
+            raise Resilience.ServiceUnavailable('No Enphase production statistics available')
         production = total_consumption = net_consumption = reading_time = 0
         for record in production_statistics['production']:
             if record['type'] == 'eim' and record['measurementType'] == 'production':
@@ -113,55 +308,114 @@ class EnphaseAPI:
             if record['type'] == 'eim' and record['measurementType'] == 'net-consumption':
                 net_consumption = record['wNow']
         battery = production_statistics['storage'][0]['wNow']
-        return {
+        stats = {
             'reading_time': reading_time,
             'production': production,
             'total_consumption': total_consumption,
             'net_consumption': net_consumption,
             'battery': battery
         }
+        return stats
 
     def live_stats_enable(self):
-        self.gateway.api_call('/ivp/livedata/stream', method='POST', json={"enable": 1})
+        self.api_call('/ivp/livedata/stream', method='POST', json={"enable": 1})
 
     def live_stats_disable(self):
-        self.gateway.api_call('/ivp/livedata/stream', method='POST', json={"enable": 0})
+        self.api_call('/ivp/livedata/stream', method='POST', json={"enable": 0})
 
+    @Tracing.traced('enphase')
     def read_live_stats(self):
-        livedata = self.gateway.api_call('/ivp/livedata/status')
+        livedata = self.api_call('/ivp/livedata/status')
+        if not livedata:
+            # The library returns nothing for an error status (e.g. 503 after the retries)
+            raise Resilience.ServiceUnavailable('No Enphase live data available')
         production = livedata['meters']['pv']['agg_p_mw'] / 1000
         consumption = livedata['meters']['load']['agg_p_mw'] / 1000
         grid = livedata['meters']['grid']['agg_p_mw'] / 1000
         battery = livedata['meters']['storage']['agg_p_mw'] / 1000
         reading_time = livedata['meters']['last_update']
-        return {
+        Metrics.SOLAR_WATTS.set(production)
+        Metrics.GRID_WATTS.set(grid)
+        Metrics.BATTERY_WATTS.set(battery)
+        stats = {
             'reading_time': reading_time,
             'production': production,
             'consumption': consumption,
             'grid': grid,
             'battery': battery
         }
+        if self.store:
+            self.store.append_stats(stats)
+        return stats
+
+    def is_production_due(self):
+        if self.profile == 'full':
+            return True
+        if not self.production_interval:
+            return False
+        return self.production_read_at is None or Clock.time_now() - self.production_read_at >= self.production_interval
+
+    @Tracing.traced('enphase')
+    def read_sample(self):
+        # Live stats drive the decisions, production.json is only read as often as the sampling profile asks
+        # Enable live stats MQTT streaming (when due), otherwise the values will stop updating after 10 minutes
+        self.stream.renew()
+        stats = self.read_live_stats()
+        self.stream.check(stats)
+        logger.debug('Live Stats: {}'.format(stats))
+        if self.is_production_due():
+            self.production_read_at = Clock.time_now()
+            logger.debug('Prod Stats: {}'.format(self.read_stats()))
+        return stats
+
+    def get_state(self):
+        # What a one-shot run (main.py --once) passes on to the next one, see restore_state
+        return {'stream': self.stream.get_state(), 'productionReadAt': self.production_read_at}
+
+    def restore_state(self, state):
+        # Don't enable the stream or read production.json again while the previous run's are recent enough
+        self.stream.restore_state(state.get('stream') or {})
+        self.production_read_at = state.get('productionReadAt')
+
+    def close(self, keep_stream=False):
+        # Stop the live stats streaming (unless the next run picks up the lease)
+        if not keep_stream:
+            self.stream.release()
 
+    @Tracing.traced('enphase')
     def get_median_grid_consumption(self, include_battery_usage=True):
         logger.info('Getting median consumption from Enphase')
-        # Read 5 times with 10 secs in between. Take the median
-        num_readings = 5
+        # Read a few times with some seconds in between. Take the median
+        num_readings = self.num_readings
         grid_readings = []
-        # Enable live stats MQTT streaming, otherwise the values will stop updating after 10 minutes
-        self.live_stats_enable()
         for i in range(num_readings):
             logger.info('Reading consumption from Enphase {} / {}'.format(i + 1, num_readings))
             # Sleep before the read to allow data to accumulate
-            time.sleep(10)
-            stats = self.read_live_stats()
+            Clock.sleep(self.reading_interval)
+            stats = self.read_sample()
             logger.info('Live Stats: {}'.format(stats))
-            stats_2 = self.read_stats()
-            logger.info('Prod Stats: {}'.format(stats_2))
             consumption = stats['grid']
             # Only include battery usage, but ignore battery charging (i.e. let it charge)
             if include_battery_usage and stats['battery'] > 0:
                 consumption += stats['battery']
             grid_readings.append(consumption)
-        # Disable live stats MQTT streaming
-        self.live_stats_disable()
         return sorted(grid_readings)[num_readings // 2]  # median
+
+
+class AsyncEnphaseAPI:
+    # Async variant of EnphaseAPI: runs the blocking calls of a shared client in worker threads
+    def __init__(self, enphase):
+        self.enphase = enphase
+
+    @classmethod
+    async def create(cls, credentials, **kwargs):
+        return cls(await asyncio.to_thread(EnphaseAPI, credentials, **kwargs))
+
+    async def read_stats(self):
+        return await asyncio.to_thread(self.enphase.read_stats)
+
+    async def read_live_stats(self):
+        return await asyncio.to_thread(self.enphase.read_live_stats)
+
+    async def get_median_grid_consumption(self, include_battery_usage=True):
+        return await asyncio.to_thread(self.enphase.get_median_grid_consumption, include_battery_usage)
@@ -0,0 +1,158 @@
+# Background Enphase sampler
+
+import logging
+import statistics
+import threading
+from collections import deque, namedtuple
+import Clock
+import Resilience
+
+logger = logging.getLogger(__name__)
+
+Sample = namedtuple('Sample', ['time', 'production', 'consumption', 'grid', 'battery'])
+
+STATISTICS = ['median', 'mean', 'trimmed-mean']
+
+
+def trimmed_mean(values, proportion=0.2):
+    # Drop the given proportion of the lowest and the highest values, average the rest
+    values = sorted(values)
+    cut = int(len(values) * proportion)
+    if cut and len(values) > 2 * cut:
+        values = values[cut:-cut]
+    return statistics.fmean(values)
+
+
+def reduce_readings(values, statistic='median'):
+    if statistic == 'median':
+        return statistics.median(values)
+    if statistic == 'mean':
+        return statistics.fmean(values)
+    if statistic == 'trimmed-mean':
+        return trimmed_mean(values)
+    raise ValueError('Unknown statistic: {}'.format(statistic))
+
+
+class EnphaseSampler:
+    def __init__(self, enphase, interval=10, buffer_size=360):
+        self.enphase = enphase
+        self.interval = interval
+        # Ring buffer of the most recent readings (oldest are dropped automatically)
+        self.samples = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.new_sample = threading.Event()
+        self.task = None
+
+    def start(self):
+        # Background thread (or simulated timer) polling the gateway
+        logger.info('Enphase sampler started: reading every {} seconds'.format(self.interval))
+        self.task = Clock.start_periodic('EnphaseSampler', self.interval, self.sample)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.stop()
+            self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    def pause(self):
+        # Stops polling until resume() (the readings in the buffer age out of the windows meanwhile)
+        if self.task is not None:
+            logger.info('Enphase sampler paused')
+            self.stop()
+
+    def resume(self):
+        if self.task is None:
+            self.start()
+
+    def sample(self):
+        now = Clock.time_now()
+        # Renews the live data stream lease when due
+        try:
+            stats = self.enphase.read_sample()
+        except Resilience.CircuitOpenError:
+            # The gateway is down, already reported when the circuit opened
+            return
+        except Resilience.ServiceUnavailable as e:
+            logger.warning('Enphase reading failed: {}'.format(e))
+            return
+        sample = Sample(now, stats['production'], stats['consumption'], stats['grid'], stats['battery'])
+        with self.lock:
+            self.samples.append(sample)
+        self.new_sample.set()
+
+    def get_samples(self, window):
+        # Readings taken within the last `window` seconds, oldest first
+        since = Clock.time_now() - window
+        with self.lock:
+            return [sample for sample in self.samples if sample.time >= since]
+
+    def wait_for_samples(self, count, window, timeout):
+        # Block until the window holds at least `count` readings (e.g. right after start-up)
+        deadline = Clock.time_now() + timeout
+        while True:
+            self.new_sample.clear()
+            available = len(self.get_samples(window))
+            remaining = deadline - Clock.time_now()
+            if available >= count or remaining <= 0:
+                return available
+            Clock.wait(self.new_sample, remaining)
+
+    def get_grid_readings(self, window, include_battery_usage=True):
+        readings = []
+        for sample in self.get_samples(window):
+            consumption = sample.grid
+            # Only include battery usage, but ignore battery charging (i.e. let it charge)
+            if include_battery_usage and sample.battery > 0:
+                consumption += sample.battery
+            readings.append(consumption)
+        return readings
+
+    def get_grid_consumption(self, window, statistic='median', include_battery_usage=True):
+        readings = self.get_grid_readings(window, include_battery_usage)
+        if not readings:
+            return None
+        return reduce_readings(readings, statistic)
+
+    def get_grid_spread(self, window, include_battery_usage=True):
+        readings = self.get_grid_readings(window, include_battery_usage)
+        if len(readings) < 2:
+            return None
+        return statistics.pstdev(readings)
+
+    def get_consumption(self, window, statistic='median'):
+        # Total home consumption (house and EV) over the window
+        readings = [sample.consumption for sample in self.get_samples(window)]
+        if not readings:
+            return None
+        return reduce_readings(readings, statistic)
+
+    def get_production_trend(self, window):
+        # Least squares slope of the solar production over the window (W per second),
+        # and how well a straight line fits the readings (R squared, 0 to 1)
+        samples = self.get_samples(window)
+        if len(samples) < 3 or samples[-1].time - samples[0].time < window / 2:
+            return None, 0
+        times = [sample.time - samples[0].time for sample in samples]
+        production = [sample.production for sample in samples]
+        slope, intercept = statistics.linear_regression(times, production)
+        variance = statistics.pvariance(production)
+        if not variance:
+            return slope, 1
+        residuals = statistics.fmean((p - (slope * t + intercept)) ** 2 for t, p in zip(times, production))
+        return slope, max(0, 1 - residuals / variance)
+
+    def get_latest_production(self):
+        with self.lock:
+            return self.samples[-1].production if self.samples else None
+
+    def get_median_grid_consumption(self, window, include_battery_usage=True):
+        return self.get_grid_consumption(window, 'median', include_battery_usage)
+
+    def get_mean_grid_consumption(self, window, include_battery_usage=True):
+        return self.get_grid_consumption(window, 'mean', include_battery_usage)
+
+    def get_trimmed_mean_grid_consumption(self, window, include_battery_usage=True):
+        return self.get_grid_consumption(window, 'trimmed-mean', include_battery_usage)
@@ -0,0 +1,67 @@
+# Estimate of the amps the EV actually draws
+
+import logging
+import Clock
+
+logger = logging.getLogger(__name__)
+
+VOLTS = 240
+
+
+class EvDrawEstimator:
+    """
+    Estimates the amps the EV actually draws, which can be less than the amps of its charging schedule: the charger
+    may be derated, still ramping up after a schedule change, or tapering off close to the battery limit.
+
+    The Rivian live charging session reports the power the car draws. When it's not available, the draw is estimated
+    from the step of the Enphase consumption readings across the last schedule change (the house load rarely changes
+    at the same moment). A step can't show later changes of the draw, so that estimate only lasts until the next one.
+    The live session is only asked again after a schedule change, or once the last answer is MEASUREMENT_MAX_AGE old
+    (the draw also drops when the charger derates or the battery is nearly full).
+    """
+    # Seconds of consumption readings compared before and after a schedule change
+    STEP_WINDOW = 60
+    # Seconds the charger takes to follow a schedule change
+    SETTLE_TIME = 60
+    # Seconds a live session measurement is reused while the schedule doesn't change
+    MEASUREMENT_MAX_AGE = 15 * 60
+
+    def __init__(self, volts=VOLTS):
+        self.volts = volts
+        # (time, amps drawn before, amps set, consumption before) of the last schedule change
+        self.change = None
+        self.step_amp = None
+        # (time, amps) of the last live session measurement
+        self.measurement = None
+
+    def record_change(self, sampler, draw_amp, new_amp):
+        # Called right after a schedule write, before the charger follows it
+        self.step_amp = None
+        self.change = None
+        self.measurement = None
+        consumption = sampler.get_consumption(self.STEP_WINDOW) if sampler else None
+        if consumption is not None:
+            self.change = (Clock.time_now(), draw_amp, new_amp, consumption)
+
+    def get_step_amp(self, sampler):
+        if self.change is not None and sampler:
+            time, draw_amp, new_amp, before = self.change
+            settled = Clock.time_now() - time - self.SETTLE_TIME
+            after = sampler.get_consumption(min(settled, self.STEP_WINDOW)) if settled >= self.STEP_WINDOW / 2 else None
+            if after is not None:
+                self.step_amp = max(0, min(new_amp, draw_amp + (after - before) / self.volts))
+                self.change = None
+                logger.info('EV draw after the last schedule change: {}A of {}A'.format(round(self.step_amp, 1),
+                                                                                         new_amp))
+        return self.step_amp
+
+    def estimate(self, vehicle, sampler):
+        # Amps drawn by the EV, None when unknown
+        now = Clock.time_now()
+        if self.measurement is not None and now - self.measurement[0] < self.MEASUREMENT_MAX_AGE:
+            return self.measurement[1]
+        power = vehicle.get_charging_power()
+        if power is not None:
+            self.measurement = (now, power / self.volts)
+            return self.measurement[1]
+        return self.get_step_amp(sampler)
@@ -0,0 +1,98 @@
+# Minimal GraphQL query builder
+
+import hashlib
+import json
+
+# Names of the declared queries: unlike mutations, they are safe to retry
+QUERY_NAMES = set()
+
+
+def timestamped(*names):
+    # Vehicle state values are reported as { timeStamp value } objects
+    return {name: ['timeStamp', 'value'] for name in names}
+
+
+def selection_set(fields):
+    """
+    Renders a selection set from the fields a caller needs.
+
+    Fields are a list of names and/or dicts of {name: sub-fields}, e.g.
+    ['id', {'location': ['latitude', 'longitude']}] -> '{ id location { latitude longitude } }'
+    """
+    if isinstance(fields, dict):
+        fields = [fields]
+    parts = []
+    for field in fields:
+        if isinstance(field, dict):
+            for name, sub_fields in field.items():
+                parts.append('{} {}'.format(name, selection_set(sub_fields)))
+        else:
+            parts.append(field)
+    return '{{ {} }}'.format(' '.join(parts))
+
+
+class Operation:
+    """
+    A named GraphQL query or mutation built from the declared fields only.
+
+    Supports Apollo automatic persisted queries: the query text is identified by its SHA-256 hash, so once the server
+    has seen it, requests only need to carry the hash.
+    """
+
+    def __init__(self, kind, name, root, fields, variables=None, persist=True):
+        # variables: {name: GraphQL type}; root: top-level field with its arguments, e.g. 'vehicleState(id: $vehicleID)'
+        self.name = name
+        # Whether to send it as a persisted query (not worth it for one-off operations, e.g. logging in)
+        self.persist = persist
+        variables = variables or {}
+        declaration = ''
+        if variables:
+            declaration = '({})'.format(', '.join('${}: {}'.format(var, var_type) for var, var_type in variables.items()))
+        self.query = '{} {}{} {}'.format(kind, name, declaration, selection_set({root: fields}))
+        self.sha256 = hashlib.sha256(self.query.encode('utf-8')).hexdigest()
+
+    def request(self, variables=None, persisted=False, include_query=True):
+        request = {
+            "operationName": self.name,
+            "variables": variables or {},
+        }
+        if include_query:
+            request["query"] = self.query
+        if persisted:
+            request["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": self.sha256}}
+        return request
+
+
+def query(name, root, fields, variables=None):
+    QUERY_NAMES.add(name)
+    return Operation('query', name, root, fields, variables)
+
+
+def mutation(name, root, fields, variables=None, persist=True):
+    return Operation('mutation', name, root, fields, variables, persist)
+
+
+def subscription(name, root, fields, variables=None):
+    # Sent over a websocket instead of a POST request
+    return Operation('subscription', name, root, fields, variables)
+
+
+def is_query_request(request):
+    # requests.PreparedRequest of a GraphQL query (not a mutation)
+    try:
+        name = json.loads(request.body or b'{}').get('operationName')
+    except (ValueError, AttributeError):
+        return False
+    return name in QUERY_NAMES
+
+
+def persisted_query_error(data):
+    # Returns 'not-found' / 'not-supported' for Apollo persisted query errors, None otherwise
+    for error in (data or {}).get('errors') or []:
+        code = (error.get('extensions') or {}).get('code')
+        message = error.get('message')
+        if code == 'PERSISTED_QUERY_NOT_FOUND' or message == 'PersistedQueryNotFound':
+            return 'not-found'
+        if code == 'PERSISTED_QUERY_NOT_SUPPORTED' or message == 'PersistedQueryNotSupported':
+            return 'not-supported'
+    return None
@@ -1,44 +1,113 @@
 # Hubitat API
 
-import json
+import asyncio
 import logging
+import threading
 import requests
-from datetime import datetime
+import Clock
+import Metrics
+import Resilience
+import Tracing
 
 logger = logging.getLogger(__name__)
 
 
 class HubitatAPI:
     DEVICE_INFO_URL = '{}/apps/api/{}/devices/{}?access_token={}'
+    ALL_DEVICES_URL = '{}/apps/api/{}/devices/all?access_token={}'
     SET_VARIABLE_URL = '{}/apps/api/{}/devices/{}/setVariable/{}?access_token={}'
-
-    def __init__(self, config_file):
-        with open(config_file) as f:
-            data = json.load(f)
-            self.host = data['host']
-            self.api_id = data['api-id']
-            self.token = data['token']
-            self.on_switch_id = data['automation-on-switch-id']
-            self.night_charge_switch_id = data['night-charge-switch-id']
-            self.info_device_id = data['info-device-id']
-
-    def get_switch_attribute(self, device_id, attribute):
-        url = self.DEVICE_INFO_URL.format(self.host, self.api_id, device_id, self.token)
-
-        logger.info('Reading switch ({}) state from Hubitat'.format(device_id))
-        response = requests.get(url)
+    # Show up to 5 changes
+    MESSAGES_TO_SHOW = 5
+    COMPARE_CHARS = 15
+
+    def __init__(self, config, policy=None):
+        self.apply_config(config)
+        # Keep-alive connection to the hub reused across cycles
+        self.session = requests.Session()
+        Metrics.instrument_session(self.session, 'hubitat', Metrics.hubitat_endpoint)
+        Resilience.protect_session(self.session, 'hubitat', policy)
+        # Device ID -> {attribute: value} from the last bulk read
+        self.device_attributes = {}
+        self.device_attributes_time = None
+        self.cache_lock = threading.Lock()
+        # When the last device event pushed by the hub arrived (see HubitatEvents)
+        self.event_time = None
+        # Info messages shown on the dashboard, kept locally instead of reading them back from the hub
+        self.info_messages = None
+        self.published_info = None
+        self.published_info_time = None
+
+    def apply_config(self, config):
+        # HubitatConfig to use from now on (also after hubitat-config.json changed)
+        self.host = config.host
+        self.api_id = config.api_id
+        self.token = config.token
+        self.on_switch_id = config.on_switch_id
+        self.night_charge_switch_id = config.night_charge_switch_id
+        self.info_device_id = config.info_device_id
+        self.cache_ttl = config.cache_ttl
+        self.info_refresh_interval = config.info_refresh_interval
+        self.event_resync_interval = config.event_resync_interval
+
+    @staticmethod
+    def parse_attributes(attributes):
+        # /devices/all returns {name: value}, /devices/{id} returns [{name, currentValue}]
+        if isinstance(attributes, dict):
+            return dict(attributes)
+        return {attr['name']: attr['currentValue'] for attr in attributes}
+
+    @Tracing.traced('hubitat')
+    def load_devices(self):
+        # Read the attributes of all Maker API devices in one request
+        url = self.ALL_DEVICES_URL.format(self.host, self.api_id, self.token)
+
+        logger.info('Reading device states from Hubitat')
+        response = self.session.get(url)
 
         if response.status_code != 200:
             logger.error('Failed to make Hubitat request: {}'.format(response.text))
-            return
-
-        data = response.json()
-        value = None
-        for attr in data['attributes']:
-            if attr['name'] == attribute:
-                value = attr['currentValue']
+            return False
+
+        self.device_attributes = {str(device['id']): self.parse_attributes(device['attributes'])
+                                  for device in response.json()}
+        self.device_attributes_time = Clock.monotonic()
+        return True
+
+    def invalidate(self):
+        # Force the next read to go to the hub
+        with self.cache_lock:
+            self.device_attributes_time = None
+
+    def apply_event(self, device_id, name, value):
+        """
+        Updates the cached attributes with a device event pushed by the hub. Once the hub pushes events, the cache
+        stays valid until the next resync instead of the cache TTL.
+        Returns True if an automation switch (or the night charging limit) changed.
+        """
+        with self.cache_lock:
+            self.event_time = Clock.monotonic()
+            attributes = self.device_attributes.setdefault(str(device_id), {})
+            previous = attributes.get(name)
+            attributes[name] = value
+        switches = (str(self.on_switch_id), str(self.night_charge_switch_id))
+        return str(device_id) in switches and str(previous) != str(value)
+
+    @Tracing.traced('hubitat')
+    def get_device_attributes(self, device_id):
+        with self.cache_lock:
+            ttl = self.cache_ttl if self.event_time is None else self.event_resync_interval
+            expired = (self.device_attributes_time is None
+                       or Clock.monotonic() - self.device_attributes_time >= ttl)
+            if expired and not self.load_devices():
+                return None
+            return self.device_attributes.get(str(device_id))
 
-        return value
+    def get_switch_attribute(self, device_id, attribute):
+        attributes = self.get_device_attributes(device_id)
+        if attributes is None:
+            logger.error('Hubitat device {} not found'.format(device_id))
+            return None
+        return attributes.get(attribute)
 
     def get_switch_state(self, device_id):
         return self.get_switch_attribute(device_id, attribute='switch')
@@ -53,39 +122,82 @@ class HubitatAPI:
 
     def get_night_charging_limit(self):
         limit = self.get_switch_attribute(self.night_charge_switch_id, attribute='level')
-        return limit
+        return int(float(limit)) if limit is not None else None
 
+    @Tracing.traced('hubitat')
     def set_info_message(self, msg, amps, grid):
-        current_messages = self.get_switch_attribute(self.info_device_id, attribute='variable').split("\n")
+        if self.info_messages is None:
+            # Only read the messages back from the hub once, after start-up
+            current = self.get_switch_attribute(self.info_device_id, attribute='variable')
+            self.info_messages = current.split("\n") if current else []
 
-        time = datetime.now()
+        now = Clock.now()
         message = '{} -- Amps: {} -- Grid: {}W -- Last update: {}'.format(
             msg,
             amps,
             round(grid),
-            time.strftime("%Y-%m-%d %H:%M")
+            now.strftime("%Y-%m-%d %H:%M")
         )
 
-        # Show up to 5 changes
-        messages_to_show = 5
-        compare_chars = 15
-        if message[:compare_chars] == current_messages[-1][:compare_chars]:
+        current_messages = self.info_messages
+        if current_messages and message[:self.COMPARE_CHARS] == current_messages[-1][:self.COMPARE_CHARS]:
             # Same message, keep the latest
             current_messages[-1] = message
         else:
             # Message changed
             current_messages.append(message)
-        if len(current_messages) > messages_to_show:
+        if len(current_messages) > self.MESSAGES_TO_SHOW:
             current_messages.pop(0)
 
-        self.update_info_device_message("\n".join(current_messages))
+        text = "\n".join(current_messages)
+        # Don't resend the same information just to move the "Last update" time, unless it's getting old
+        content = text[:text.rfind(' -- Last update: ')]
+        if (self.published_info == content and self.published_info_time is not None
+                and Clock.monotonic() - self.published_info_time < self.info_refresh_interval):
+            logger.info('No change to the Hubitat info. Not updating')
+            return
+
+        if self.update_info_device_message(text):
+            self.published_info = content
+            self.published_info_time = Clock.monotonic()
+
+    def get_state(self):
+        # The info last published, so a one-shot run doesn't re-send it (monotonic time is per process)
+        if self.published_info_time is None:
+            return {}
+        return {'info': self.published_info,
+                'infoTime': Clock.time_now() - (Clock.monotonic() - self.published_info_time)}
+
+    def restore_state(self, state):
+        if state.get('infoTime') is not None:
+            self.published_info = state.get('info')
+            self.published_info_time = Clock.monotonic() - (Clock.time_now() - state['infoTime'])
 
     def update_info_device_message(self, message):
         url = self.SET_VARIABLE_URL.format(self.host, self.api_id, self.info_device_id, message, self.token)
 
         logger.info('Sending info to Hubitat')
-        response = requests.get(url)
+        response = self.session.get(url)
 
         if response.status_code != 200:
             logger.error('Failed to make Hubitat request: {}'.format(response.text))
+            return False
+        return True
+
+
+class AsyncHubitatAPI:
+    # Async variant of HubitatAPI: runs the blocking calls of a shared client in worker threads
+    def __init__(self, hubitat):
+        self.hubitat = hubitat
+
+    async def is_automation_on(self):
+        return await asyncio.to_thread(self.hubitat.is_automation_on)
+
+    async def is_night_charging_on(self):
+        return await asyncio.to_thread(self.hubitat.is_night_charging_on)
+
+    async def get_night_charging_limit(self):
+        return await asyncio.to_thread(self.hubitat.get_night_charging_limit)
 
+    async def set_info_message(self, msg, amps, grid):
+        await asyncio.to_thread(self.hubitat.set_info_message, msg, amps, grid)
@@ -0,0 +1,87 @@
+# Hubitat event listener
+#
+# The Maker API can POST every event of its devices to a URL ("URL to send device events to by POST"). The listener
+# applies them to the Hubitat client's cached device attributes, so switch changes are known right away instead of
+# at the next poll, and wakes the automation loop when the automation or night charging switch changed.
+
+import json
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class EventHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        listener = self.server.listener
+        if not listener.is_allowed(self.client_address[0]):
+            self.send_error(403)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            event = json.loads(body)['content']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        listener.handle_event(event)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('Hubitat event request: {}'.format(format % args))
+
+
+class EventListener:
+    """
+    Receives the Maker API device events on `port` in a background thread.
+
+    Only events from the hub's address are accepted (the events can turn the automation on): while the hub's host name
+    can't be resolved, every event is refused and the automation keeps polling the switches.
+    `changes` (a threading.Event) is set when a switch changed. A running listener doesn't mean events arrive (the
+    Maker API may have no POST URL), so the loop only relies on them once one was accepted (`is_receiving()`).
+    """
+
+    def __init__(self, hubitat, port, changes, host=''):
+        self.hubitat = hubitat
+        self.hub_address = self.resolve(hubitat.host)
+        if self.hub_address is None:
+            logger.warning('Refusing Hubitat events until the hub host {} resolves'.format(hubitat.host))
+        self.changes = changes
+        self.server = ThreadingHTTPServer((host, port), EventHandler)
+        self.server.daemon_threads = True
+        self.server.listener = self
+        threading.Thread(target=self.server.serve_forever, name='HubitatEvents', daemon=True).start()
+        logger.info('Listening for Hubitat events on port {}'.format(self.server.server_address[1]))
+
+    @staticmethod
+    def resolve(url):
+        try:
+            return socket.gethostbyname(urlsplit(url).hostname)
+        except (OSError, TypeError, UnicodeError) as e:
+            logger.warning('Cannot resolve the Hubitat host {}: {}'.format(url, e))
+            return None
+
+    def is_allowed(self, address):
+        if self.hub_address is None:
+            # Try again, the name may not have been resolvable at start-up only
+            self.hub_address = self.resolve(self.hubitat.host)
+        return self.hub_address is not None and address == self.hub_address
+
+    def is_receiving(self):
+        # Whether the hub's events arrive, so a switch change wakes the loop: one was accepted from the hub already
+        return self.hub_address is not None and self.hubitat.event_time is not None
+
+    def handle_event(self, event):
+        device_id, name, value = str(event.get('deviceId')), event.get('name'), event.get('value')
+        logger.debug('Hubitat event: device {} {} = {}'.format(device_id, name, value))
+        if self.hubitat.apply_event(device_id, name, value):
+            logger.info('Hubitat device {} {} changed to {}'.format(device_id, name, value))
+            self.changes.set()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,239 @@
+# Prometheus metrics
+#
+# Metrics are always recorded in memory (it's cheap), the /metrics HTTP endpoint is only served when a
+# metrics-port is configured. Uses the Prometheus text exposition format, no client library needed.
+
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import Tracing
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CYCLE_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{{{}}}'.format(','.join(pairs))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # label values -> value(s)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, label_values):
+        if len(label_values) != len(self.label_names):
+            raise ValueError('{} expects labels {}'.format(self.name, self.label_names))
+        return tuple(str(value) for value in label_values)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return ['{}{} {}'.format(self.name, format_labels(self.label_names, label_values), format_value(value))]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        if not self.label_names:
+            self.values[()] = 0
+
+    def inc(self, *label_values, amount=1):
+        key = self.key(label_values)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        key = self.key(label_values)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, *label_values):
+        key = self.key(label_values)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, label_values, value):
+        counts, total = value
+        label_names = self.label_names + ('le',)
+        lines = ['{}_bucket{} {}'.format(self.name, format_labels(label_names, label_values + (format_value(bound),)),
+                                         count) for bound, count in zip(self.buckets, counts)]
+        labels = format_labels(self.label_names, label_values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+API_REQUEST_DURATION = registry.register(Histogram(
+    'charging_api_request_duration_seconds', 'Latency of requests to the Rivian, Enphase and Hubitat APIs',
+    ['service', 'endpoint']))
+API_ERRORS = registry.register(Counter(
+    'charging_api_errors_total', 'Failed API requests (HTTP error status or connection error)',
+    ['service', 'endpoint', 'error']))
+CYCLE_DURATION = registry.register(Histogram(
+    'charging_cycle_duration_seconds', 'Duration of the automation cycles', buckets=CYCLE_BUCKETS))
+CYCLE_FAILURES = registry.register(Counter('charging_cycle_failures_total', 'Automation cycles that failed'))
+DECISIONS = registry.register(Counter('charging_decisions_total', 'Automation decisions by branch', ['branch']))
+CURRENT_AMPS = registry.register(Gauge('charging_current_amps', 'Charging amps set by the automation', ['vehicle']))
+GRID_WATTS = registry.register(Gauge('charging_grid_watts', 'Latest grid reading (W, positive when importing)'))
+BATTERY_WATTS = registry.register(Gauge('charging_battery_watts',
+                                        'Latest home battery reading (W, positive when discharging)'))
+SOLAR_WATTS = registry.register(Gauge('charging_solar_watts', 'Latest solar production reading (W)'))
+EV_DRAW_AMPS = registry.register(Gauge('charging_ev_draw_amps', 'Amps the EV actually draws (measured or estimated)',
+                                       ['vehicle']))
+CHARGER_DERATED = registry.register(Gauge('charging_charger_derated', 'Charger derate status (1 when derated)',
+                                          ['vehicle']))
+EV_SOC = registry.register(Gauge('charging_ev_soc_percent', 'EV battery level (%)', ['vehicle']))
+API_RETRIES = registry.register(Counter('charging_api_retries_total', 'Retried API requests', ['service']))
+CIRCUIT_OPEN = registry.register(Gauge('charging_circuit_open', 'Circuit breaker state (1 while skipping the service)',
+                                       ['service']))
+TIMESERIES_REJECTED = registry.register(Counter(
+    'charging_timeseries_rejected_total', 'Enphase readings not stored because they were not newer than the last one'))
+AUTOMATION_MODE = registry.register(Gauge('charging_automation_mode', 'Automation mode (1 for the current mode)',
+                                          ['mode']))
+
+
+def rivian_endpoint(request):
+    # API and GraphQL operation name, e.g. 'gateway/GetVehicleState' for /api/gql/gateway/graphql
+    path = urlsplit(request.url).path.split('/')
+    operation = None
+    try:
+        operation = json.loads(request.body or b'{}').get('operationName')
+    except (ValueError, AttributeError):
+        pass
+    return '{}/{}'.format(path[3] if len(path) > 3 else '', operation or 'unknown')
+
+
+def hubitat_endpoint(request):
+    # Maker API path without IDs, variable values and the access token, e.g. 'devices/{id}/setVariable'
+    path = urlsplit(request.url).path
+    path = re.sub(r'^/apps/api/[^/]+', '', path)
+    path = re.sub(r'/devices/(?!all\b)[^/]+', '/devices/{id}', path)
+    path = re.sub(r'/setVariable/.*', '/setVariable', path)
+    return path.lstrip('/')
+
+
+def path_endpoint(request):
+    return urlsplit(request.url).path
+
+
+def instrument_session(session, service, endpoint=path_endpoint):
+    # Record the latency and the errors of every request sent over a requests session
+    if getattr(session, 'instrumented', False):
+        return session
+    send = session.send
+
+    def timed_send(request, **kwargs):
+        name = endpoint(request)
+        start = time.perf_counter()
+        try:
+            with Tracing.span(name, service) as args:
+                response = send(request, **kwargs)
+                args['status'] = response.status_code
+        except Exception as e:
+            API_ERRORS.inc(service, name, type(e).__name__)
+            raise
+        API_REQUEST_DURATION.observe(time.perf_counter() - start, service, name)
+        if response.status_code >= 400:
+            API_ERRORS.inc(service, name, str(response.status_code))
+        return response
+
+    session.send = timed_send
+    session.instrumented = True
+    return session
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: {}'.format(format % args))
+
+
+server = None
+
+
+def start_server(port, host=''):
+    # Serve /metrics in a background thread (once per process)
+    global server
+    if server is None:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+        logger.info('Serving metrics on port {}'.format(server.server_address[1]))
+    return server
@@ -0,0 +1,203 @@
+# Timeouts, retries, circuit breakers and the cycle deadline shared by the Rivian, Enphase and Hubitat clients
+#
+# Installed on each client's requests session (like the metrics), so the requests made inside the Enphase-API library
+# are covered too:
+# - every request gets connect and read timeouts, capped by the time left before the cycle deadline
+# - idempotent reads are retried with jittered exponential backoff on connection errors, timeouts and 5xx responses
+# - a circuit breaker per service fails requests right away while the service is down, letting a trial request
+#   through every reset_timeout seconds
+# - requests made after the cycle deadline fail right away, so the cycle aborts instead of blocking the loop
+
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import requests
+import Clock
+import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceUnavailable(requests.RequestException):
+    # A service can't be used right now (or not in time), so nothing was requested
+    pass
+
+
+class CircuitOpenError(ServiceUnavailable):
+    pass
+
+
+class DeadlineExceeded(ServiceUnavailable):
+    pass
+
+
+class Policy:
+    def __init__(self, connect_timeout=5, read_timeout=30, retries=2, backoff=1, max_backoff=10,
+                 failure_threshold=5, reset_timeout=60):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.connect_timeout, config.read_timeout, config.request_retries,
+                   failure_threshold=config.circuit_breaker_threshold, reset_timeout=config.circuit_breaker_reset)
+
+    def apply_config(self, config):
+        # The protected sessions keep this policy, so a changed config.json is applied in place
+        vars(self).update(vars(self.from_config(config)))
+        with breakers_lock:
+            for breaker in breakers.values():
+                breaker.failure_threshold = self.failure_threshold
+                breaker.reset_timeout = self.reset_timeout
+
+    def timeout(self):
+        # (connect, read) timeouts, no longer than the time left in the cycle
+        left = remaining()
+        if left is None:
+            return self.connect_timeout, self.read_timeout
+        if left <= 0:
+            raise DeadlineExceeded('Automation cycle deadline passed')
+        return min(self.connect_timeout, left), min(self.read_timeout, left)
+
+    def backoff_delay(self, attempt):
+        # Full jitter: anywhere up to the exponential backoff, so retries from concurrent requests don't line up
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Closed: requests go through. After `failure_threshold` consecutive failures the circuit opens and requests fail
+    right away. After `reset_timeout` seconds one trial request goes through (half-open): if it succeeds the circuit
+    closes, otherwise it stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, service, failure_threshold=5, reset_timeout=60):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or Clock.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('{} is unavailable (circuit open)'.format(self.service))
+            # Half-open: let this request through as the trial
+            self.trial = True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info('{} is back, closing the circuit'.format(self.service))
+                Metrics.CIRCUIT_OPEN.set(0, self.service)
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is None and self.failures < self.failure_threshold:
+                return
+            if self.opened_at is None:
+                logger.warning('{} failed {} times in a row, opening the circuit for {} seconds'.format(
+                    self.service, self.failures, self.reset_timeout))
+                Metrics.CIRCUIT_OPEN.set(1, self.service)
+            self.opened_at = Clock.monotonic()
+
+
+# Service name -> CircuitBreaker, shared by all the clients of a service
+breakers = {}
+breakers_lock = threading.Lock()
+
+# Monotonic time the current cycle must end by (None outside of a cycle, e.g. the background sampler)
+cycle_deadline = contextvars.ContextVar('cycle_deadline', default=None)
+
+
+def get_breaker(service, policy):
+    with breakers_lock:
+        if service not in breakers:
+            breakers[service] = CircuitBreaker(service, policy.failure_threshold, policy.reset_timeout)
+        return breakers[service]
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # Requests made within the block (including worker threads and tasks started from it) must end in `seconds`
+    token = cycle_deadline.set(Clock.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        cycle_deadline.reset(token)
+
+
+def remaining():
+    # Seconds left before the cycle deadline, None without a deadline
+    at = cycle_deadline.get()
+    return None if at is None else at - Clock.monotonic()
+
+
+def is_read(request):
+    return request.method in ('GET', 'HEAD')
+
+
+def protect_session(session, service, policy=None, idempotent=is_read):
+    # Apply the timeouts, retries (of requests `idempotent` returns True for) and circuit breaker of `service`
+    # to every request sent over a requests session
+    if getattr(session, 'protected', False):
+        return session
+    policy = policy or Policy()
+    breaker = get_breaker(service, policy)
+    send = session.send
+
+    def resilient_send(request, **kwargs):
+        retries = policy.retries if idempotent(request) else 0
+        attempt = 0
+        while True:
+            kwargs['timeout'] = policy.timeout()
+            breaker.before_request()
+            try:
+                response = send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                if attempt == retries:
+                    raise
+                error = e
+            except Exception:
+                breaker.record_failure()
+                raise
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt == retries:
+                    return response
+                error = response.status_code
+                response.close()
+
+            delay = policy.backoff_delay(attempt)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise DeadlineExceeded('No time left to retry {} request ({})'.format(service, error))
+            attempt += 1
+            Metrics.API_RETRIES.inc(service)
+            logger.info('{} request failed ({}), retry {} / {} in {:.1f} seconds'.format(
+                service, error, attempt, retries, delay))
+            Clock.sleep(delay)
+
+    session.send = resilient_send
+    session.protected = True
+    return session
@@ -1,42 +1,169 @@
 # Rivian API wrapper
 
+import asyncio
 import logging
 import os
 import json
+import threading
 import requests
-from datetime import datetime
+from functools import lru_cache
+import Clock
+import Metrics
+import Resilience
+import Tracing
+from GraphQL import is_query_request, mutation, persisted_query_error, query, timestamped
+from TokenStore import write_json_atomic
 
 logger = logging.getLogger(__name__)
 
+# GraphQL operations, each declaring only the fields the automation reads
+CREATE_CSRF_TOKEN = mutation('CreateCSRFToken', 'createCsrfToken', ['__typename', 'csrfToken', 'appSessionToken'],
+                             persist=False)
+LOGIN = mutation(
+    'Login', 'login(email: $email, password: $password)',
+    ['__typename',
+     {'... on MobileLoginResponse': ['accessToken', 'refreshToken', 'userSessionToken']},
+     {'... on MobileMFALoginResponse': ['otpToken']}],
+    {'email': 'String!', 'password': 'String!'}, persist=False)
+GET_USER_VEHICLES = query('getUserInfo', 'currentUser', [{'vehicles': ['id']}])
+GET_USER_ID = query('getUserId', 'currentUser', ['id'])
+GET_CHARGING_SCHEDULE = query(
+    'GetChargingSchedule', 'getVehicle(id: $vehicleId)',
+    [{'chargingSchedules': ['startTime', 'duration', {'location': ['latitude', 'longitude']}, 'amperage', 'enabled',
+                            'weekDays']}],
+    {'vehicleId': 'String!'})
+SET_CHARGING_SCHEDULE = mutation(
+    'SetChargingSchedule', 'setChargingSchedules(vehicleId: $vehicleId, chargingSchedules: $chargingSchedules)',
+    ['success'],
+    {'vehicleId': 'String!', 'chargingSchedules': '[InputChargingSchedule!]!'})
+# Live data of the current charging session (power in kW, as measured by the car)
+GET_LIVE_SESSION_DATA = query(
+    'getLiveSessionData', 'getLiveSessionData(vehicleId: $vehicleId)', [{'power': ['value', 'updatedAt']}],
+    {'vehicleId': 'ID!'})
+# Vehicle state values used by the automation
+VEHICLE_STATE_FIELDS = ('chargerStatus', 'batteryLevel', 'chargerDerateStatus')
+# Also read to split the solar surplus by how far each vehicle is from its charge limit
+SOC_DEFICIT_FIELDS = VEHICLE_STATE_FIELDS + ('batteryLimit',)
+# chargerStatus values of a vehicle plugged in
+CHARGER_CONNECTED = ('chrgr_sts_connected_charging', 'chrgr_sts_connected_no_chrg')
+# chargerDerateStatus values of a charger running at full power
+CHARGER_NOT_DERATED = (None, '', 'NONE')
+
+
+@lru_cache
+def vehicle_state_query(fields):
+    return query('GetVehicleState', 'vehicleState(id: $vehicleID)', timestamped(*fields), {'vehicleID': 'String!'})
+
 
 class RivianAPI:
-    GATEWAY_URL = 'https://rivian.com/api/gql/gateway/graphql'
-    CHARGING_URL = 'https://rivian.com/api/gql/chrg/user/graphql'
-    AMPS_MAX = 48
-    AMPS_MIN = 8
+    GATEWAY_PATH = '/api/gql/gateway/graphql'
+    CHARGING_PATH = '/api/gql/chrg/user/graphql'
 
-    def __init__(self, config, session_file):
+    def __init__(self, config, session_file, schedule_file='rivian-schedule.json', policy=None):
         self.config = config
         self.session_file = session_file
+        # Schedule shadow of the first vehicle, the others get one named after their vehicle ID
+        self.schedule_file = schedule_file
+        self.gateway_url = config.rivian_host + self.GATEWAY_PATH
+        self.charging_url = config.rivian_host + self.CHARGING_PATH
         self.app_session_token = None
         self.user_session_token = None
         self.csrf_token = None
-        self.vehicle_id = None
-        self.charging_status = None
-        self.battery_level = None
+        # All vehicles on the account
+        self.vehicle_ids = []
+        self.vehicles = []
+        self.vehicle_state_fields = SOC_DEFICIT_FIELDS if config.vehicle_allocation == 'soc-deficit' \
+            else VEHICLE_STATE_FIELDS
+        # When the stored session was created and last confirmed to work
+        self.session_created_at = None
+        self.session_validated_at = None
+        # Optional: send Apollo persisted query hashes instead of the full query text
+        self.persisted_queries = config.rivian_persisted_queries
+        # Optional vehicle state subscription (RivianSubscription), the vehicles poll without it
+        self.subscription = None
+        # Serializes re-login when concurrent requests find the session expired
+        self.login_lock = threading.Lock()
+        # Keep-alive connection pool reused by every request for the life of this client
+        self.session = requests.Session()
+        # (the async cycle reads the state and the schedule of two vehicles at once)
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        Metrics.instrument_session(self.session, 'rivian', Metrics.rivian_endpoint)
+        # GraphQL queries are retried, mutations are not
+        Resilience.protect_session(self.session, 'rivian', policy or Resilience.Policy.from_config(config),
+                                   is_query_request)
         self.login()
-        self.init_vehicle_info()
+        self.init_vehicles()
+
+    def auth_headers(self):
+        return {
+            'a-sess': self.app_session_token,
+            'u-sess': self.user_session_token,
+            'csrf-token': self.csrf_token,
+            'apollographql-client-name': 'com.rivian.android.consumer'
+        }
+
+    @staticmethod
+    def is_auth_error(response):
+        if response.status_code in (401, 403):
+            return True
+        if response.status_code != 200:
+            return False
+        try:
+            errors = response.json().get('errors') or []
+        except ValueError:
+            return False
+        return any((error.get('extensions') or {}).get('code') in ('UNAUTHENTICATED', 'FORBIDDEN') for error in errors)
+
+    def post_operation(self, url, operation, variables=None, headers=None):
+        headers = self.auth_headers() if headers is None else headers
+        if not self.persisted_queries or not operation.persist:
+            return self.session.post(url, headers=headers, json=operation.request(variables))
+
+        # Send the query hash only, the server already has the query text unless told otherwise
+        response = self.session.post(url, headers=headers,
+                                     json=operation.request(variables, persisted=True, include_query=False))
+        try:
+            error = persisted_query_error(response.json())
+        except ValueError:
+            error = None
+        if error == 'not-found':
+            # Register the query with the server
+            return self.session.post(url, headers=headers, json=operation.request(variables, persisted=True))
+        if error == 'not-supported':
+            logger.info('Rivian API does not support persisted queries, sending full queries')
+            self.persisted_queries = False
+            return self.session.post(url, headers=headers, json=operation.request(variables))
+        return response
+
+    @Tracing.traced('rivian')
+    def graphql(self, operation, variables=None, url=None, reauthenticate=True):
+        # Send an authenticated request over the pooled session.
+        # Only re-login when the stored session is actually rejected, then retry once.
+        url = url or self.gateway_url
+        user_session_token = self.user_session_token
+        response = self.post_operation(url, operation, variables)
+
+        if reauthenticate and self.is_auth_error(response):
+            with self.login_lock:
+                # Another request may have logged in again already
+                if self.user_session_token == user_session_token:
+                    logger.info('Rivian session rejected, logging in again')
+                    if self.init_session():
+                        self.save_session()
+            response = self.post_operation(url, operation, variables)
 
+        if response.status_code != 200:
+            logger.error('Failed to make GraphQL request: {}'.format(response.text))
+            return None
+
+        return response.json()
+
+    @Tracing.traced('rivian')
     def init_session(self):
         # Getting CSRF token
         logger.info('Initializing new Rivian session...')
-        request = {
-            "operationName": "CreateCSRFToken",
-            "variables": [],
-            "query": "mutation CreateCSRFToken { createCsrfToken { __typename csrfToken appSessionToken } }"
-        }
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
+        response = self.post_operation(self.gateway_url, CREATE_CSRF_TOKEN, headers=headers)
 
         if response.status_code != 200:
             logger.error('Failed to make GraphQL request: {}'.format(response.text))
@@ -49,20 +176,16 @@ class RivianAPI:
         username = self.config.rivian_user
         password = self.config.rivian_pass
 
-        request = {
-            "operationName": "Login",
-            "variables": {
-                "email": username,
-                "password": password
-            },
-            "query": "mutation Login($email: String!, $password: String!) { login(email: $email, password: $password) { __typename ... on MobileLoginResponse { accessToken refreshToken userSessionToken } ... on MobileMFALoginResponse { otpToken } } }"
+        variables = {
+            "email": username,
+            "password": password
         }
         headers = {
             'a-sess': self.app_session_token,
             'csrf-token': self.csrf_token,
             'apollographql-client-name': 'com.rivian.android.consumer'
         }
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
+        response = self.post_operation(self.gateway_url, LOGIN, variables, headers=headers)
 
         if response.status_code != 200:
             logger.error('Failed to make GraphQL request: {}'.format(response.text))
@@ -70,67 +193,58 @@ class RivianAPI:
 
         data = response.json()
         self.user_session_token = data['data']['login']['userSessionToken']
+        self.session_created_at = None
         logger.info('Rivian session initialized')
+        return True
 
+    @Tracing.traced('rivian')
     def init_user_info(self):
+        # Loads the vehicle IDs, which also validates the session
         if not self.app_session_token:
             return False
 
         logger.info('Loading Rivian user data...')
-        request = {
-            "operationName": "getUserInfo",
-            "variables": {},
-            "query": "query getUserInfo { currentUser { __typename id firstName lastName email address { __typename country } vehicles { __typename id name owner roles vin vas { __typename vasVehicleId vehiclePublicKey } vehicle { __typename model mobileConfiguration { __typename trimOption { __typename optionId optionName } exteriorColorOption { __typename optionId optionName } interiorColorOption { __typename optionId optionName } } vehicleState { __typename supportedFeatures { __typename name status } } otaEarlyAccessStatus } settings { __typename name { __typename value } } } enrolledPhones { __typename vas { __typename vasPhoneId publicKey } enrolled { __typename deviceType deviceName vehicleId identityId shortName } } pendingInvites { __typename id invitedByFirstName role status vehicleId vehicleModel email } } }"
-        }
+        response = self.post_operation(self.gateway_url, GET_USER_VEHICLES)
 
-        headers = {
-            'a-sess': self.app_session_token,
-            'u-sess': self.user_session_token,
-            'csrf-token': self.csrf_token,
-            'apollographql-client-name': 'com.rivian.android.consumer'
-        }
-
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
-
-        if response.status_code != 200:
+        if response.status_code != 200 or self.is_auth_error(response):
             return False
-        data = response.json()
-        self.vehicle_id = data['data']['currentUser']['vehicles'][0]['id']
-        logger.info('Rivian user data loaded')
+        user = (response.json().get('data') or {}).get('currentUser')
+        if not user or not user['vehicles']:
+            return False
+        self.vehicle_ids = [vehicle['id'] for vehicle in user['vehicles']]
+        logger.info('Rivian user data loaded: {} vehicle(s)'.format(len(self.vehicle_ids)))
         return True
 
-    def init_vehicle_info(self):
-        logger.info('Loading Rivian vehicle data...')
-
-        request = {
-            "operationName": "GetVehicleState",
-            "variables": {
-                "vehicleID": self.vehicle_id
-            },
-            "query": "query GetVehicleState($vehicleID: String!) { vehicleState(id: $vehicleID) { __typename gnssLocation { __typename latitude longitude timeStamp } alarmSoundStatus { __typename timeStamp value } timeToEndOfCharge { __typename timeStamp value } doorFrontLeftLocked { __typename timeStamp value } doorFrontLeftClosed { __typename timeStamp value } doorFrontRightLocked { __typename timeStamp value } doorFrontRightClosed { __typename timeStamp value } doorRearLeftLocked { __typename timeStamp value } doorRearLeftClosed { __typename timeStamp value } doorRearRightLocked { __typename timeStamp value } doorRearRightClosed { __typename timeStamp value } windowFrontLeftClosed { __typename timeStamp value } windowFrontRightClosed { __typename timeStamp value } windowFrontLeftCalibrated { __typename timeStamp value } windowFrontRightCalibrated { __typename timeStamp value } windowRearLeftCalibrated { __typename timeStamp value } windowRearRightCalibrated { __typename timeStamp value } closureFrunkLocked { __typename timeStamp value } closureFrunkClosed { __typename timeStamp value } gearGuardLocked { __typename timeStamp value } closureLiftgateLocked { __typename timeStamp value } closureLiftgateClosed { __typename timeStamp value } windowRearLeftClosed { __typename timeStamp value } windowRearRightClosed { __typename timeStamp value } closureSideBinLeftLocked { __typename timeStamp value } closureSideBinLeftClosed { __typename timeStamp value } closureSideBinRightLocked { __typename timeStamp value } closureSideBinRightClosed { __typename timeStamp value } closureTailgateLocked { __typename timeStamp value } closureTailgateClosed { __typename timeStamp value } closureTonneauLocked { __typename timeStamp value } closureTonneauClosed { __typename timeStamp value } wiperFluidState { __typename timeStamp value } powerState { __typename timeStamp value } batteryHvThermalEventPropagation { __typename timeStamp value } vehicleMileage { __typename timeStamp value } brakeFluidLow { __typename timeStamp value } gearStatus { __typename timeStamp value } tirePressureStatusFrontLeft { __typename timeStamp value } tirePressureStatusValidFrontLeft { __typename timeStamp value } tirePressureStatusFrontRight { __typename timeStamp value } tirePressureStatusValidFrontRight { __typename timeStamp value } tirePressureStatusRearLeft { __typename timeStamp value } tirePressureStatusValidRearLeft { __typename timeStamp value } tirePressureStatusRearRight { __typename timeStamp value } tirePressureStatusValidRearRight { __typename timeStamp value } batteryLevel { __typename timeStamp value } chargerState { __typename timeStamp value } batteryLimit { __typename timeStamp value } remoteChargingAvailable { __typename timeStamp value } batteryHvThermalEvent { __typename timeStamp value } rangeThreshold { __typename timeStamp value } distanceToEmpty { __typename timeStamp value } otaAvailableVersionNumber { __typename timeStamp value } otaAvailableVersionWeek { __typename timeStamp value } otaAvailableVersionYear { __typename timeStamp value } otaCurrentVersionNumber { __typename timeStamp value } otaCurrentVersionWeek { __typename timeStamp value } otaCurrentVersionYear { __typename timeStamp value } otaDownloadProgress { __typename timeStamp value } otaInstallDuration { __typename timeStamp value } otaInstallProgress { __typename timeStamp value } otaInstallReady { __typename timeStamp value } otaInstallTime { __typename timeStamp value } otaInstallType { __typename timeStamp value } otaStatus { __typename timeStamp value } otaCurrentStatus { __typename timeStamp value } cabinClimateInteriorTemperature { __typename timeStamp value } cabinPreconditioningStatus { __typename timeStamp value } cabinPreconditioningType { __typename timeStamp value } petModeStatus { __typename timeStamp value } petModeTemperatureStatus { __typename timeStamp value } cabinClimateDriverTemperature { __typename timeStamp value } gearGuardVideoStatus { __typename timeStamp value } gearGuardVideoMode { __typename timeStamp value } gearGuardVideoTermsAccepted { __typename timeStamp value } defrostDefogStatus { __typename timeStamp value } steeringWheelHeat { __typename timeStamp value } seatFrontLeftHeat { __typename timeStamp value } seatFrontRightHeat { __typename timeStamp value } seatRearLeftHeat { __typename timeStamp value } seatRearRightHeat { __typename timeStamp value } chargerStatus { __typename timeStamp value } seatFrontLeftVent { __typename timeStamp value } seatFrontRightVent { __typename timeStamp value } chargerDerateStatus { __typename timeStamp value } driveMode { __typename timeStamp value } } }"
-        }
-        headers = {
-            'a-sess': self.app_session_token,
-            'u-sess': self.user_session_token,
-            'csrf-token': self.csrf_token,
-            'apollographql-client-name': 'com.rivian.android.consumer'
-        }
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
-
-        if response.status_code != 200:
-            logger.error('Failed to make GraphQL request: {}'.format(response.text))
-            return
-
-        data = response.json()
-
-        if data['data']['vehicleState']['chargerStatus'] == None:
-            logger.info('Rivian vehicle data missing — might be in service mode')
-            return
-
-        self.charging_status = data['data']['vehicleState']['chargerStatus']['value']
-        self.battery_level = data['data']['vehicleState']['batteryLevel']['value']
-        logger.info('Rivian vehicle data loaded')
+    def init_vehicles(self):
+        # One client per vehicle, sharing this session
+        self.vehicles = []
+        for i, vehicle_id in enumerate(self.vehicle_ids):
+            schedule_file = self.schedule_file
+            if i:
+                name, extension = os.path.splitext(self.schedule_file)
+                schedule_file = '{}-{}{}'.format(name, vehicle_id, extension)
+            self.vehicles.append(RivianVehicle(self, vehicle_id, schedule_file))
+
+    def get_vehicles(self):
+        # Retries loading the vehicles if the login failed at start-up
+        if not self.vehicles and self.init_user_info():
+            self.save_session()
+            self.init_vehicles()
+        return self.vehicles
+
+    @property
+    def schedule_updates(self):
+        return sum(vehicle.schedule_updates for vehicle in self.vehicles)
+
+    @Tracing.traced('rivian')
+    def validate_session(self):
+        # Explicit session check with the smallest possible query
+        if not self.app_session_token:
+            return False
+        response = self.post_operation(self.gateway_url, GET_USER_ID)
+        return response.status_code == 200 and not self.is_auth_error(response)
 
+    @Tracing.traced('rivian')
     def login(self):
         # check stored session first
         if os.path.exists(self.session_file):
@@ -140,64 +254,198 @@ class RivianAPI:
                 self.app_session_token = data['appSessionToken']
                 self.user_session_token = data['userSessionToken']
                 self.csrf_token = data['csrfToken']
+                # Sessions saved before multiple vehicles were supported only have the first vehicle
+                self.vehicle_ids = data.get('vehicleIds') or []
+                self.session_created_at = data.get('createdAt')
+                self.session_validated_at = data.get('validatedAt')
+
+        # A stored session with known vehicles is assumed to be valid:
+        # if it's not, the first real request gets an auth error and logs in again
+        if self.app_session_token and self.vehicle_ids:
+            return
 
         # if connection fails, reinitialize
-        if not self.init_user_info():
-            self.init_session()
-            if self.init_user_info():
-                # store session for future use
-                logger.info('Persisting Rivian session')
-                with open(self.session_file, 'w') as f:
-                    session_json = {
-                        'appSessionToken': self.app_session_token,
-                        'userSessionToken': self.user_session_token,
-                        'csrfToken': self.csrf_token
-                    }
-                    json.dump(session_json, f)
+        if self.init_user_info():
+            self.save_session()
+            return
+        if self.init_session() and self.init_user_info():
+            self.save_session()
+
+    def save_session(self):
+        # store session for future use
+        logger.info('Persisting Rivian session')
+        now = Clock.time_now()
+        if self.session_created_at is None:
+            self.session_created_at = now
+        self.session_validated_at = now
+        write_json_atomic(self.session_file, {
+            'appSessionToken': self.app_session_token,
+            'userSessionToken': self.user_session_token,
+            'csrfToken': self.csrf_token,
+            'vehicleId': self.vehicle_ids[0] if self.vehicle_ids else None,
+            'vehicleIds': self.vehicle_ids,
+            'createdAt': self.session_created_at,
+            'validatedAt': self.session_validated_at
+        })
+
+    def close(self):
+        if self.subscription is not None:
+            self.subscription.stop()
+            self.subscription = None
+        self.session.close()
+
+
+class RivianVehicle:
+    """
+    State and charging schedule of one vehicle, read and written through the account's RivianAPI session.
+    """
+
+    def __init__(self, rivian, vehicle_id, schedule_file):
+        self.rivian = rivian
+        self.vehicle_id = vehicle_id
+        self.schedule_file = schedule_file
+        self.charging_status = None
+        self.battery_level = None
+        # Latest values of the requested vehicle state fields
+        self.vehicle_state = {}
+        # Number of successful schedule writes made by this client
+        self.schedule_updates = 0
+        # Local shadow of the vehicle's charging schedules (and when it was last confirmed by the server)
+        self.schedules = None
+        self.schedules_time = None
+        self.schedules_vehicle_id = None
+        self.load_schedule_shadow()
+
+    @Tracing.traced('rivian')
+    def init_vehicle_info(self, fields=None):
+        fields = fields or self.rivian.vehicle_state_fields
+        # Forget the previous cycle's state, so a failed read is treated as unknown
+        self.charging_status = None
+        self.battery_level = None
+        self.vehicle_state = {}
+
+        # No request while the subscription keeps the state current
+        subscription = self.rivian.subscription
+        vehicle_state = subscription.get_state(self.vehicle_id, fields) if subscription else None
+        if vehicle_state is not None:
+            logger.info('Rivian vehicle data ({}) from the subscription'.format(self.vehicle_id))
+            self.set_vehicle_state(vehicle_state)
+            return
+
+        logger.info('Loading Rivian vehicle data ({})...'.format(self.vehicle_id))
+        data = self.rivian.graphql(vehicle_state_query(tuple(fields)), {"vehicleID": self.vehicle_id})
+        if data is None:
+            return
+
+        vehicle_state = data['data']['vehicleState']
+        if vehicle_state['chargerStatus'] == None:
+            logger.info('Rivian vehicle data missing — might be in service mode')
+            return
+
+        self.set_vehicle_state({name: (value or {}).get('value') for name, value in vehicle_state.items()})
+        if subscription:
+            subscription.seed(self.vehicle_id, self.vehicle_state)
+        logger.info('Rivian vehicle data loaded')
+
+    def set_vehicle_state(self, vehicle_state):
+        self.vehicle_state = vehicle_state
+        self.charging_status = vehicle_state['chargerStatus']
+        self.battery_level = vehicle_state['batteryLevel']
+        if self.battery_level is not None:
+            Metrics.EV_SOC.set(self.battery_level, self.vehicle_id)
 
     def is_charging(self):
         return self.charging_status == 'chrgr_sts_connected_charging'
 
     def is_charger_connected(self):
-        return self.charging_status in ['chrgr_sts_connected_charging', 'chrgr_sts_connected_no_chrg']
+        return self.charging_status in CHARGER_CONNECTED
 
     def get_battery_level(self):
         return self.battery_level
 
-    def get_current_schedules(self):
-        request = {
-            "operationName": "GetChargingSchedule",
-            "variables": {
-                "vehicleId": self.vehicle_id
-            },
-            "query": "query GetChargingSchedule($vehicleId: String!) { getVehicle(id: $vehicleId) { chargingSchedules { startTime duration location { latitude longitude } amperage enabled weekDays } } }"
-        }
-        headers = {
-            'a-sess': self.app_session_token,
-            'u-sess': self.user_session_token,
-            'csrf-token': self.csrf_token,
-            'apollographql-client-name': 'com.rivian.android.consumer'
-        }
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
+    def get_battery_limit(self):
+        return self.vehicle_state.get('batteryLimit')
 
-        if response.status_code != 200:
-            logger.error('Failed to make GraphQL request: {}'.format(response.text))
+    def get_charger_derate_status(self):
+        return self.vehicle_state.get('chargerDerateStatus')
+
+    def is_charger_derated(self):
+        return self.get_charger_derate_status() not in CHARGER_NOT_DERATED
+
+    @Tracing.traced('rivian')
+    def get_charging_power(self):
+        # Power the car is drawing in the current charging session (W), None if unknown
+        data = self.rivian.graphql(GET_LIVE_SESSION_DATA, {"vehicleId": self.vehicle_id}, url=self.rivian.charging_url)
+        session = ((data or {}).get('data') or {}).get('getLiveSessionData') or {}
+        power = (session.get('power') or {}).get('value')
+        if power is None:
+            return None
+        return power * 1000
+
+    @Tracing.traced('rivian')
+    def fetch_current_schedules(self):
+        data = self.rivian.graphql(GET_CHARGING_SCHEDULE, {"vehicleId": self.vehicle_id})
+        if data is None:
             return None
 
-        data = response.json()
         return data['data']['getVehicle']['chargingSchedules']
 
+    def load_schedule_shadow(self):
+        if not os.path.exists(self.schedule_file):
+            return
+        try:
+            with open(self.schedule_file) as f:
+                data = json.load(f)
+            self.schedules = data['schedules']
+            self.schedules_time = data['updatedAt']
+            self.schedules_vehicle_id = data['vehicleId']
+        except (ValueError, KeyError) as e:
+            logger.error('Ignoring invalid Rivian schedule file: {}'.format(e))
+            self.schedules = None
+
+    def save_schedule_shadow(self):
+        write_json_atomic(self.schedule_file, {
+            'vehicleId': self.vehicle_id,
+            'updatedAt': self.schedules_time,
+            'schedules': self.schedules
+        })
+
+    def update_schedule_shadow(self, schedules):
+        self.schedules = schedules
+        self.schedules_time = Clock.time_now()
+        self.schedules_vehicle_id = self.vehicle_id
+        self.save_schedule_shadow()
+
+    def invalidate_schedule_shadow(self):
+        self.schedules = None
+
+    def is_schedule_shadow_fresh(self):
+        if not self.schedules or self.schedules_vehicle_id != self.vehicle_id:
+            return False
+        # Re-read from the server now and then, in case the schedule was changed in the Rivian app
+        return Clock.time_now() - self.schedules_time < self.rivian.config.rivian_schedule_max_age
+
+    def get_current_schedules(self, refresh=False):
+        if not refresh and self.is_schedule_shadow_fresh():
+            return self.schedules
+
+        logger.info('Loading Rivian charging schedule...')
+        schedules = self.fetch_current_schedules()
+        if schedules is not None:
+            self.update_schedule_shadow(schedules)
+        return schedules
+
     def get_current_schedule_amp(self):
-        schedules = self.get_current_schedules()
-        return schedules[0]['amperage']
+        return self.get_available_schedules()[0]['amperage']
 
-    def set_schedule_custom(self, amps=AMPS_MAX):
+    def set_schedule_custom(self, amps=None):
+        amps_max = self.rivian.config.amps_max
         new_schedule = {
                 "startTime": 0,
                 "duration": 1440,
                 "location": {
                 },
-                "amperage": self.AMPS_MAX,
+                "amperage": amps_max,
                 "enabled": True,
                 "weekDays": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
             }
@@ -205,13 +453,14 @@ class RivianAPI:
         if amps == 0:
             # Use time-specific schedule that does not overlap with the current time:
             # in the first half of the day use 18:00-19:00; second half — use 6:00-7:00
-            current_hour = datetime.now().hour
+            current_hour = Clock.now().hour
             new_schedule["startTime"] = 18 * 60 if current_hour < 12 else 6 * 60
             new_schedule["duration"] = 60
-        else:
+        elif amps is not None:
             new_schedule["amperage"] = amps
 
-        current_schedules = self.get_current_schedules()
+        # Compare against the local shadow, only read from the server if it's stale
+        current_schedules = self.get_available_schedules()
         # copy the location from the existing schedule
         new_schedule["location"] = current_schedules[0]["location"]
 
@@ -224,6 +473,13 @@ class RivianAPI:
 
         self.set_charging_schedule(new_schedule)
 
+    def get_available_schedules(self):
+        # The current schedules, a failed read is a request error (e.g. for the safe state to report) like a timeout
+        schedules = self.get_current_schedules()
+        if not schedules:
+            raise Resilience.ServiceUnavailable('No Rivian charging schedule available for {}'.format(self.vehicle_id))
+        return schedules
+
     def set_schedule_default(self):
         self.set_schedule_custom()
 
@@ -233,25 +489,84 @@ class RivianAPI:
     def set_schedule_amps(self, amps):
         self.set_schedule_custom(amps=amps)
 
+    @Tracing.traced('rivian')
     def set_charging_schedule(self, schedule):
         logger.info('Updating charging schedule: {}'.format(schedule))
-        request = {
-            "operationName": "SetChargingSchedule",
-            "variables": {
-                "vehicleId": self.vehicle_id,
-                "chargingSchedules": [schedule]
-            },
-            "query": "mutation SetChargingSchedule($vehicleId: String!, $chargingSchedules: [InputChargingSchedule!]!) { setChargingSchedules(vehicleId: $vehicleId, chargingSchedules: $chargingSchedules) { success } }"
+        variables = {
+            "vehicleId": self.vehicle_id,
+            "chargingSchedules": [schedule]
         }
-        headers = {
-            'a-sess': self.app_session_token,
-            'u-sess': self.user_session_token,
-            'csrf-token': self.csrf_token,
-            'apollographql-client-name': 'com.rivian.android.consumer'
-        }
-        response = requests.post(self.GATEWAY_URL, headers=headers, json=request)
-
-        if response.status_code == 200:
+        try:
+            data = self.rivian.graphql(SET_CHARGING_SCHEDULE, variables)
+        except requests.RequestException:
+            # No response (e.g. timed out): the update may or may not have been made
+            self.invalidate_schedule_shadow()
+            raise
+        result = (data or {}).get('data') or {}
+        if (result.get('setChargingSchedules') or {}).get('success'):
+            self.schedule_updates += 1
+            self.update_schedule_shadow([schedule])
             logger.info('Charging schedule updated')
         else:
-            logger.error('Failed to make GraphQL request: {}'.format(response.text))
+            # The server state is unknown now, read it back before the next update
+            self.invalidate_schedule_shadow()
+
+
+class AsyncRivianAPI:
+    # Async variant of RivianAPI: runs the blocking calls of a shared client in worker threads,
+    # so independent requests of a cycle can run concurrently
+    def __init__(self, rivian):
+        self.rivian = rivian
+
+    @classmethod
+    async def create(cls, config, session_file, schedule_file='rivian-schedule.json', policy=None):
+        return cls(await asyncio.to_thread(RivianAPI, config, session_file, schedule_file, policy))
+
+    async def get_vehicles(self):
+        return [AsyncRivianVehicle(vehicle) for vehicle in await asyncio.to_thread(self.rivian.get_vehicles)]
+
+
+class AsyncRivianVehicle:
+    # Async variant of RivianVehicle
+    def __init__(self, vehicle):
+        self.vehicle = vehicle
+
+    @property
+    def vehicle_id(self):
+        return self.vehicle.vehicle_id
+
+    async def init_vehicle_info(self):
+        await asyncio.to_thread(self.vehicle.init_vehicle_info)
+
+    def is_charging(self):
+        return self.vehicle.is_charging()
+
+    def is_charger_connected(self):
+        return self.vehicle.is_charger_connected()
+
+    def get_battery_level(self):
+        return self.vehicle.get_battery_level()
+
+    def get_battery_limit(self):
+        return self.vehicle.get_battery_limit()
+
+    def is_charger_derated(self):
+        return self.vehicle.is_charger_derated()
+
+    async def get_charging_power(self):
+        return await asyncio.to_thread(self.vehicle.get_charging_power)
+
+    async def get_current_schedules(self):
+        return await asyncio.to_thread(self.vehicle.get_current_schedules)
+
+    async def get_current_schedule_amp(self):
+        return await asyncio.to_thread(self.vehicle.get_current_schedule_amp)
+
+    async def set_schedule_default(self):
+        await asyncio.to_thread(self.vehicle.set_schedule_default)
+
+    async def set_schedule_off(self):
+        await asyncio.to_thread(self.vehicle.set_schedule_off)
+
+    async def set_schedule_amps(self, amps):
+        await asyncio.to_thread(self.vehicle.set_schedule_amps, amps)
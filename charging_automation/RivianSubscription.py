@@ -0,0 +1,182 @@
+# Rivian vehicle state subscription
+#
+# The Rivian app is kept up to date by a GraphQL subscription over a websocket (the graphql-transport-ws protocol)
+# instead of polling GetVehicleState. The subscription runs in a background thread and merges every update into the
+# state of its vehicle, so a cycle reads the charger status and battery level from memory, and plugging a vehicle in
+# or unplugging it wakes the automation loop right away. While the websocket is down (reconnecting with backoff) the
+# vehicles poll as before.
+#
+# Needs the optional websockets package.
+
+import json
+import logging
+import random
+import threading
+import uuid
+from functools import lru_cache
+from websockets.exceptions import WebSocketException
+from websockets.sync.client import connect
+import Metrics
+from GraphQL import subscription, timestamped
+from RivianAPI import CHARGER_CONNECTED
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL = 'graphql-transport-ws'
+
+
+class SubscriptionError(Exception):
+    pass
+
+
+@lru_cache
+def vehicle_state_subscription(fields):
+    return subscription('VehicleState', 'vehicleState(id: $vehicleID)', timestamped(*fields),
+                        {'vehicleID': 'String!'})
+
+
+class VehicleStateSubscription:
+    """
+    Subscribes to the state of all the vehicles of a RivianAPI account over one websocket.
+
+    get_state() returns a vehicle's latest values while the subscription is connected and has all the fields (from
+    the server, or seeded from a poll), None otherwise. `changes` (a threading.Event) is set when a vehicle is plugged
+    in or unplugged.
+    """
+    # Reconnect backoff (seconds), doubling up to MAX_BACKOFF
+    BACKOFF = 1
+    MAX_BACKOFF = 5 * 60
+    # Seconds the server has to acknowledge the connection
+    ACK_TIMEOUT = 10
+
+    def __init__(self, rivian, url, changes=None):
+        self.rivian = rivian
+        self.url = url
+        self.changes = changes
+        # Vehicle ID -> {field: value} received since the websocket connected
+        self.states = {}
+        self.connected = False
+        self.lock = threading.Lock()
+        self.websocket = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='RivianSubscription', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        websocket = self.websocket
+        if websocket is not None:
+            websocket.close()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def get_state(self, vehicle_id, fields):
+        with self.lock:
+            state = self.states.get(vehicle_id)
+            if not self.connected or state is None or any(field not in state for field in fields):
+                return None
+            return {field: state[field] for field in fields}
+
+    def seed(self, vehicle_id, vehicle_state):
+        # Polled values fill in the fields the server hasn't sent since connecting (its updates are newer)
+        with self.lock:
+            state = self.states.get(vehicle_id)
+            if self.connected and state is not None:
+                for name, value in vehicle_state.items():
+                    state.setdefault(name, value)
+
+    def run(self):
+        attempt = 0
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except (OSError, ValueError, WebSocketException, SubscriptionError) as e:
+                if not self.stopped.is_set():
+                    logger.warning('Rivian subscription failed, polling the vehicle state: {}'.format(e))
+            else:
+                if not self.stopped.is_set():
+                    logger.info('Rivian subscription closed by the server, polling the vehicle state')
+            finally:
+                with self.lock:
+                    if self.connected:
+                        # Got as far as subscribing, start the backoff over
+                        attempt = 0
+                    self.connected = False
+                    self.states = {}
+                self.websocket = None
+            # Jittered exponential backoff, so a Rivian outage doesn't get a reconnect storm
+            delay = min(self.MAX_BACKOFF, self.BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+            attempt += 1
+            self.stopped.wait(delay)
+
+    def listen(self):
+        rivian = self.rivian
+        if not rivian.user_session_token or not rivian.vehicle_ids:
+            raise SubscriptionError('not logged in to Rivian yet')
+        with connect(self.url, subprotocols=[PROTOCOL], open_timeout=self.ACK_TIMEOUT) as websocket:
+            self.websocket = websocket
+            if self.stopped.is_set():
+                return
+            websocket.send(json.dumps({'type': 'connection_init', 'payload': {
+                'client-name': 'com.rivian.android.consumer',
+                'dc-cid': 'm-android-{}'.format(uuid.uuid4()),
+                'u-sess': rivian.user_session_token
+            }}))
+            message = json.loads(websocket.recv(timeout=self.ACK_TIMEOUT))
+            if message.get('type') != 'connection_ack':
+                raise SubscriptionError('connection not acknowledged: {}'.format(message))
+
+            # Subscription ID -> vehicle ID
+            subscriptions = {}
+            operation = vehicle_state_subscription(tuple(rivian.vehicle_state_fields))
+            for vehicle_id in rivian.vehicle_ids:
+                subscription_id = str(uuid.uuid4())
+                subscriptions[subscription_id] = vehicle_id
+                websocket.send(json.dumps({'id': subscription_id, 'type': 'subscribe',
+                                           'payload': operation.request({'vehicleID': vehicle_id})}))
+            with self.lock:
+                self.states = {vehicle_id: {} for vehicle_id in rivian.vehicle_ids}
+                self.connected = True
+            logger.info('Subscribed to the state of {} Rivian vehicle(s)'.format(len(subscriptions)))
+
+            # Ends when the server closes the websocket (or stop() does)
+            for raw in websocket:
+                message = json.loads(raw)
+                kind = message.get('type')
+                if kind == 'next':
+                    self.apply(subscriptions.get(message.get('id')), message.get('payload') or {})
+                elif kind == 'ping':
+                    websocket.send(json.dumps({'type': 'pong'}))
+                elif kind in ('error', 'complete'):
+                    raise SubscriptionError('subscription {}: {}'.format(kind, message.get('payload')))
+
+    def apply(self, vehicle_id, payload):
+        if payload.get('errors'):
+            raise SubscriptionError('; '.join(error.get('message', '') for error in payload['errors']))
+        data = (payload.get('data') or {}).get('vehicleState') or {}
+        # Updates only carry the fields that changed
+        values = {name: value.get('value') for name, value in data.items() if value is not None}
+        with self.lock:
+            state = self.states.get(vehicle_id)
+            if state is None or not values:
+                return
+            if 'chargerStatus' in state:
+                previous = state['chargerStatus']
+            else:
+                # First update since connecting: compare with what the last cycle saw
+                previous = next((vehicle.charging_status for vehicle in self.rivian.vehicles
+                                 if vehicle.vehicle_id == vehicle_id), None)
+            state.update(values)
+        if values.get('batteryLevel') is not None:
+            Metrics.EV_SOC.set(values['batteryLevel'], vehicle_id)
+        status = values.get('chargerStatus')
+        if previous is None or status is None or (previous in CHARGER_CONNECTED) == (status in CHARGER_CONNECTED):
+            return
+        logger.info('Rivian vehicle {} {}'.format(vehicle_id, 'plugged in' if status in CHARGER_CONNECTED
+                                                   else 'unplugged'))
+        if self.changes is not None:
+            self.changes.set()
@@ -0,0 +1,111 @@
+# Adaptive scheduling of the automation cycles
+
+import logging
+import Clock
+from ChargingAutomation import CycleBranch, get_seconds_until_night_end
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveScheduler:
+    """
+    Picks the delay before the next automation cycle from the outcome of the last one.
+
+    Runs fast while the solar surplus is moving (clouds, large amp changes), backs off while readings are stable,
+    and idles when nothing can change (automation OFF, charger unplugged, solar-only mode at night).
+    Never wakes up for a new cycle before the minimum gap between Rivian schedule writes has passed.
+
+    At night the schedule only changes when a vehicle reaches the night charging limit: while charging, the next cycle
+    is shortly before the projected finish, otherwise at the end of the night. When the Hubitat mode changes don't wake
+    the loop (`mode_events`), these sleeps are no longer than the idle interval.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.stable_cycles = 0
+        self.last_write_time = None
+        # Whether Hubitat switch changes wake the loop (the Hubitat event listener receives the hub's events)
+        self.mode_events = False
+        # Whether the last interval is an idle or night one, when the next cycle needs no grid readings before it
+        self.idle = False
+
+    def get_state(self):
+        return {'stableCycles': self.stable_cycles, 'lastWriteTime': self.last_write_time}
+
+    def restore_state(self, state):
+        self.stable_cycles = state.get('stableCycles', 0)
+        self.last_write_time = state.get('lastWriteTime')
+
+    def next_interval(self, result, now=None):
+        config = self.config
+        now = Clock.time_now() if now is None else now
+
+        self.idle = False
+        if result is None:
+            # Failed cycle: retry at the regular pace
+            self.stable_cycles = 0
+            return config.iteration_time, 'last cycle failed'
+
+        if result.schedule_updated:
+            self.last_write_time = now
+
+        interval, reason = self.pick_interval(result)
+
+        # Keep a minimum gap between Rivian schedule writes
+        if self.last_write_time is not None:
+            write_gap = self.last_write_time + config.min_schedule_write_gap - now
+            if write_gap > interval:
+                interval, reason = write_gap, 'waiting for the minimum gap between schedule writes'
+
+        return round(interval), reason
+
+    def pick_interval(self, result):
+        config = self.config
+
+        if result.branch in (CycleBranch.OFF, CycleBranch.UNPLUGGED, CycleBranch.NIGHT_CHARGING) or result.night:
+            self.idle = True
+        if result.branch == CycleBranch.OFF:
+            self.stable_cycles = 0
+            return config.idle_iteration_time, 'automation is OFF'
+        if result.branch == CycleBranch.UNPLUGGED:
+            self.stable_cycles = 0
+            return config.idle_iteration_time, 'charger not plugged in'
+        if result.branch == CycleBranch.NIGHT_CHARGING:
+            self.stable_cycles = 0
+            if result.night_charging_time is None:
+                return config.iteration_time, 'charging at night'
+            interval = result.night_charging_time - config.night_planner_margin
+            if interval <= config.iteration_time:
+                return config.iteration_time, 'charging at night, almost done'
+            return self.night_interval(interval, 'charging at night, done in {} minutes'.format(
+                round(result.night_charging_time / 60)))
+        if result.night:
+            # Nothing to adjust until the morning (solar-only mode, or charged to the night limit)
+            self.stable_cycles = 0
+            return self.night_interval(get_seconds_until_night_end(config), 'night time')
+
+        spread = result.grid_spread or 0
+        if abs(result.delta_amp) >= config.large_delta_amp or spread >= config.grid_spread_threshold:
+            self.stable_cycles = 0
+            return config.fast_iteration_time, 'solar surplus is changing (delta {}A, spread {}W)'.format(
+                result.delta_amp, round(spread))
+
+        if result.branch == CycleBranch.SMALL_CHANGE:
+            # Stable readings: double the interval with every stable cycle, up to the limit
+            self.stable_cycles += 1
+            interval = min(config.iteration_time * 2 ** (self.stable_cycles - 1), config.stable_iteration_time)
+            return interval, 'stable readings'
+
+        self.stable_cycles = 0
+        return config.iteration_time, 'regular interval'
+
+    def night_interval(self, interval, reason):
+        # Until the end of the night at most, and only until the idle interval if a mode change could go unnoticed
+        config = self.config
+        night_end = get_seconds_until_night_end(config)
+        if interval >= night_end:
+            interval, reason = night_end, reason + ', until the end of the night'
+        if not self.mode_events and interval > config.idle_iteration_time:
+            return config.idle_iteration_time, reason + ', checking the mode every {} seconds'.format(
+                config.idle_iteration_time)
+        return interval, reason
@@ -0,0 +1,267 @@
+# Compact on-disk store for the Enphase readings
+#
+# Each resolution (raw, 1m, 15m, 1d) is an append-only file of fixed-width 12-byte records:
+# int32 timestamp + int16 watts for production, consumption, grid and battery. Rollups are the mean of the readings
+# in each bucket. Range queries binary search a memory-mapped file, so they don't read the whole file.
+# 10-second readings take ~100 KB a day; old raw and 1-minute records are pruned once a day.
+#
+# Usage: python TimeSeriesStore.py [--dir timeseries] [--resolution 15m] [--hours 24]  (prints CSV)
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections import namedtuple
+from datetime import datetime
+import Clock
+import Metrics
+
+logger = logging.getLogger(__name__)
+
+Reading = namedtuple('Reading', ['time', 'production', 'consumption', 'grid', 'battery'])
+
+RECORD = struct.Struct('<i4h')
+INT16_MIN = -2 ** 15
+INT16_MAX = 2 ** 15 - 1
+
+# Resolution name -> bucket size in seconds (0 = raw readings)
+RESOLUTIONS = {'raw': 0, '1m': 60, '15m': 15 * 60, '1d': 24 * 60 * 60}
+DAY = 24 * 60 * 60
+
+
+def to_watts(value):
+    return max(INT16_MIN, min(INT16_MAX, round(value or 0)))
+
+
+def bucket_start(timestamp, size):
+    if size == DAY:
+        # Daily buckets follow the local calendar day
+        day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+        return int(day.timestamp())
+    return timestamp - timestamp % size
+
+
+class SeriesFile:
+    """
+    Append-only file of fixed-width records sorted by time.
+    Appends are buffered and flushed by the store; reads use a memory map of the flushed part.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.map = None
+        self.map_size = 0
+        self.last_time = None
+        last = self.read_last()
+        if last is not None:
+            self.last_time = last.time
+
+    def append(self, reading):
+        # False if the reading isn't newer than the last one
+        if self.last_time is not None and reading.time <= self.last_time:
+            return False
+        self.file.write(RECORD.pack(reading.time, *(to_watts(value) for value in reading[1:])))
+        self.last_time = reading.time
+        return True
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.unmap()
+        self.file.close()
+
+    def unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_size = 0
+
+    def mapped(self):
+        # Memory map of the file, re-mapped when it grew
+        size = os.path.getsize(self.path)
+        size -= size % RECORD.size
+        if size != self.map_size:
+            self.unmap()
+            if size:
+                with open(self.path, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                self.map_size = size
+        return self.map
+
+    def count(self):
+        return self.map_size // RECORD.size
+
+    def time_at(self, index):
+        return struct.unpack_from('<i', self.map, index * RECORD.size)[0]
+
+    def find(self, timestamp):
+        # Index of the first record at or after `timestamp`
+        low, high = 0, self.count()
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read_range(self, start, end):
+        # Records with start <= time < end
+        if self.mapped() is None:
+            return []
+        first = self.find(start)
+        last = self.find(end)
+        return [Reading(*values) for values in
+                RECORD.iter_unpack(self.map[first * RECORD.size:last * RECORD.size])]
+
+    def read_last(self):
+        if self.mapped() is None or not self.count():
+            return None
+        return Reading(*RECORD.unpack_from(self.map, (self.count() - 1) * RECORD.size))
+
+    def prune(self, before):
+        # Drop the records older than `before` by rewriting the file
+        self.flush()
+        if self.mapped() is None:
+            return
+        first = self.find(before)
+        if not first:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(self.map[first * RECORD.size:])
+        self.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'ab')
+        logger.info('Pruned {} old records from {}'.format(first, self.path))
+
+
+class Rollup:
+    # Accumulates the readings of the current bucket of a resolution
+    def __init__(self, size):
+        self.size = size
+        self.start = None
+        self.sums = [0.0] * 4
+        self.count = 0
+
+    def add(self, reading):
+        # Returns the completed bucket's mean reading when `reading` starts a new bucket
+        start = bucket_start(reading.time, self.size)
+        completed = None
+        if self.start is not None and start != self.start and self.count:
+            completed = Reading(self.start, *(value / self.count for value in self.sums))
+        if start != self.start:
+            self.start = start
+            self.sums = [0.0] * 4
+            self.count = 0
+        for i, value in enumerate(reading[1:]):
+            self.sums[i] += value or 0
+        self.count += 1
+        return completed
+
+
+class TimeSeriesStore:
+    def __init__(self, directory='timeseries', raw_retention_days=31, minute_retention_days=90):
+        self.directory = directory
+        self.retention = {'raw': raw_retention_days * DAY, '1m': minute_retention_days * DAY}
+        os.makedirs(directory, exist_ok=True)
+        self.files = {name: SeriesFile(os.path.join(directory, '{}.bin'.format(name))) for name in RESOLUTIONS}
+        self.rollups = {name: Rollup(size) for name, size in RESOLUTIONS.items() if size}
+        self.lock = threading.Lock()
+        self.recover()
+
+    def recover(self):
+        # Rebuild the partial buckets lost at the last shutdown from the next finer resolution
+        source = 'raw'
+        for name, rollup in self.rollups.items():
+            last = self.files[name].last_time
+            since = last + rollup.size if last is not None else 0
+            for reading in self.files[source].read_range(since, 2 ** 31 - 1):
+                completed = rollup.add(reading)
+                if completed is not None:
+                    self.files[name].append(completed)
+            self.files[name].flush()
+            source = name
+
+    def append(self, timestamp, production, consumption, grid, battery):
+        reading = Reading(int(timestamp), production, consumption, grid, battery)
+        with self.lock:
+            if not self.files['raw'].append(reading):
+                # Repeated (the gateway's live data stopped updating) or out of order (e.g. the gateway's clock was set
+                # back): the series must stay sorted by time
+                Metrics.TIMESERIES_REJECTED.inc()
+                last_time = self.files['raw'].last_time
+                log = logger.debug if reading.time == last_time else logger.warning
+                log('Not storing the reading of {}, the last stored one is from {}'.format(
+                    datetime.fromtimestamp(reading.time).isoformat(), datetime.fromtimestamp(last_time).isoformat()))
+                return
+            for name, rollup in self.rollups.items():
+                completed = rollup.add(reading)
+                if completed is None:
+                    break
+                # A completed bucket feeds the next coarser rollup
+                self.files[name].append(completed)
+                reading = completed
+                if name == '1m':
+                    self.flush()
+                if name == '1d':
+                    self.prune(completed.time + DAY)
+
+    def append_stats(self, stats):
+        # Reading from EnphaseAPI.read_live_stats()
+        self.append(stats['reading_time'] or Clock.time_now(), stats['production'], stats['consumption'], stats['grid'],
+                    stats['battery'])
+
+    def flush(self):
+        for series in self.files.values():
+            series.flush()
+
+    def prune(self, now):
+        for name, retention in self.retention.items():
+            self.files[name].prune(now - retention)
+
+    def close(self):
+        with self.lock:
+            for series in self.files.values():
+                series.flush()
+                series.close()
+
+    def query(self, start, end, resolution='raw'):
+        # Readings with start <= time < end (epoch seconds) at the given resolution
+        with self.lock:
+            if resolution == 'raw':
+                self.files['raw'].flush()
+            return self.files[resolution].read_range(int(start), int(end))
+
+    def pick_resolution(self, start, end, max_points=2000, raw_interval=10):
+        # Finest resolution with at most `max_points` readings in the range
+        for name, size in RESOLUTIONS.items():
+            if (end - start) / (size or raw_interval) <= max_points:
+                return name
+        return '1d'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print stored Enphase readings as CSV')
+    parser.add_argument('--dir', default='timeseries', help='store directory')
+    parser.add_argument('--resolution', choices=list(RESOLUTIONS), help='default: picked from the time range')
+    parser.add_argument('--hours', type=float, default=24, help='how many hours back to print')
+    args = parser.parse_args()
+
+    store = TimeSeriesStore(args.dir)
+    end = Clock.time_now()
+    start = end - args.hours * 60 * 60
+    resolution = args.resolution or store.pick_resolution(start, end)
+    print('time,production,consumption,grid,battery')
+    for reading in store.query(start, end, resolution):
+        print('{},{},{},{},{}'.format(datetime.fromtimestamp(reading.time).isoformat(), *reading[1:]))
+    store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# Token store
+#
+# Refreshed tokens and session cookies are kept in their own JSON file instead of config.json (the warm state of
+# main.py --once uses the same store). Files are written atomically: the new contents go to a temporary file that
+# then replaces the old one, so a crash or a full disk can't leave a truncated file behind.
+
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class TokenStore:
+    def __init__(self, path):
+        self.path = path
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error('Ignoring invalid file {}: {}'.format(self.path, e))
+            return {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def update(self, **values):
+        self.data.update(values)
+        write_json_atomic(self.path, self.data)
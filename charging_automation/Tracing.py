@@ -0,0 +1,139 @@
+# Cycle tracing
+#
+# Spans around the service calls and the decisions of each cycle, to see where a slow cycle spent its time. They are
+# written to a local file in the Chrome trace event format (open it in https://ui.perfetto.dev or chrome://tracing).
+# Off unless a trace-file is configured, a span is then a single check. Only spans within a cycle are recorded (not the
+# background Enphase sampling, say). The events are serialized and written by a background thread, and the file
+# rotates at a size limit like a log file.
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Current Tracer (None while tracing is off)
+tracer = None
+# Whether the code runs within a cycle (asyncio.to_thread() passes it on to the worker threads)
+in_cycle = ContextVar('in_cycle', default=False)
+
+
+class TraceFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Writes each record's event as a line of a JSON array. The format allows leaving the array open, so a file can be
+    opened while it's being written, or after a crash.
+    """
+    terminator = ',\n'
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            stream.write('[\n')
+        return stream
+
+    def format(self, record):
+        return json.dumps(record.msg, separators=(',', ':'))
+
+
+class Tracer:
+    def __init__(self, path, max_bytes, backup_count):
+        self.settings = (path, max_bytes, backup_count)
+        self.pid = os.getpid()
+        # Threads whose name was written already
+        self.threads = set()
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(
+            self.queue, TraceFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True))
+        self.listener.start()
+
+    def add(self, event):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.put({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                      'args': {'name': threading.current_thread().name}})
+        event.update(pid=self.pid, tid=tid)
+        self.put(event)
+
+    def put(self, event):
+        self.queue.put(logging.makeLogRecord({'msg': event}))
+
+    def stop(self):
+        # Writes the queued events
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def configure(config):
+    # Starts, restarts or stops tracing to match the config
+    global tracer
+    settings = (config.trace_file, config.trace_max_bytes, config.trace_backup_count) if config.trace_file else None
+    if tracer is not None and tracer.settings == settings:
+        return
+    stop()
+    if settings:
+        logger.info('Tracing cycles to {}'.format(config.trace_file))
+        tracer = Tracer(*settings)
+
+
+def stop():
+    global tracer
+    if tracer is not None:
+        tracer.stop()
+        tracer = None
+
+
+@contextmanager
+def span(name, category='automation', **args):
+    """
+    Records the time spent in the with block. Yields the span's args, to add values known at the end of the block
+    (e.g. the branch a decision took).
+    """
+    current = tracer
+    if current is None or not in_cycle.get():
+        yield args
+        return
+    ts = time.time_ns() // 1000
+    start = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        current.add({'name': name, 'cat': category, 'ph': 'X', 'ts': ts,
+                     'dur': round((time.perf_counter() - start) * 1e6), 'args': args})
+
+
+@contextmanager
+def cycle(**args):
+    # The span of a whole cycle, the spans within it are recorded
+    token = in_cycle.set(True)
+    try:
+        with span('cycle', 'cycle', **args) as cycle_args:
+            yield cycle_args
+    finally:
+        in_cycle.reset(token)
+
+
+def traced(category):
+    # Method decorator: a span around each call
+    def decorator(function):
+        name = function.__qualname__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None or not in_cycle.get():
+                return function(*args, **kwargs)
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,33 +1,200 @@
+import argparse
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 import time
-from ChargingAutomation import run_charging_automation
+import Clock
+from TokenStore import TokenStore
+
+# The automation itself (requests, the API clients, asyncio) is imported by the functions that run cycles,
+# so a --once run that has nothing to do exits without loading it
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_ITERATION_TIME = 10 * 60
+# Warm state of --once runs, and how early a --once run may start before its cycle is due (seconds)
+DEFAULT_STATE_FILE = 'automation-state.json'
+ONCE_SLACK = 10
+
 
 def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s: %(message)s',
-        stream=sys.stdout
-    )
+    # Records are written by a background thread, so slow log I/O (e.g. to an SD card) never holds up a cycle
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    # The queue handler merges the message with its arguments and traceback, the listener's handler adds the rest
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    # Writes the queued records on exit
+    atexit.register(listener.stop)
 
 
-def main():
-    setup_logging()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Rivian solar charging automation')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run the independent requests of each cycle concurrently')
+    parser.add_argument('--once', action='store_true',
+                        help='run a single cycle (if due) and exit, e.g. from a systemd timer or cron')
+    parser.add_argument('--force', action='store_true', help='with --once: run the cycle even if it is not due yet')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help='with --once: where to keep the warm state')
+    return parser.parse_args()
 
-    iteration_time = 10 * 60
 
-    logger.info('Charging Automation Started: run every {} seconds'.format(iteration_time))
+def run_cycle(clients, use_async=False):
+    # One automation cycle, aborted if it doesn't complete within the cycle deadline
+    import requests
+    import Resilience
+    import Tracing
+    from ChargingAutomation import apply_safe_state, get_decision_label, run_charging_automation
 
-    while True:
+    # Pick up config file changes first (only re-read when they changed)
+    clients.reload_config()
+    with Tracing.cycle(use_async=use_async) as span:
         try:
-            run_charging_automation()
-        except Exception as e:
-            logger.error("An error occurred:", e)
-        logger.info('Sleeping for {} seconds...'.format(iteration_time))
-        time.sleep(iteration_time)
+            with Resilience.deadline(clients.config.cycle_deadline):
+                if use_async:
+                    import asyncio
+                    from AsyncChargingAutomation import run_charging_automation_async
+                    result = asyncio.run(run_charging_automation_async(clients))
+                else:
+                    result = run_charging_automation(clients)
+        except requests.RequestException as e:
+            logger.warning('Automation cycle aborted ({}), leaving the charging schedule in a safe state'.format(e))
+            with Tracing.span('apply_safe_state'):
+                apply_safe_state(clients)
+            raise
+        span['branch'] = get_decision_label(result)
+        return result
+
+
+def start_event_listener(clients):
+    # The Hubitat event listener, None if its port can't be opened (the next cycle tries again)
+    from HubitatEvents import EventListener
+    port = clients.hubitat_config.event_port
+    try:
+        return EventListener(clients.hubitat, port, clients.changes)
+    except OSError as e:
+        logger.warning('Cannot listen for Hubitat events on port {} ({}), polling the switches'.format(port, e))
+        return None
+
+
+def run_loop(use_async=False, until=None, on_cycle=None):
+    """
+    Runs automation cycles until the clock reaches `until` (forever if None).
+
+    `on_cycle` is called with the result of every cycle (None if the cycle failed).
+    """
+    import Metrics
+    import Resilience
+    from ChargingAutomation import ServiceClients, record_cycle_metrics
+    from Scheduler import AdaptiveScheduler
+
+    # One set of API clients for the life of the process (sessions and logins are reused across cycles)
+    clients = None
+    scheduler = None
+    # Optional Hubitat event listener, wakes the loop when a switch changes
+    events = None
+
+    try:
+        while until is None or Clock.time_now() < until:
+            result = None
+            start = time.perf_counter()
+            try:
+                if clients is None:
+                    clients = ServiceClients(use_sampler=True, use_subscription=True)
+                    scheduler = AdaptiveScheduler(clients.config)
+                    if clients.config.metrics_port is not None:
+                        Metrics.start_server(clients.config.metrics_port)
+                if events is None and clients.hubitat and clients.hubitat_config.event_port is not None:
+                    events = start_event_listener(clients)
+                result = run_cycle(clients, use_async)
+            except Resilience.ServiceUnavailable as e:
+                # An expected outage (a service down or too slow), the cycle already left a safe state
+                logger.warning('Automation cycle failed: {}'.format(e))
+            except Exception as e:
+                logger.exception('An error occurred: {}'.format(e))
+            if scheduler:
+                scheduler.config = clients.config
+                # The night sleeps are only longer than the idle interval once the hub's events are known to arrive
+                scheduler.mode_events = events is not None and events.is_receiving()
+            record_cycle_metrics(result, time.perf_counter() - start)
+            if on_cycle:
+                on_cycle(result)
+
+            # Without a config there is nothing to adapt to, retry at the default pace
+            iteration_time, reason = scheduler.next_interval(result) if scheduler else (DEFAULT_ITERATION_TIME,
+                                                                                        'not started')
+            logger.info('Sleeping for {} seconds ({})...'.format(iteration_time, reason))
+            if scheduler and scheduler.idle:
+                # Nothing reads the gateway until the next cycle, which resumes the sampler if it needs the grid
+                clients.pause_sampler()
+            if clients is None:
+                Clock.sleep(iteration_time)
+            elif clients.wait_for_changes(iteration_time):
+                logger.info('Woken up by a pushed change, running the next cycle now')
+    finally:
+        if events is not None:
+            events.close()
+        if clients is not None:
+            clients.close()
+
+
+def run_once(use_async=False, state_file=DEFAULT_STATE_FILE, force=False, on_cycle=None):
+    """
+    Runs a single cycle, for installs that start the automation from a timer instead of running it as a service.
+
+    The state a service keeps in memory between cycles is kept in `state_file` instead: when the next cycle is due
+    (the adaptive schedule), the live data stream lease, when production.json was last read and the last Hubitat info.
+    The Rivian and Enphase sessions, vehicle IDs and schedule copies are in their own files already. A run before the
+    next cycle is due exits right away, without loading the automation. Returns False if the cycle failed.
+    `on_cycle` is called with the result of the cycle (None if it failed), not for a run that wasn't due.
+    """
+    state = TokenStore(state_file)
+    start = Clock.time_now()
+    next_cycle_at = state.get('nextCycleAt')
+    if not force and next_cycle_at is not None and start + ONCE_SLACK < next_cycle_at:
+        logger.info('Next cycle due in {} seconds, nothing to do'.format(round(next_cycle_at - start)))
+        return True
+
+    import Resilience
+    from ChargingAutomation import ServiceClients
+    from Scheduler import AdaptiveScheduler
+
+    clients = ServiceClients()
+    scheduler = AdaptiveScheduler(clients.config)
+    clients.restore_state(state.data)
+    scheduler.restore_state(state.get('scheduler', {}))
+    result = None
+    try:
+        result = run_cycle(clients, use_async)
+    except Resilience.ServiceUnavailable as e:
+        logger.warning('Automation cycle failed: {}'.format(e))
+    except Exception as e:
+        logger.exception('An error occurred: {}'.format(e))
+    finally:
+        scheduler.config = clients.config
+        iteration_time, reason = scheduler.next_interval(result)
+        logger.info('Next cycle in {} seconds ({})'.format(iteration_time, reason))
+        # Due relative to the start of this cycle, like a timer firing at a fixed interval
+        state.update(**dict(clients.get_state(), scheduler=scheduler.get_state(), nextCycleAt=start + iteration_time))
+        # The gateway keeps streaming for the rest of the lease, for the next run
+        clients.close(keep_stream=True)
+    if on_cycle:
+        on_cycle(result)
+    return result is not None
+
+
+def main():
+    args = parse_args()
+    setup_logging()
+
+    if args.once:
+        sys.exit(0 if run_once(args.use_async, args.state_file, args.force) else 1)
+    logger.info('Charging Automation Started')
+    run_loop(args.use_async)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+# Offline backtest of the amp controller's constants
+#
+# Usage (from the charging_automation directory):
+#   python -m simulator.Backtest [--store timeseries | --trace day.csv] [--days 30] [--amp-step 1 2 4]
+#       [--deadband 2 3 4 6] [--readings 3 5 9] [--reading-interval 10 20] [--interval 300 600] [--output results.csv]
+#
+# Replays recorded days (the automation's time series store, a simulator trace, or synthetic days) through the
+# reactive controller for every combination of the given constants: the amp rounding step of calculate_delta_amp(),
+# the band of is_delta_amp_too_small(), the number of readings and the seconds between them of the median grid
+# reading, and the seconds between cycles. Reports the solar used by the EV and the home, the grid import, the home
+# battery drain and the schedule writes of each combination. Needs numpy.
+#
+# Simplified model: the EV is plugged in all day and takes all the amps it's given, the charger follows a new
+# schedule right away, and the home battery (up to --battery-power W) covers the imports but never runs empty. Like
+# the automation (which adds the battery discharge back to the grid readings), the controller sees the load before
+# the battery, so it doesn't charge the EV from the battery. The amps only change at decisions, so the energy between two
+# decisions is read from prefix sums per amp level, and the decisions of all days and combinations are stepped
+# together: a year of days and thousands of combinations take seconds.
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from simulator.Model import DAY, CsvTrace, SyntheticTrace
+
+Combination = namedtuple('Combination', ['amp_step', 'deadband', 'readings', 'reading_interval', 'interval'])
+
+# Metric -> True if higher is better
+METRICS = {
+    'ev_kwh': True,
+    'ev_solar_kwh': True,
+    'self_consumed_solar_kwh': True,
+    'grid_import_kwh': False,
+    'battery_drain_kwh': False,
+    'schedule_writes': False,
+}
+
+# Days simulated at once (bounds the memory of the prefix sums)
+CHUNK_DAYS = 32
+
+
+def sample_traces(traces, step):
+    # (solar, house) arrays of shape (days, steps) from simulator traces, one per day
+    offsets = np.arange(0, DAY, step)
+    solar = np.array([[trace.solar(seconds) for seconds in offsets] for trace in traces])
+    house = np.array([[trace.house(seconds) for seconds in offsets] for trace in traces])
+    return solar, house
+
+
+def load_synthetic(days, seed, cloudiness, step):
+    return sample_traces([SyntheticTrace(seed + day, cloudiness=cloudiness) for day in range(days)], step) + (0,)
+
+
+def load_trace(path, step):
+    return sample_traces([CsvTrace(path)], step) + (0,)
+
+
+def load_store(directory, days, step):
+    """
+    The last `days` full days of the automation's time series store, production as the solar and consumption as the
+    house load (consumption includes the EV while the automation was charging it: pick days it wasn't, or expect the
+    house load to be overstated). The home battery's power is the largest discharge recorded.
+    """
+    from TimeSeriesStore import TimeSeriesStore
+    if not os.path.isdir(directory):
+        raise ValueError('No time series store in {}'.format(directory))
+    today = datetime.combine(date.today(), datetime.min.time())
+    starts = np.array([(today - timedelta(days=days - day)).timestamp() for day in range(days)])
+    store = TimeSeriesStore(directory)
+    try:
+        readings = np.array(store.query(starts[0], today.timestamp()), dtype=float).reshape(-1, 5)
+    finally:
+        store.close()
+    # Days without a reading are left out, gaps within a day are interpolated
+    counts = np.histogram(readings[:, 0], bins=np.append(starts, today.timestamp()))[0]
+    if not counts.any():
+        raise ValueError('No readings in {} for the last {} days'.format(directory, days))
+    times = starts[counts > 0, None] + np.arange(0, DAY, step)[None, :]
+    solar = np.interp(times, readings[:, 0], readings[:, 1])
+    house = np.interp(times, readings[:, 0], readings[:, 2])
+    return solar, house, max(0, readings[:, 4].max())
+
+
+def prefix_sums(values, hours):
+    # Cumulative energy (Wh) along the last axis, starting at 0
+    sums = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,), dtype=np.float32)
+    np.cumsum(values * hours, axis=-1, out=sums[..., 1:])
+    return sums
+
+
+def median_readings(net, steps, readings, interval):
+    # Median of the `readings` values `interval` steps apart ending at each of `steps` (clipped at the first step)
+    shifted = [net[:, np.maximum(steps - i * interval, 0)] for i in range(readings)]
+    return np.median(np.stack(shifted), axis=0)
+
+
+def backtest_chunk(solar, house, combinations, battery_power, amps_min, amps_max, volts, step):
+    days, steps = solar.shape
+    hours = step / 3600
+    # Home load before the EV and the battery (W)
+    net = house - solar
+
+    def grid(load):
+        # The battery covers imports up to its power
+        return load - np.clip(load, 0, battery_power)
+
+    totals = {name: np.zeros((days, len(combinations))) for name in METRICS}
+    # Whole days without the EV, the decisions only change the hours with sun
+    no_ev = grid(net)
+    totals['grid_import_kwh'] += np.maximum(no_ev, 0).sum(axis=1, keepdims=True) * hours / 1000
+    totals['battery_drain_kwh'] += (net - no_ev).clip(0).sum(axis=1, keepdims=True) * hours / 1000
+    solar_kwh = solar.sum(axis=1, keepdims=True) * hours / 1000
+    sunny = np.flatnonzero(solar.max(axis=0) > 0)
+    if not len(sunny):
+        totals['self_consumed_solar_kwh'] += solar_kwh
+        return totals
+
+    # Medians are taken over the whole day (the first readings of the window come before sunrise)
+    window = slice(sunny[0], sunny[-1] + 1)
+    reading_schedules = sorted({(c.readings, c.reading_interval // step) for c in combinations})
+    medians = np.stack([median_readings(net, np.arange(steps)[window], readings, interval)
+                        for readings, interval in reading_schedules])
+    net = net[:, window]
+    steps = net.shape[1]
+
+    # Energy prefix sums per amp level over the sunny hours: imports (after the battery), battery drain, exports
+    levels = np.array([0] + list(range(amps_min, amps_max + 1)))
+    level_index = np.zeros(amps_max + 1, dtype=int)
+    level_index[levels] = np.arange(len(levels))
+    imports = np.empty((len(levels), days, steps + 1), dtype=np.float32)
+    drains = np.empty_like(imports)
+    exports = np.empty_like(imports)
+    for i, amps in enumerate(levels):
+        load = net + amps * volts
+        imports[i] = prefix_sums(np.maximum(grid(load), 0), hours)
+        drains[i] = prefix_sums(np.clip(load, 0, battery_power), hours)
+        exports[i] = prefix_sums(np.maximum(-load, 0), hours)
+    # The sunny hours without the EV were counted already
+    totals['grid_import_kwh'] -= imports[0, :, -1:] / 1000
+    totals['battery_drain_kwh'] -= drains[0, :, -1:] / 1000
+
+    amp_step = np.array([c.amp_step for c in combinations])
+    deadband = np.array([c.deadband for c in combinations])
+    interval = np.array([c.interval // step for c in combinations])
+    schedule = np.array([reading_schedules.index((c.readings, c.reading_interval // step)) for c in combinations])
+    day = np.arange(days)[:, None]
+    amps = np.zeros((days, len(combinations)), dtype=int)
+    ev = np.zeros((days, len(combinations)))
+    writes = np.zeros((days, len(combinations)), dtype=int)
+    energy = {'imports': np.zeros_like(ev), 'drains': np.zeros_like(ev), 'exports': np.zeros_like(ev)}
+    at = np.zeros(len(combinations), dtype=int)
+    while (at < steps).any():
+        active = at < steps
+        start = np.minimum(at, steps)
+        end = np.minimum(at + interval, steps)
+        # calculate_delta_amp() and is_delta_amp_too_small() on the median grid reading with the current amps
+        # (including the battery discharge)
+        reading = medians[schedule, day, np.minimum(at, steps - 1)] + amps * volts
+        delta = (-np.ceil(reading / volts / amp_step) * amp_step).astype(int)
+        new_amps = amps + delta
+        new_amps = np.where(new_amps > amps_max, amps_max, np.where(new_amps < amps_min, 0, new_amps))
+        new_amps = np.where((np.abs(delta) < deadband) | ~active, amps, new_amps)
+        writes += new_amps != amps
+        amps = new_amps
+        level = level_index[amps]
+        for name, sums in (('imports', imports), ('drains', drains), ('exports', exports)):
+            energy[name] += sums[level, day, end] - sums[level, day, start]
+        ev += amps * volts * (end - start) * hours
+        at += interval
+
+    totals['grid_import_kwh'] += energy['imports'] / 1000
+    totals['battery_drain_kwh'] += energy['drains'] / 1000
+    totals['self_consumed_solar_kwh'] += solar_kwh - energy['exports'] / 1000
+    totals['ev_kwh'] += ev / 1000
+    # What the EV took from the grid and the battery: the difference to not charging at all
+    totals['ev_solar_kwh'] += (ev - (energy['imports'] - imports[0, :, -1:]) -
+                               (energy['drains'] - drains[0, :, -1:])) / 1000
+    totals['schedule_writes'] += writes
+    return totals
+
+
+def backtest(solar, house, combinations, battery_power=0, amps_min=8, amps_max=48, volts=240, step=10):
+    """
+    Replays the days of `solar` and `house` (W, shape (days, steps), one value every `step` seconds) for each
+    Combination. Returns {metric: array with the total of each combination}.
+    """
+    totals = {name: np.zeros(len(combinations)) for name in METRICS}
+    for first in range(0, len(solar), CHUNK_DAYS):
+        chunk = slice(first, first + CHUNK_DAYS)
+        results = backtest_chunk(solar[chunk], house[chunk], combinations, battery_power, amps_min, amps_max,
+                                 volts, step)
+        for name, values in results.items():
+            totals[name] += values.sum(axis=0)
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator.Backtest',
+                                     description='Backtest the amp controller constants on recorded days')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--store', help='time series store directory of the automation (timeseries-dir)')
+    source.add_argument('--trace', help='CSV file of a recorded day with time,solar,house columns')
+    parser.add_argument('--days', type=int, default=30, help='days to replay (last days of the store, or synthetic)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the first synthetic day')
+    parser.add_argument('--cloudiness', type=float, default=0.3, help='synthetic clouds, 0 (clear) to 1')
+    parser.add_argument('--step', type=int, default=10, help='seconds between replayed values')
+    parser.add_argument('--amp-step', type=int, nargs='+', default=[2], help='amp rounding steps to try')
+    parser.add_argument('--deadband', type=int, nargs='+', default=[3], help='smallest amp changes to try')
+    parser.add_argument('--readings', type=int, nargs='+', default=[5], help='readings per median to try')
+    parser.add_argument('--reading-interval', type=int, nargs='+', default=[10],
+                        help='seconds between readings to try (multiples of --step)')
+    parser.add_argument('--interval', type=int, nargs='+', default=[300],
+                        help='seconds between cycles to try (multiples of --step)')
+    parser.add_argument('--amps-min', type=int, default=8)
+    parser.add_argument('--amps-max', type=int, default=48)
+    parser.add_argument('--volts', type=float, default=240)
+    parser.add_argument('--battery-power', type=float,
+                        help='most watts the home battery discharges (default: the largest recorded, 0 otherwise)')
+    parser.add_argument('--sort', choices=sorted(METRICS), default='ev_solar_kwh', help='metric to rank by')
+    parser.add_argument('--top', type=int, default=10, help='number of combinations to print')
+    parser.add_argument('--output', help='write every combination as CSV to this file')
+    args = parser.parse_args(argv)
+    for name in ('reading_interval', 'interval'):
+        if any(value <= 0 or value % args.step for value in getattr(args, name)):
+            parser.error('--{} must be multiples of --step'.format(name.replace('_', '-')))
+    return args
+
+
+def print_results(combinations, totals, sort, top):
+    order = np.argsort(totals[sort], kind='stable')
+    if METRICS[sort]:
+        order = order[::-1]
+    print(','.join(Combination._fields + tuple(METRICS)))
+    for i in order[:top]:
+        print(','.join([str(value) for value in combinations[i]] +
+                       ['{:.2f}'.format(totals[name][i]) if name.endswith('_kwh') else str(int(totals[name][i]))
+                        for name in METRICS]))
+
+
+def main_backtest(argv=None):
+    args = parse_args(argv)
+    start = time.perf_counter()
+    if args.store:
+        try:
+            solar, house, battery_power = load_store(args.store, args.days, args.step)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif args.trace:
+        solar, house, battery_power = load_trace(args.trace, args.step)
+    else:
+        solar, house, battery_power = load_synthetic(args.days, args.seed, args.cloudiness, args.step)
+    if args.battery_power is not None:
+        battery_power = args.battery_power
+    loaded = time.perf_counter()
+
+    combinations = [Combination(*values) for values in itertools.product(
+        args.amp_step, args.deadband, args.readings, args.reading_interval, args.interval)]
+    totals = backtest(solar, house, combinations, battery_power, args.amps_min, args.amps_max, args.volts, args.step)
+    print('{} combinations over {} days in {:.1f}s (loading took {:.1f}s)'.format(
+        len(combinations), len(solar), time.perf_counter() - loaded, loaded - start), file=sys.stderr)
+
+    print_results(combinations, totals, args.sort, args.top)
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(Combination._fields + tuple(METRICS))
+            for i, combination in enumerate(combinations):
+                writer.writerow(list(combination) + [round(float(totals[name][i]), 3) if name.endswith('_kwh')
+                                                     else int(totals[name][i]) for name in METRICS])
+
+
+if __name__ == '__main__':
+    main_backtest()
@@ -0,0 +1,284 @@
+# Benchmark of the automation cycle against the local stand-in servers
+#
+# Usage (from the charging_automation directory):
+#   python -m simulator.Benchmark [--scenario solar-ramp ...] [--async] [--output results.json]
+#
+# Reports, per scenario, the wall-clock cycle latency with the time spent waiting on each service, the number of
+# HTTP requests and the request / response bytes per service and cycle, and the peak RSS. Each scenario runs in a
+# process of its own, so its peak RSS isn't the highest of the scenarios before it.
+# Requests made by background tasks (the Enphase sampler) are reported separately from the cycle's own requests.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import requests
+
+import Clock
+from ChargingAutomation import ServiceClients
+from main import run_cycle
+from Scheduler import AdaptiveScheduler
+from simulator.Simulation import Simulation, day_start, load_trace
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = {
+    'unplugged': {'start_hour': 10, 'hours': 2, 'plugged_in': (0, 0)},
+    'night-charging': {'start_hour': 0, 'hours': 4, 'battery_level': 30, 'night_charging_limit': 80},
+    'solar-ramp': {'start_hour': 7, 'hours': 4, 'cloudiness': 0},
+    'cloudy-oscillation': {'start_hour': 11, 'hours': 3, 'cloudiness': 1},
+    'derated-charger': {'start_hour': 10, 'hours': 3, 'derate_amps': 16},
+    'two-vehicles': {'start_hour': 9, 'hours': 4, 'vehicles': 2, 'battery_level': [30, 60]},
+    'enphase-outage': {'start_hour': 10, 'hours': 3, 'outages': [('enphase', 11, 11.5)]},
+    'long-run': {'start_hour': 0, 'hours': 24},
+}
+
+# A fixed day, so results are comparable between runs
+BENCHMARK_DATE = date(2024, 6, 21)
+
+
+def new_counters():
+    return {'requests': 0, 'sent_bytes': 0, 'received_bytes': 0, 'time': 0.0}
+
+
+class RequestRecorder:
+    """
+    Counts the requests, bytes on the wire and time spent per service by wrapping requests.Session.send
+    for the duration of a benchmark (every client uses its own requests session).
+    """
+
+    def __init__(self, simulation):
+        self.clock = simulation.clock
+        self.services = {server.url: server.name for server in simulation.servers}
+        self.lock = threading.Lock()
+        self.cycle = defaultdict(new_counters)
+        self.background = defaultdict(new_counters)
+        self.original_send = None
+
+    def __enter__(self):
+        recorder = self
+        original_send = self.original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            start = time.perf_counter()
+            response = original_send(session, request, **kwargs)
+            recorder.record(request, response, time.perf_counter() - start)
+            return response
+
+        requests.Session.send = send
+        return self
+
+    def __exit__(self, *exc_info):
+        requests.Session.send = self.original_send
+
+    def service(self, url):
+        for prefix, name in self.services.items():
+            if url.startswith(prefix):
+                return name
+        return 'other'
+
+    @staticmethod
+    def request_size(request):
+        path = request.path_url
+        size = len('{} {} HTTP/1.1\r\n'.format(request.method, path))
+        size += sum(len(name) + len(value) + 4 for name, value in request.headers.items()) + 2
+        body = request.body or b''
+        return size + len(body)
+
+    @staticmethod
+    def response_size(response):
+        size = len('HTTP/1.1 {} {}\r\n'.format(response.status_code, response.reason))
+        size += sum(len(name) + len(value) + 4 for name, value in response.raw.headers.items()) + 2
+        # Content-Length is the size on the wire (before decompression)
+        length = response.headers.get('Content-Length')
+        return size + (int(length) if length is not None else len(response.content))
+
+    def record(self, request, response, elapsed):
+        scope = self.background if self.clock.current_task() else self.cycle
+        with self.lock:
+            counters = scope[self.service(request.url)]
+            counters['requests'] += 1
+            counters['sent_bytes'] += self.request_size(request)
+            counters['received_bytes'] += self.response_size(response)
+            counters['time'] += elapsed
+
+    def take_cycle(self):
+        # Counters of the cycle that just completed
+        with self.lock:
+            cycle, self.cycle = self.cycle, defaultdict(new_counters)
+        return dict(cycle)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 2)
+
+
+def memory_usage():
+    usage = {'peak_rss_kb': None, 'rss_kb': None}
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes elsewhere
+        usage['peak_rss_kb'] = peak // 1024 if sys.platform == 'darwin' else peak
+    try:
+        with open('/proc/self/statm') as f:
+            usage['rss_kb'] = int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, AttributeError):
+        pass
+    return usage
+
+
+def summarize(cycles, background, services):
+    latencies = [cycle['latency'] for cycle in cycles]
+    summary = {
+        'cycles': len(cycles),
+        'failed_cycles': sum(cycle['failed'] for cycle in cycles),
+        'latency_ms': {
+            'first': milliseconds(latencies[0]),
+            'mean': milliseconds(statistics.fmean(latencies)),
+            'p50': milliseconds(percentile(latencies, 0.5)),
+            'p95': milliseconds(percentile(latencies, 0.95)),
+            'max': milliseconds(max(latencies)),
+        },
+        'per_cycle': {},
+        'background': {},
+    }
+    for service in services:
+        counters = [cycle['services'].get(service, new_counters()) for cycle in cycles]
+        summary['per_cycle'][service] = {
+            'requests': round(statistics.fmean(c['requests'] for c in counters), 2),
+            'sent_bytes': round(statistics.fmean(c['sent_bytes'] for c in counters)),
+            'received_bytes': round(statistics.fmean(c['received_bytes'] for c in counters)),
+            'time_ms': milliseconds(statistics.fmean(c['time'] for c in counters)),
+        }
+        if service in background:
+            counters = background[service]
+            summary['background'][service] = {
+                'requests': counters['requests'],
+                'sent_bytes': counters['sent_bytes'],
+                'received_bytes': counters['received_bytes'],
+                'time_ms': milliseconds(counters['time']),
+            }
+    return summary
+
+
+def run_scenario(name, scenario, use_async=False):
+    trace = load_trace(cloudiness=scenario.get('cloudiness', 0.3))
+    simulation = Simulation(day_start(BENCHMARK_DATE, scenario['start_hour']), trace,
+                            battery_level=scenario.get('battery_level', 40),
+                            plugged_in=scenario.get('plugged_in', (0, 24)),
+                            night_charging_limit=scenario.get('night_charging_limit', 50),
+                            derate_amps=scenario.get('derate_amps'), vehicles=scenario.get('vehicles', 1),
+                            outages=scenario.get('outages', ()))
+    cycles = []
+    wall_start = time.perf_counter()
+    with simulation, RequestRecorder(simulation) as recorder:
+        clients = ServiceClients(use_sampler=True)
+        scheduler = AdaptiveScheduler(clients.config)
+        until = simulation.until(scenario['hours'])
+        try:
+            while Clock.time_now() < until:
+                start = time.perf_counter()
+                try:
+                    result = run_cycle(clients, use_async)
+                except Exception as e:
+                    logger.info('Cycle failed: {}'.format(e))
+                    result = None
+                latency = time.perf_counter() - start
+                cycles.append({'latency': latency, 'failed': result is None, 'services': recorder.take_cycle()})
+                interval = scheduler.next_interval(result)[0]
+                # Like main.run_loop()
+                if scheduler.idle:
+                    clients.pause_sampler()
+                Clock.sleep(interval)
+        finally:
+            clients.close()
+        background = dict(recorder.background)
+
+    summary = summarize(cycles, background, [server.name for server in simulation.servers])
+    summary['wall_time_s'] = round(time.perf_counter() - wall_start, 2)
+    summary['simulation'] = simulation.summary()
+    summary.update(memory_usage())
+    logger.info('{}: {} cycles, mean latency {} ms'.format(name, summary['cycles'], summary['latency_ms']['mean']))
+    return summary
+
+
+def setup_logging(verbose=False):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s: %(message)s', stream=sys.stderr)
+    if verbose:
+        logger.setLevel(logging.INFO)
+
+
+def run_scenario_process(name, use_async=False, verbose=False):
+    # Runs in the scenario's own process
+    setup_logging(verbose)
+    return run_scenario(name, SCENARIOS[name], use_async)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator.Benchmark',
+                                     description='Benchmark the automation cycle against local stand-in servers')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (default: all), can be repeated')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='benchmark the async automation cycle')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show progress')
+    return parser.parse_args(argv)
+
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.verbose)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'async': args.use_async,
+        'scenarios': {},
+    }
+    # A fresh process per scenario (spawned, not forked, so it starts without the memory of the previous ones)
+    context = multiprocessing.get_context('spawn')
+    for name in args.scenario or SCENARIOS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results['scenarios'][name] = executor.submit(run_scenario_process, name, args.use_async,
+                                                         args.verbose).result()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,295 @@
+# Simulated home: solar, house load, EV and the meters the gateway reports
+
+import bisect
+import csv
+import math
+import random
+import threading
+from datetime import datetime
+
+DAY = 24 * 60 * 60
+VOLTS = 240
+
+WEEK_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def parse_time_of_day(value):
+    # '13:45', '13:45:30' or seconds since midnight
+    if ':' in value:
+        parts = [float(part) for part in value.split(':')]
+        return sum(part * 60 ** (2 - i) for i, part in enumerate(parts + [0] * (3 - len(parts))))
+    return float(value)
+
+
+class SyntheticTrace:
+    """
+    Clear-sky solar curve with random passing clouds, and a house load with a base load, a cycling fridge
+    and morning / evening peaks. The same seed gives the same day.
+    """
+
+    def __init__(self, seed=1, peak_solar=7000, sunrise=6.5, sunset=19.5, cloudiness=0.3, base_load=350):
+        self.peak_solar = peak_solar
+        self.sunrise = sunrise * 3600
+        self.sunset = sunset * 3600
+        self.base_load = base_load
+        rng = random.Random(seed)
+        # Per-minute cloud attenuation: a two-state (clear / cloudy) chain, clouds last a few minutes
+        self.clouds = []
+        cloudy = False
+        for _ in range(DAY // 60 + 1):
+            if cloudy:
+                cloudy = rng.random() > 0.25
+            else:
+                cloudy = rng.random() < cloudiness * 0.1
+            self.clouds.append(rng.uniform(0.2, 0.6) if cloudy else 1.0)
+        self.noise = [rng.uniform(-100, 100) for _ in range(DAY // 60 + 1)]
+
+    @staticmethod
+    def interpolate(values, seconds):
+        minute, fraction = divmod(seconds % DAY / 60, 1)
+        minute = int(minute)
+        return values[minute] + (values[minute + 1] - values[minute]) * fraction
+
+    def solar(self, seconds):
+        seconds %= DAY
+        if not self.sunrise < seconds < self.sunset:
+            return 0
+        clear_sky = self.peak_solar * math.sin(math.pi * (seconds - self.sunrise) / (self.sunset - self.sunrise)) ** 1.2
+        return clear_sky * self.interpolate(self.clouds, seconds)
+
+    def house(self, seconds):
+        seconds %= DAY
+        hour = seconds / 3600
+        load = self.base_load + self.interpolate(self.noise, seconds)
+        # Fridge compressor: 15 minutes every 45
+        if seconds % (45 * 60) < 15 * 60:
+            load += 150
+        if 7 <= hour < 8:
+            load += 1500
+        if 18 <= hour < 21:
+            load += 1200
+        return max(load, 0)
+
+    def ev(self, seconds):
+        # Synthetic EV draw follows the charging schedule
+        return None
+
+
+class CsvTrace:
+    """
+    Recorded day replayed from a CSV file with the columns: time (HH:MM[:SS] or seconds since midnight),
+    solar and house (W), and optionally ev (W) to replay a recorded EV draw instead of following the schedule.
+    Values are interpolated between rows.
+    """
+
+    def __init__(self, path):
+        self.times = []
+        self.columns = {'solar': [], 'house': [], 'ev': []}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                self.times.append(parse_time_of_day(row['time']))
+                for name, values in self.columns.items():
+                    value = row.get(name)
+                    values.append(float(value) if value not in (None, '') else None)
+        if not self.times:
+            raise ValueError('Empty trace: {}'.format(path))
+
+    def value(self, name, seconds):
+        values = self.columns[name]
+        seconds %= DAY
+        i = bisect.bisect_right(self.times, seconds)
+        if i == 0:
+            return values[0]
+        if i == len(self.times):
+            return values[-1]
+        t0, t1 = self.times[i - 1], self.times[i]
+        v0, v1 = values[i - 1], values[i]
+        if v0 is None or v1 is None:
+            return v0
+        return v0 + (v1 - v0) * (seconds - t0) / (t1 - t0)
+
+    def solar(self, seconds):
+        return self.value('solar', seconds)
+
+    def house(self, seconds):
+        return self.value('house', seconds)
+
+    def ev(self, seconds):
+        return self.value('ev', seconds)
+
+
+class EvModel:
+    """
+    One EV: its charging schedules, the amps its charger draws and its battery.
+    The charger follows the active schedule after a short response delay, up to `derate_amps` when it's derated.
+    """
+
+    def __init__(self, vehicle_id, battery_capacity=135, battery_level=40, plugged_in=(0, 24), derate_amps=None):
+        self.vehicle_id = vehicle_id
+        # kWh, %
+        self.battery_capacity = battery_capacity
+        self.battery_level = battery_level
+        # Hours of the day the car is plugged in
+        self.plugged_in = plugged_in
+        # Most amps a derated charger draws (None: not derated)
+        self.derate_amps = derate_amps
+        self.schedules = [{
+            "startTime": 0,
+            "duration": 1440,
+            "location": {"latitude": 37.7749, "longitude": -122.4194},
+            "amperage": 48,
+            "enabled": True,
+            "weekDays": list(WEEK_DAYS)
+        }]
+        self.schedule_writes = 0
+        self.amps = None
+        self.pending_amps = None
+        self.pending_since = None
+
+
+class HomeModel:
+    """
+    Integrates the energy flows of the simulated home up to the simulated time of every request.
+
+    Each EV draws the amps of its active charging schedule (after a short charger response delay) while plugged in and
+    not full, up to its `derate_amps` when the charger is derated. Grid is positive when importing.
+    Without `evs`, the home has one EV made from the remaining arguments.
+    """
+
+    def __init__(self, clock, trace, battery_capacity=135, battery_level=40, plugged_in=(0, 24),
+                 response_delay=30, derate_amps=None, evs=None):
+        self.clock = clock
+        self.trace = trace
+        self.evs = evs or [EvModel('SIM-VEHICLE-1', battery_capacity, battery_level, plugged_in, derate_amps)]
+        # Seconds the charger takes to follow a schedule change
+        self.response_delay = response_delay
+        self.lock = threading.Lock()
+        self.time = clock.time()
+        now = clock.now()
+        self.day_start = self.time - (now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6)
+        for ev in self.evs:
+            ev.amps = self.schedule_amps(ev, self.time)
+        # Energy totals (Wh)
+        self.totals = {'solar': 0.0, 'house': 0.0, 'ev': 0.0, 'ev_from_grid': 0.0, 'grid_import': 0.0,
+                       'grid_export': 0.0}
+
+    @property
+    def schedule_writes(self):
+        return sum(ev.schedule_writes for ev in self.evs)
+
+    def get_ev(self, vehicle_id):
+        for ev in self.evs:
+            if ev.vehicle_id == vehicle_id:
+                return ev
+        raise KeyError(vehicle_id)
+
+    def seconds_of_day(self, t):
+        return (t - self.day_start) % DAY
+
+    def is_plugged_in(self, ev, t):
+        hour = self.seconds_of_day(t) / 3600
+        start, end = ev.plugged_in
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def schedule_amps(self, ev, t):
+        seconds = self.seconds_of_day(t)
+        minute = seconds / 60
+        week_day = WEEK_DAYS[datetime.fromtimestamp(t).weekday()]
+        for schedule in ev.schedules:
+            if not schedule['enabled'] or week_day not in schedule['weekDays']:
+                continue
+            start = schedule['startTime']
+            if start <= minute < start + schedule['duration'] or minute < start + schedule['duration'] - 1440:
+                return schedule['amperage']
+        return 0
+
+    def ev_power(self, ev, t):
+        # A recorded EV draw replaces the first EV
+        recorded = self.trace.ev(self.seconds_of_day(t)) if ev is self.evs[0] else None
+        if recorded is not None:
+            return recorded
+        if not self.is_plugged_in(ev, t) or ev.battery_level >= 100:
+            return 0
+        amps = ev.amps if ev.derate_amps is None else min(ev.amps, ev.derate_amps)
+        return amps * VOLTS
+
+    def powers(self, t):
+        seconds = self.seconds_of_day(t)
+        solar = self.trace.solar(seconds)
+        house = self.trace.house(seconds)
+        evs = [self.ev_power(ev, t) for ev in self.evs]
+        return solar, house, evs, house + sum(evs) - solar
+
+    def update(self):
+        # Integrate from the last update to the current simulated time, in steps of up to a minute
+        with self.lock:
+            now = self.clock.time()
+            while self.time < now:
+                step = min(60, now - self.time)
+                for ev in self.evs:
+                    if ev.pending_since is not None and self.time >= ev.pending_since + self.response_delay:
+                        ev.amps = ev.pending_amps
+                        ev.pending_since = None
+                    elif ev.pending_since is not None:
+                        step = min(step, ev.pending_since + self.response_delay - self.time)
+                solar, house, evs, grid = self.powers(self.time)
+                hours = step / 3600
+                self.totals['solar'] += solar * hours
+                self.totals['house'] += house * hours
+                self.totals['ev'] += sum(evs) * hours
+                self.totals['ev_from_grid'] += min(sum(evs), max(grid, 0)) * hours
+                self.totals['grid_import'] += max(grid, 0) * hours
+                self.totals['grid_export'] += max(-grid, 0) * hours
+                for ev, power in zip(self.evs, evs):
+                    ev.battery_level = min(100.0, ev.battery_level + power * hours / 1000 / ev.battery_capacity * 100)
+                self.time += step
+                for ev in self.evs:
+                    self.follow_schedule(ev)
+
+    def follow_schedule(self, ev):
+        # The charger picks up a new schedule (or the schedule's time window starting / ending) after a delay
+        amps = self.schedule_amps(ev, self.time)
+        if amps != ev.amps and amps != ev.pending_amps:
+            ev.pending_amps = amps
+            ev.pending_since = self.time
+        elif amps == ev.amps:
+            ev.pending_since = None
+            ev.pending_amps = None
+
+    def meters(self):
+        self.update()
+        with self.lock:
+            solar, house, evs, grid = self.powers(self.time)
+            return {'time': self.time, 'production': solar, 'consumption': house + sum(evs), 'grid': grid,
+                    'battery': 0}
+
+    def charger_status(self, vehicle_id):
+        self.update()
+        with self.lock:
+            ev = self.get_ev(vehicle_id)
+            if not self.is_plugged_in(ev, self.time):
+                return 'chrgr_sts_not_connected'
+            if self.ev_power(ev, self.time) > 0:
+                return 'chrgr_sts_connected_charging'
+            return 'chrgr_sts_connected_no_chrg'
+
+    def get_charging_power(self, vehicle_id):
+        self.update()
+        with self.lock:
+            return self.ev_power(self.get_ev(vehicle_id), self.time)
+
+    def get_battery_level(self, vehicle_id):
+        self.update()
+        return self.get_ev(vehicle_id).battery_level
+
+    def get_schedules(self, vehicle_id):
+        with self.lock:
+            return [dict(schedule) for schedule in self.get_ev(vehicle_id).schedules]
+
+    def set_schedules(self, vehicle_id, schedules):
+        self.update()
+        with self.lock:
+            ev = self.get_ev(vehicle_id)
+            ev.schedules = [dict(schedule) for schedule in schedules]
+            ev.schedule_writes += 1
+            self.follow_schedule(ev)
@@ -0,0 +1,507 @@
+# Local HTTP stand-ins for the Enphase gateway, the Rivian GraphQL API and the Hubitat Maker API
+
+import gzip
+import hashlib
+import json
+import logging
+import re
+import secrets
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, without waiting for delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.server.name, format % args))
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        if self.server.is_down():
+            # Outage: every request fails with 503 Service Unavailable
+            self.read_body()
+            self.send_body(503, b'')
+            self.wfile.flush()
+            return False
+        return True
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def read_json(self):
+        body = self.read_body()
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            return None
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.server.count_request()
+        if 'gzip' in (self.headers.get('Accept-Encoding') or '') and len(body) > 0:
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(status, json.dumps(data).encode('utf-8'), headers=headers)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    name = 'stand-in'
+
+    def __init__(self, handler_class, model):
+        super().__init__(('127.0.0.1', 0), handler_class)
+        self.model = model
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        self.thread = None
+        # (start, end) timestamps of simulated outages
+        self.outages = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def is_down(self):
+        now = self.model.clock.time()
+        return any(start <= now < end for start, end in self.outages)
+
+    def count_request(self):
+        with self.requests_lock:
+            self.requests += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=self.name, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class EnphaseHandler(StandInHandler):
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path == '/auth/check_jwt':
+            if self.headers.get('Authorization') != 'Bearer ' + self.server.token:
+                return self.send_body(401, b'<!DOCTYPE html><h2>Invalid token.</h2>\n', 'text/html')
+            session_id = self.server.new_session()
+            return self.send_body(200, b'<!DOCTYPE html><h2>Valid token.</h2>\n', 'text/html',
+                                  {'Set-Cookie': 'sessionId={}; Path=/'.format(session_id)})
+        if not self.server.is_authorized(self.headers.get('Cookie')):
+            self.read_body()
+            return self.send_body(401, b'')
+        if path == '/ivp/livedata/stream':
+            data = self.read_json() or {}
+            return self.send_json(self.server.set_stream(bool(data.get('enable'))))
+        self.send_body(404, b'')
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if not self.server.is_authorized(self.headers.get('Cookie')):
+            return self.send_body(401, b'')
+        if path == '/ivp/livedata/status':
+            return self.send_json(self.server.live_data())
+        if path == '/production.json':
+            return self.send_json(self.server.production())
+        self.send_body(404, b'')
+
+
+class EnphaseServer(StandInServer):
+    """
+    IQ Gateway: JWT login with a session cookie, live data (which stops updating 10 minutes after the stream was
+    enabled, like the real gateway) and production.json.
+    """
+    name = 'enphase'
+    # The gateway stops refreshing live data this long after the stream was enabled
+    STREAM_DURATION = 10 * 60
+
+    def __init__(self, model, token):
+        super().__init__(EnphaseHandler, model)
+        self.token = token
+        self.sessions = set()
+        self.stream_enabled_until = None
+        self.last_meters = None
+
+    def new_session(self):
+        session_id = secrets.token_hex(16)
+        self.sessions.add(session_id)
+        return session_id
+
+    def is_authorized(self, cookie):
+        match = re.search(r'sessionId=(\w+)', cookie or '')
+        return bool(match) and match.group(1) in self.sessions
+
+    def set_stream(self, enable):
+        now = self.model.clock.time()
+        self.stream_enabled_until = now + self.STREAM_DURATION if enable else None
+        return {'sc_stream': 'enabled' if enable else 'disabled'}
+
+    def live_data(self):
+        meters = self.model.meters()
+        # Without an active stream the values freeze
+        if self.stream_enabled_until is None or meters['time'] > self.stream_enabled_until:
+            meters = self.last_meters or meters
+        self.last_meters = meters
+        return {
+            'connection': {'sc_stream': 'enabled' if self.stream_enabled_until else 'disabled'},
+            'meters': {
+                'last_update': int(meters['time']),
+                'pv': {'agg_p_mw': round(meters['production'] * 1000)},
+                'storage': {'agg_p_mw': round(meters['battery'] * 1000)},
+                'grid': {'agg_p_mw': round(meters['grid'] * 1000)},
+                'load': {'agg_p_mw': round(meters['consumption'] * 1000)}
+            }
+        }
+
+    def production(self):
+        meters = self.model.meters()
+        reading_time = int(meters['time'])
+        return {
+            'production': [
+                {'type': 'inverters', 'wNow': round(meters['production'])},
+                {'type': 'eim', 'measurementType': 'production', 'wNow': meters['production'],
+                 'readingTime': reading_time}
+            ],
+            'consumption': [
+                {'type': 'eim', 'measurementType': 'total-consumption', 'wNow': meters['consumption'],
+                 'readingTime': reading_time},
+                {'type': 'eim', 'measurementType': 'net-consumption', 'wNow': meters['grid'],
+                 'readingTime': reading_time}
+            ],
+            'storage': [{'type': 'acb', 'wNow': meters['battery']}]
+        }
+
+
+def graphql_error(message, code):
+    return {'errors': [{'message': message, 'extensions': {'code': code}}], 'data': None}
+
+
+class RivianHandler(StandInHandler):
+    def do_POST(self):
+        request = self.read_json()
+        if request is None:
+            return self.send_json(graphql_error('Invalid JSON', 'BAD_REQUEST'), 400)
+        self.send_json(self.server.execute(request, self.headers))
+
+
+class RivianServer(StandInServer):
+    """
+    Rivian GraphQL gateway: login, vehicle state, live charging session data and charging schedules of the model's
+    vehicles. Supports Apollo persisted queries and gzip compressed responses.
+
+    With `subscriptions`, also serves the vehicle state subscription over a websocket (graphql-transport-ws, needs
+    the websockets package). push_vehicle_states() sends the subscribers the values that changed.
+    """
+    name = 'rivian'
+    SUBSCRIPTION_PATH = '/gql-consumer-subscriptions/graphql'
+
+    def __init__(self, model, user, password, live_session=True, subscriptions=False):
+        super().__init__(RivianHandler, model)
+        self.user = user
+        self.password = password
+        # Whether getLiveSessionData reports the charging power
+        self.live_session = live_session
+        self.app_sessions = set()
+        self.user_sessions = set()
+        # sha256 -> query text of the registered persisted queries
+        self.persisted_queries = {}
+        self.operations = {}
+        self.subscriptions = subscriptions
+        self.subscription_server = None
+        # Subscribed vehicles: {'websocket', 'id', 'vehicle_id', 'fields', 'sent': last values sent}
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        # Websocket -> event set when it answers a ping
+        self.pongs = {}
+        self.updates = 0
+
+    @property
+    def subscription_url(self):
+        return 'ws://127.0.0.1:{}{}'.format(self.subscription_server.socket.getsockname()[1], self.SUBSCRIPTION_PATH)
+
+    def start(self):
+        if self.subscriptions:
+            from websockets.sync.server import serve
+            self.subscription_server = serve(self.serve_subscription, '127.0.0.1', 0)
+            threading.Thread(target=self.subscription_server.serve_forever, name='rivian-subscriptions',
+                             daemon=True).start()
+        return super().start()
+
+    def stop(self):
+        if self.subscription_server is not None:
+            self.subscription_server.shutdown()
+        super().stop()
+
+    def resolve_query(self, request):
+        # Returns (query text, error)
+        query = request.get('query')
+        persisted = ((request.get('extensions') or {}).get('persistedQuery') or {}).get('sha256Hash')
+        if persisted:
+            if query is None:
+                query = self.persisted_queries.get(persisted)
+                if query is None:
+                    return None, graphql_error('PersistedQueryNotFound', 'PERSISTED_QUERY_NOT_FOUND')
+            elif hashlib.sha256(query.encode('utf-8')).hexdigest() != persisted:
+                return None, graphql_error('provided sha does not match query', 'INTERNAL_SERVER_ERROR')
+            else:
+                self.persisted_queries[persisted] = query
+        if not query:
+            return None, graphql_error('Must provide query string.', 'BAD_REQUEST')
+        return query, None
+
+    def execute(self, request, headers):
+        query, error = self.resolve_query(request)
+        if error:
+            return error
+        name = request.get('operationName')
+        variables = request.get('variables') or {}
+        self.operations[name] = self.operations.get(name, 0) + 1
+
+        if name == 'CreateCSRFToken':
+            app_session = secrets.token_hex(16)
+            self.app_sessions.add(app_session)
+            return {'data': {'createCsrfToken': {'__typename': 'CreateCsrfTokenResponse',
+                                                 'csrfToken': secrets.token_hex(16), 'appSessionToken': app_session}}}
+        if name == 'Login':
+            if headers.get('a-sess') not in self.app_sessions:
+                return graphql_error('Unauthenticated', 'UNAUTHENTICATED')
+            if variables.get('email') != self.user or variables.get('password') != self.password:
+                return graphql_error('Bad credentials', 'BAD_CURRENT_PASSWORD')
+            user_session = secrets.token_hex(16)
+            self.user_sessions.add(user_session)
+            return {'data': {'login': {'__typename': 'MobileLoginResponse', 'accessToken': secrets.token_hex(16),
+                                       'refreshToken': secrets.token_hex(16), 'userSessionToken': user_session}}}
+
+        if headers.get('u-sess') not in self.user_sessions:
+            return graphql_error('Unauthenticated', 'UNAUTHENTICATED')
+
+        if name == 'getUserInfo':
+            return {'data': {'currentUser': {'vehicles': [{'id': ev.vehicle_id} for ev in self.model.evs]}}}
+        if name == 'getUserId':
+            return {'data': {'currentUser': {'id': 'SIM-USER-1'}}}
+
+        vehicle_id = variables.get('vehicleId') or variables.get('vehicleID')
+        if vehicle_id not in {ev.vehicle_id for ev in self.model.evs}:
+            return graphql_error('Vehicle not found: {}'.format(vehicle_id), 'NOT_FOUND')
+        if name == 'GetVehicleState':
+            return {'data': {'vehicleState': self.vehicle_state(vehicle_id, query)}}
+        if name == 'getLiveSessionData':
+            return {'data': {'getLiveSessionData': self.live_session_data(vehicle_id)}}
+        if name == 'GetChargingSchedule':
+            return {'data': {'getVehicle': {'chargingSchedules': self.model.get_schedules(vehicle_id)}}}
+        if name == 'SetChargingSchedule':
+            self.model.set_schedules(vehicle_id, variables['chargingSchedules'])
+            return {'data': {'setChargingSchedules': {'success': True}}}
+        return graphql_error('Unknown operation: {}'.format(name), 'GRAPHQL_VALIDATION_FAILED')
+
+    def vehicle_state_values(self, vehicle_id):
+        charger_status = self.model.charger_status(vehicle_id)
+        return {
+            'chargerStatus': charger_status,
+            'batteryLevel': round(self.model.get_battery_level(vehicle_id), 1),
+            'batteryLimit': 100,
+            'chargerState': 'charging_active' if charger_status.endswith('_charging') else 'charging_ready',
+            'chargerDerateStatus': 'NONE' if self.model.get_ev(vehicle_id).derate_amps is None else 'DERATED',
+        }
+
+    def vehicle_state(self, vehicle_id, query, values=None):
+        values = self.vehicle_state_values(vehicle_id) if values is None else values
+        time_stamp = datetime.fromtimestamp(self.model.clock.time(), timezone.utc).isoformat()
+        # Only the requested { timeStamp value } fields
+        fields = re.findall(r'(\w+) \{ timeStamp value \}', query)
+        return {field: {'timeStamp': time_stamp, 'value': values.get(field)} for field in fields}
+
+    def serve_subscription(self, websocket):
+        from websockets.exceptions import ConnectionClosed
+        self.pongs[websocket] = threading.Event()
+        try:
+            message = json.loads(websocket.recv(timeout=10))
+            if self.is_down():
+                return websocket.close(1013, 'Service unavailable')
+            if message.get('type') != 'connection_init' or \
+                    (message.get('payload') or {}).get('u-sess') not in self.user_sessions:
+                return websocket.close(4403, 'Forbidden')
+            websocket.send(json.dumps({'type': 'connection_ack'}))
+            for raw in websocket:
+                message = json.loads(raw)
+                kind = message.get('type')
+                if kind == 'subscribe':
+                    self.subscribe(websocket, message.get('id'), message.get('payload') or {})
+                elif kind == 'ping':
+                    websocket.send(json.dumps({'type': 'pong'}))
+                elif kind == 'pong':
+                    self.pongs[websocket].set()
+                elif kind == 'complete':
+                    with self.subscribers_lock:
+                        self.subscribers = [
+                            subscriber for subscriber in self.subscribers
+                            if (subscriber['websocket'], subscriber['id']) != (websocket, message.get('id'))]
+        except (ConnectionClosed, TimeoutError, ValueError):
+            pass
+        finally:
+            with self.subscribers_lock:
+                self.subscribers = [subscriber for subscriber in self.subscribers
+                                    if subscriber['websocket'] is not websocket]
+            del self.pongs[websocket]
+
+    def subscribe(self, websocket, subscription_id, payload):
+        query, error = self.resolve_query(payload)
+        vehicle_id = (payload.get('variables') or {}).get('vehicleID')
+        if not error and vehicle_id not in {ev.vehicle_id for ev in self.model.evs}:
+            error = graphql_error('Vehicle not found: {}'.format(vehicle_id), 'NOT_FOUND')
+        if error:
+            return websocket.send(json.dumps({'id': subscription_id, 'type': 'error', 'payload': error['errors']}))
+        self.operations['VehicleState'] = self.operations.get('VehicleState', 0) + 1
+        subscriber = {'websocket': websocket, 'id': subscription_id, 'vehicle_id': vehicle_id, 'query': query,
+                      'sent': {}}
+        with self.subscribers_lock:
+            self.subscribers.append(subscriber)
+            # The current state first, then only the changes
+            self.send_changes(subscriber)
+
+    def send_changes(self, subscriber):
+        values = self.vehicle_state_values(subscriber['vehicle_id'])
+        state = self.vehicle_state(subscriber['vehicle_id'], subscriber['query'], values)
+        sent = subscriber['sent']
+        changed = {field: value for field, value in state.items()
+                   if field not in sent or sent[field] != value['value']}
+        if not changed:
+            return False
+        subscriber['websocket'].send(json.dumps({'id': subscriber['id'], 'type': 'next',
+                                                 'payload': {'data': {'vehicleState': changed}}}))
+        subscriber['sent'].update({field: value['value'] for field, value in changed.items()})
+        self.updates += 1
+        return True
+
+    def push_vehicle_states(self):
+        # Sends the subscribers the state values that changed, then pings the websockets: the clients answer after
+        # reading the updates, so their effects are in place before the simulated time moves on
+        from websockets.exceptions import ConnectionClosed
+        with self.subscribers_lock:
+            websockets = {subscriber['websocket'] for subscriber in self.subscribers}
+            if self.is_down():
+                for websocket in websockets:
+                    websocket.close(1012, 'Service restart')
+                return
+            updated = set()
+            for subscriber in self.subscribers:
+                try:
+                    if self.send_changes(subscriber):
+                        updated.add(subscriber['websocket'])
+                except ConnectionClosed:
+                    pass
+        for websocket in updated:
+            pong = self.pongs.get(websocket)
+            try:
+                pong.clear()
+                websocket.send(json.dumps({'type': 'ping'}))
+            except (AttributeError, ConnectionClosed):
+                continue
+            pong.wait(5)
+
+    def live_session_data(self, vehicle_id):
+        updated_at = datetime.fromtimestamp(self.model.clock.time(), timezone.utc).isoformat()
+        power = round(self.model.get_charging_power(vehicle_id) / 1000, 2) if self.live_session else None
+        return {'power': {'value': power, 'updatedAt': updated_at}}
+
+
+class HubitatHandler(StandInHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        token = (parse_qs(url.query).get('access_token') or [None])[0]
+        parts = [unquote(part) for part in url.path.split('/')]
+        # /apps/api/{app id}/devices/...
+        if parts[1:3] != ['apps', 'api'] or len(parts) < 5 or parts[4] != 'devices':
+            return self.send_body(404, b'')
+        if parts[3] != self.server.api_id or token != self.server.token:
+            return self.send_body(401, b'')
+        devices = self.server.devices
+        if parts[5:] == ['all']:
+            return self.send_json([self.server.device_summary(device_id) for device_id in devices])
+        device_id = parts[5] if len(parts) > 5 else None
+        if device_id not in devices:
+            return self.send_body(404, b'')
+        if len(parts) == 6:
+            return self.send_json(self.server.device_details(device_id))
+        if len(parts) == 8 and parts[6] == 'setVariable':
+            self.server.info_updates += 1
+            self.server.set_attribute(device_id, 'variable', parts[7])
+            return self.send_json(self.server.device_details(device_id))
+        self.send_body(404, b'')
+
+
+class HubitatServer(StandInServer):
+    """
+    Hubitat Maker API with the automation switch, the night charging switch (with a level for the charging limit)
+    and the info variable device. With an `event_url`, every attribute change is POSTed there like the Maker API does.
+    """
+    name = 'hubitat'
+
+    def __init__(self, model, api_id='1', token='sim-token', automation_on=True, night_charging=True,
+                 night_charging_limit=50):
+        super().__init__(HubitatHandler, model)
+        self.api_id = api_id
+        self.token = token
+        self.devices = {
+            '101': {'switch': 'on' if automation_on else 'off'},
+            '102': {'switch': 'on' if night_charging else 'off', 'level': night_charging_limit},
+            '103': {'variable': ''},
+        }
+        self.info_updates = 0
+        self.event_url = None
+        self.events = 0
+
+    def set_attribute(self, device_id, name, value):
+        self.devices[device_id][name] = value
+        if self.event_url:
+            event = {'content': {'name': name, 'value': str(value), 'displayName': 'Device {}'.format(device_id),
+                                 'deviceId': device_id, 'descriptionText': None, 'unit': None, 'type': None,
+                                 'data': None}}
+            request = Request(self.event_url, json.dumps(event).encode('utf-8'),
+                              {'Content-Type': 'application/json'})
+            try:
+                with urlopen(request, timeout=5):
+                    self.events += 1
+            except OSError as e:
+                logger.warning('Failed to post Hubitat event: {}'.format(e))
+
+    def device_summary(self, device_id):
+        return {'id': device_id, 'name': 'Device {}'.format(device_id), 'label': 'Device {}'.format(device_id),
+                'attributes': dict(self.devices[device_id])}
+
+    def device_details(self, device_id):
+        return {'id': device_id, 'name': 'Device {}'.format(device_id), 'label': 'Device {}'.format(device_id),
+                'attributes': [{'name': name, 'currentValue': value}
+                               for name, value in self.devices[device_id].items()]}
+
+    def config(self):
+        # Contents of hubitat-config.json pointing at this stand-in
+        return {
+            'host': self.url,
+            'api-id': self.api_id,
+            'token': self.token,
+            'automation-on-switch-id': '101',
+            'night-charge-switch-id': '102',
+            'info-device-id': '103'
+        }
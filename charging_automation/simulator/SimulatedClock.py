@@ -0,0 +1,104 @@
+# Simulated clock
+#
+# Time only moves when the automation sleeps or waits. Periodic tasks (e.g. the Enphase sampler) run as timers
+# inside those sleeps, in the sleeping thread, so a simulated day is deterministic and runs as fast as the
+# requests to the stand-in servers allow.
+
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedTask:
+    def __init__(self, clock, name, interval, function):
+        self.clock = clock
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class SimulatedClock:
+    def __init__(self, start):
+        # start: datetime (local time) the simulation begins at
+        self.current = start.timestamp()
+        self.timers = []
+        self.sequence = itertools.count()
+        # Serializes time advances when several threads sleep (e.g. the async cycle's worker threads)
+        self.lock = threading.RLock()
+        # Task being run by the current thread (e.g. to tell background requests from the cycle's own)
+        self.local = threading.local()
+
+    def time(self):
+        return self.current
+
+    def monotonic(self):
+        return self.current
+
+    def now(self):
+        return datetime.fromtimestamp(self.current)
+
+    def sleep(self, seconds):
+        self.advance(self.current + max(seconds, 0))
+
+    def wait(self, event, timeout=None):
+        # Like event.wait(timeout): runs timers until one of them sets the event or the timeout passes
+        if event.is_set():
+            return True
+        if timeout is None and not self.timers:
+            raise RuntimeError('Waiting without a timeout while no simulated task can set the event')
+        self.advance(float('inf') if timeout is None else self.current + max(timeout, 0), event)
+        return event.is_set()
+
+    def start_periodic(self, name, interval, function):
+        # Like SystemClock.start_periodic(): the first run is due immediately
+        task = SimulatedTask(self, name, interval, function)
+        self.schedule(task, self.current)
+        return task
+
+    def call_at(self, when, name, function):
+        # Runs `function` once at the simulated time `when`, like a periodic task that stops after its first run
+        task = SimulatedTask(self, name, 0, None)
+
+        def run_once():
+            task.stop()
+            function()
+
+        task.function = run_once
+        self.schedule(task, when)
+        return task
+
+    def current_task(self):
+        return getattr(self.local, 'task', None)
+
+    def schedule(self, task, due):
+        heapq.heappush(self.timers, (due, next(self.sequence), task))
+
+    def advance(self, until, event=None):
+        with self.lock:
+            while self.timers and self.timers[0][0] <= until:
+                due, _, task = heapq.heappop(self.timers)
+                if task.stopped:
+                    continue
+                self.current = max(self.current, due)
+                self.local.task = task
+                try:
+                    task.function()
+                except Exception as e:
+                    # Same as a failing PeriodicTask: report and keep the schedule
+                    logger.error('{} failed: {}'.format(task.name, e))
+                finally:
+                    self.local.task = None
+                if not task.stopped:
+                    self.schedule(task, self.current + task.interval)
+                if event is not None and event.is_set():
+                    return
+            if until != float('inf'):
+                self.current = max(self.current, until)
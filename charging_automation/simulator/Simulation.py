@@ -0,0 +1,168 @@
+# Simulated home with the stand-in servers, config files and the simulated clock wired together
+
+import json
+import os
+import socket
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+
+import Clock
+from simulator.Model import CsvTrace, EvModel, HomeModel, SyntheticTrace
+from simulator.Servers import EnphaseServer, HubitatServer, RivianServer
+from simulator.SimulatedClock import SimulatedClock
+
+GATEWAY_SN = '122100000000'
+
+
+def create_enphase_token():
+    # A gateway token the Enphase library accepts (the signature is not verified locally)
+    now = int(time.time())
+    return jwt.encode({
+        'aud': GATEWAY_SN,
+        'iss': 'Entrez',
+        'enphaseUser': 'owner',
+        'exp': now + 365 * 24 * 60 * 60,
+        'iat': now,
+        'jti': str(uuid.uuid4()),
+        'username': 'simulator@example.com'
+    }, 'simulator', algorithm='HS256')
+
+
+class Simulation:
+    """
+    Installs a simulated clock starting at `start` (datetime), starts the stand-in servers and, while entered as a
+    context manager, works in a scratch directory holding config.json and hubitat-config.json that point at them.
+    With several `vehicles`, `battery_level` can be a list with each vehicle's level.
+    `outages` are (service, from hour, until hour) periods a stand-in server is down.
+    `switch_changes` are (hour, switch, value) changes of the Hubitat switches, pushed to the automation's event
+    listener with `hubitat_events`.
+    With `rivian_subscription`, the automation subscribes to the vehicle state, which is pushed every minute.
+    """
+    # Hubitat devices of the switch_changes: switch name -> (device ID, attribute)
+    SWITCHES = {'automation': ('101', 'switch'), 'night-charging': ('102', 'switch'), 'night-limit': ('102', 'level')}
+
+    def __init__(self, start, trace=None, battery_level=40, plugged_in=(0, 24), automation_on=True,
+                 night_charging=True, night_charging_limit=50, derate_amps=None, live_session=True, vehicles=1,
+                 outages=(), config=None, switch_changes=(), hubitat_events=False, rivian_subscription=False):
+        self.start = start
+        self.clock = SimulatedClock(start)
+        self.trace = trace or SyntheticTrace()
+        levels = battery_level if isinstance(battery_level, (list, tuple)) else [battery_level]
+        evs = [EvModel('SIM-VEHICLE-{}'.format(i + 1), battery_level=levels[min(i, len(levels) - 1)],
+                       plugged_in=plugged_in, derate_amps=derate_amps) for i in range(vehicles)]
+        self.model = HomeModel(self.clock, self.trace, evs=evs)
+        self.token = create_enphase_token()
+        self.enphase = EnphaseServer(self.model, self.token)
+        self.rivian = RivianServer(self.model, 'simulator@example.com', 'simulator', live_session=live_session,
+                                   subscriptions=rivian_subscription)
+        self.hubitat = HubitatServer(self.model, automation_on=automation_on, night_charging=night_charging,
+                                     night_charging_limit=night_charging_limit)
+        self.servers = [self.enphase, self.rivian, self.hubitat]
+        for service, start_hour, end_hour in outages:
+            self.add_outage(service, start_hour, end_hour)
+        for hour, switch, value in switch_changes:
+            self.add_switch_change(hour, switch, value)
+        self.event_port = find_free_port() if hubitat_events else None
+        # Extra config.json settings
+        self.config = config or {}
+        self.directory = None
+        self.working_directory = None
+
+    def add_outage(self, service, start_hour, end_hour):
+        # The service answers every request with 503 between these hours of the simulated day
+        day = self.start.replace(hour=0, minute=0, second=0, microsecond=0)
+        servers = {server.name: server for server in self.servers}
+        if service not in servers:
+            raise ValueError('Unknown service: {} (one of {})'.format(service, ', '.join(servers)))
+        server = servers[service]
+        server.outages.append(((day + timedelta(hours=start_hour)).timestamp(),
+                               (day + timedelta(hours=end_hour)).timestamp()))
+
+    def add_switch_change(self, hour, switch, value):
+        # The Hubitat switch ('on' / 'off', or the night charging limit) changes at this hour of the simulated day
+        if switch not in self.SWITCHES:
+            raise ValueError('Unknown switch: {} (one of {})'.format(switch, ', '.join(self.SWITCHES)))
+        device_id, attribute = self.SWITCHES[switch]
+        day = self.start.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.clock.call_at((day + timedelta(hours=hour)).timestamp(), 'hubitat-{}'.format(switch),
+                           lambda: self.hubitat.set_attribute(device_id, attribute, value))
+
+    def write_config(self):
+        config = {
+            'rivian-user': self.rivian.user,
+            'rivian-pass': self.rivian.password,
+            'rivian-host': self.rivian.url,
+            'enphase-token': self.token,
+            'enphase-gateway-sn': GATEWAY_SN,
+            'enphase-gateway-host': self.enphase.url,
+            'night-time-start': 24,
+            'night-time-end': 7
+        }
+        if self.rivian.subscriptions:
+            config['rivian-vehicle-subscription'] = True
+            config['rivian-subscription-url'] = self.rivian.subscription_url
+        config.update(self.config)
+        with open(os.path.join(self.directory.name, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=4)
+        hubitat_config = self.hubitat.config()
+        if self.event_port is not None:
+            hubitat_config['event-port'] = self.event_port
+            self.hubitat.event_url = 'http://127.0.0.1:{}/'.format(self.event_port)
+        with open(os.path.join(self.directory.name, 'hubitat-config.json'), 'w') as f:
+            json.dump(hubitat_config, f, indent=2)
+
+    def __enter__(self):
+        Clock.install(self.clock)
+        for server in self.servers:
+            server.start()
+        if self.rivian.subscriptions:
+            self.clock.start_periodic('rivian-vehicle-state', 60, self.rivian.push_vehicle_states)
+        # Config, session and schedule files live in a scratch directory
+        self.directory = tempfile.TemporaryDirectory(prefix='charging-simulator-')
+        self.write_config()
+        self.working_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.chdir(self.working_directory)
+        self.directory.cleanup()
+        for server in self.servers:
+            server.stop()
+        Clock.install(Clock.SystemClock())
+        self.model.update()
+
+    def until(self, hours):
+        return self.clock.time() + hours * 60 * 60
+
+    def summary(self):
+        # Energy in kWh
+        totals = {name: value / 1000 for name, value in self.model.totals.items()}
+        totals['ev_from_solar'] = totals['ev'] - totals['ev_from_grid']
+        return {
+            'start': self.start.isoformat(),
+            'end': self.clock.now().isoformat(),
+            'energy_kwh': {name: round(value, 3) for name, value in totals.items()},
+            'battery_levels': {ev.vehicle_id: round(ev.battery_level, 1) for ev in self.model.evs},
+            'schedule_writes': self.model.schedule_writes,
+            'requests': {server.name: server.requests for server in self.servers},
+            'subscription_updates': self.rivian.updates
+        }
+
+
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def load_trace(path=None, seed=1, peak_solar=7000, cloudiness=0.3):
+    return CsvTrace(path) if path else SyntheticTrace(seed, peak_solar, cloudiness=cloudiness)
+
+
+def day_start(day, hour=0):
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
@@ -0,0 +1,2 @@
+# Simulator: runs the charging automation against local stand-ins for the Enphase gateway, the Rivian API and the
+# Hubitat hub, on a simulated clock. Run from the charging_automation directory: python -m simulator --help
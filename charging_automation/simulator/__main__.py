@@ -0,0 +1,126 @@
+# Runs a simulated day of the charging automation against the local stand-in servers
+#
+# Usage (from the charging_automation directory):
+#   python -m simulator [--date 2024-06-21] [--hours 24] [--trace day.csv] [--cloudiness 0.3] [--async]
+#   python -m simulator --once 90 [--once-cold]      (main.py --once started from a timer)
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import date
+
+import Clock
+import main
+from simulator.Simulation import Simulation, day_start, load_trace
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator', description='Simulated day of the charging automation')
+    parser.add_argument('--date', type=date.fromisoformat, default=date.today(), help='simulated day (YYYY-MM-DD)')
+    parser.add_argument('--start-hour', type=float, default=0, help='hour of the day the simulation starts at')
+    parser.add_argument('--hours', type=float, default=24, help='simulated duration')
+    parser.add_argument('--trace', help='CSV file with recorded time,solar,house[,ev] values to replay')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic trace')
+    parser.add_argument('--peak-solar', type=float, default=7000, help='synthetic solar peak (W)')
+    parser.add_argument('--cloudiness', type=float, default=0.3, help='synthetic clouds, 0 (clear) to 1')
+    parser.add_argument('--vehicles', type=int, default=1, help='number of EVs on the Rivian account')
+    parser.add_argument('--battery-level', type=float, nargs='+', default=[40],
+                        help='EV battery level at the start (%%), one per vehicle or one for all')
+    parser.add_argument('--plugged-in', type=float, nargs=2, default=(0, 24), metavar=('FROM', 'UNTIL'),
+                        help='hours of the day the EV is plugged in')
+    parser.add_argument('--solar-only', action='store_true', help='turn the night charging switch off')
+    parser.add_argument('--automation-off', action='store_true', help='turn the automation switch off')
+    parser.add_argument('--night-charging-limit', type=int, default=50, help='night charging limit (%%)')
+    parser.add_argument('--derate-amps', type=int, help='derated charger: most amps the EV draws')
+    parser.add_argument('--no-live-session', dest='live_session', action='store_false',
+                        help='Rivian live charging session data without the charging power')
+    parser.add_argument('--outage', action='append', default=[], nargs=3, metavar=('SERVICE', 'FROM', 'UNTIL'),
+                        type=str, help='stand-in server (enphase, rivian, hubitat) down between these hours, '
+                                       'can be repeated')
+    parser.add_argument('--switch', action='append', default=[], nargs=3, metavar=('HOUR', 'SWITCH', 'VALUE'),
+                        help='Hubitat switch (automation, night-charging: on / off, night-limit: %%) changing at '
+                             'this hour, can be repeated')
+    parser.add_argument('--hubitat-events', action='store_true',
+                        help='push the Hubitat events to the automation instead of it polling the hub')
+    parser.add_argument('--rivian-subscription', action='store_true',
+                        help='push the vehicle state to the automation over a websocket instead of it polling Rivian')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='run the async automation cycle')
+    parser.add_argument('--once', type=float, metavar='SECONDS',
+                        help='start main.py --once from a timer firing every SECONDS instead of running the service')
+    parser.add_argument('--once-cold', action='store_true',
+                        help='with --once: remove the state file before every run')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', type=parse_setting,
+                        help='config.json setting, e.g. --set controller=predictive (JSON values), can be repeated')
+    parser.add_argument('--verbose', action='store_true', help='show the automation log')
+    return parser.parse_args(argv)
+
+
+def parse_setting(setting):
+    key, _, value = setting.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def run_timer(args, until, on_cycle):
+    # Like a systemd timer with OnUnitActiveSec: each run starts `args.once` seconds after the previous one started
+    runs = 0
+    while Clock.time_now() < until:
+        start = Clock.time_now()
+        if args.once_cold and os.path.exists(main.DEFAULT_STATE_FILE):
+            os.remove(main.DEFAULT_STATE_FILE)
+        main.run_once(args.use_async, on_cycle=on_cycle)
+        runs += 1
+        Clock.sleep(max(0.0, start + args.once - Clock.time_now()))
+    return runs
+
+
+def print_summary(summary, cycles, failures, wall_time, runs=None):
+    energy = summary['energy_kwh']
+    print('Simulated {} - {} in {:.1f}s'.format(summary['start'], summary['end'], wall_time))
+    if runs is not None:
+        print('Timer runs: {}'.format(runs))
+    print('Cycles: {} ({} failed), schedule writes: {}'.format(cycles, failures, summary['schedule_writes']))
+    print('Solar: {:.2f} kWh, house: {:.2f} kWh, grid import: {:.2f} kWh, grid export: {:.2f} kWh'.format(
+        energy['solar'], energy['house'], energy['grid_import'], energy['grid_export']))
+    print('EV: {:.2f} kWh ({:.2f} kWh from solar, {:.2f} kWh from the grid), battery level {}'.format(
+        energy['ev'], energy['ev_from_solar'], energy['ev_from_grid'],
+        ', '.join('{:.1f}%'.format(level) for level in summary['battery_levels'].values())))
+    print('Requests: {}'.format(', '.join('{} {}'.format(name, count) for name, count in summary['requests'].items())))
+    if summary['subscription_updates']:
+        print('Rivian subscription updates: {}'.format(summary['subscription_updates']))
+
+
+def main_simulator(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s: %(message)s', stream=sys.stdout)
+
+    simulation = Simulation(day_start(args.date, args.start_hour),
+                            load_trace(args.trace, args.seed, args.peak_solar, args.cloudiness),
+                            battery_level=args.battery_level, plugged_in=tuple(args.plugged_in),
+                            automation_on=not args.automation_off, night_charging=not args.solar_only,
+                            night_charging_limit=args.night_charging_limit, derate_amps=args.derate_amps,
+                            live_session=args.live_session, vehicles=args.vehicles,
+                            outages=[(service, float(start), float(end)) for service, start, end in args.outage],
+                            config=dict(args.set), hubitat_events=args.hubitat_events,
+                            rivian_subscription=args.rivian_subscription,
+                            switch_changes=[(float(hour), switch, value) for hour, switch, value in args.switch])
+    results = []
+    runs = None
+    wall_start = time.monotonic()
+    with simulation:
+        if args.once:
+            runs = run_timer(args, simulation.until(args.hours), results.append)
+        else:
+            main.run_loop(args.use_async, until=simulation.until(args.hours), on_cycle=results.append)
+
+    print_summary(simulation.summary(), len(results), results.count(None), time.monotonic() - wall_start, runs)
+
+
+if __name__ == '__main__':
+    main_simulator()
@@ -0,0 +1,79 @@
+# Hubitat event listener and the night sleeps
+#
+#   python -m unittest discover tests        (from charging_automation/)
+
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from datetime import datetime
+from types import SimpleNamespace
+
+import Clock
+from ChargingAutomation import AutomationMode, CycleBranch, CycleResult
+from HubitatAPI import HubitatAPI
+from HubitatEvents import EventListener
+from Scheduler import AdaptiveScheduler
+from simulator.SimulatedClock import SimulatedClock
+
+IDLE_ITERATION_TIME = 1800
+
+SCHEDULER_CONFIG = SimpleNamespace(iteration_time=600, idle_iteration_time=IDLE_ITERATION_TIME,
+                                   min_schedule_write_gap=180, night_time_start=22, night_time_end=6)
+
+HUBITAT_CONFIG = SimpleNamespace(host='http://127.0.0.1', api_id=1, token='token', on_switch_id=1,
+                                 night_charge_switch_id=2, info_device_id=3, cache_ttl=60, info_refresh_interval=1800,
+                                 event_resync_interval=3600)
+
+
+class NightSleepTest(unittest.TestCase):
+    def setUp(self):
+        self.system_clock = Clock.clock
+        # 23:00, charged to the night limit: nothing to do until the end of the night at 06:00
+        Clock.install(SimulatedClock(datetime(2024, 6, 21, 23)))
+        self.hubitat = HubitatAPI(HUBITAT_CONFIG)
+        self.listener = EventListener(self.hubitat, 0, threading.Event(), host='127.0.0.1')
+        self.scheduler = AdaptiveScheduler(SCHEDULER_CONFIG)
+
+    def tearDown(self):
+        self.listener.close()
+        self.hubitat.session.close()
+        Clock.install(self.system_clock)
+
+    def night_interval(self):
+        # Like run_loop(): the listener only lifts the cap once the hub's events arrive
+        self.scheduler.mode_events = self.listener.is_receiving()
+        result = CycleResult(AutomationMode.DEFAULT, CycleBranch.SMALL_CHANGE)
+        result.night = True
+        return self.scheduler.next_interval(result)[0]
+
+    def post_event(self, device_id, name, value):
+        body = json.dumps({'content': {'deviceId': device_id, 'name': name, 'value': value}}).encode()
+        url = 'http://127.0.0.1:{}/'.format(self.listener.server.server_address[1])
+        with urllib.request.urlopen(urllib.request.Request(url, data=body, method='POST')) as response:
+            self.assertEqual(response.status, 200)
+
+    def test_listener_without_events_keeps_the_idle_cap(self):
+        # The listener runs, but the Maker API posts no events (e.g. no POST URL configured)
+        self.assertFalse(self.listener.is_receiving())
+        self.assertEqual(self.night_interval(), IDLE_ITERATION_TIME)
+
+    def test_unresolved_hub_keeps_the_idle_cap(self):
+        # Events are refused while the hub's address is unknown
+        self.listener.hub_address = None
+        self.hubitat.host = 'http://hub.invalid'
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.post_event(1, 'switch', 'on')
+        self.assertEqual(error.exception.code, 403)
+        self.assertFalse(self.listener.is_receiving())
+        self.assertEqual(self.night_interval(), IDLE_ITERATION_TIME)
+
+    def test_accepted_event_lifts_the_cap(self):
+        self.post_event(1, 'switch', 'on')
+        self.assertTrue(self.listener.is_receiving())
+        self.assertEqual(self.night_interval(), 7 * 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()